@@ -0,0 +1,82 @@
+"""Local stand-in for nginx when testing DOWNLOAD_SERVE_MODE=accel.
+
+Wraps the app in a WSGI middleware that behaves like the internal
+location in nginx.example.conf: responses carrying X-Accel-Redirect (or
+X-Sendfile) have their body replaced by the referenced file, served with
+Range/If-Range support the way the front proxy would.
+
+Usage:
+    DOWNLOAD_SERVE_MODE=accel python accel_proxy.py
+"""
+import os
+import logging
+from urllib.parse import unquote
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Headers nginx keeps from the upstream response on an internal redirect
+PASSED_HEADERS = ('Content-Type', 'Content-Disposition', 'Cache-Control', 'Set-Cookie')
+
+class AccelRedirectMiddleware:
+    """Serve X-Accel-Redirect and X-Sendfile responses like a front proxy"""
+
+    def __init__(self, app, locations):
+        self.app = app
+        # Internal location prefix -> directory it is aliased to
+        self.locations = {prefix.rstrip('/') + '/': root for prefix, root in locations.items()}
+
+    def resolve(self, target):
+        """Map an internal redirect target onto a file path"""
+        target = unquote(target)
+        for prefix, root in self.locations.items():
+            if target.startswith(prefix):
+                return safe_join(root, target[len(prefix):])
+        return None
+
+    def __call__(self, environ, start_response):
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            return lambda data: None
+
+        app_iter = self.app(environ, capture)
+        headers = Headers(captured['headers'])
+        accel = headers.get('X-Accel-Redirect')
+        sendfile = headers.get('X-Sendfile')
+
+        if not accel and not sendfile:
+            start_response(captured['status'], captured['headers'])
+            return app_iter
+
+        # The upstream body is discarded, as nginx does
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+        path = self.resolve(accel) if accel else sendfile
+        if not path or not os.path.isfile(path):
+            logger.error(f"Internal redirect target not found: {accel or sendfile}")
+            return NotFound()(environ, start_response)
+
+        response = send_file(path, environ, conditional=True, etag=True)
+        for name in PASSED_HEADERS:
+            if name in headers:
+                response.headers[name] = headers[name]
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response(environ, start_response)
+
+if __name__ == '__main__':
+    os.environ.setdefault('DOWNLOAD_SERVE_MODE', 'accel')
+    from run import app
+
+    app.wsgi_app = AccelRedirectMiddleware(app.wsgi_app, {
+        app.config['DOWNLOAD_ACCEL_PREFIX']: app.config['UPLOAD_FOLDER']
+    })
+    port = int(os.environ.get('PORT', 5000))
+    app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,72 @@
+"""Apply a firmware delta downloaded with X-Delta-Base.
+
+Rebuilds the new firmware from the file you already have and the patch,
+and checks the result's SHA-256. Needs only the Python standard library
+for block patches (X-Delta-Format: blocks); VCDIFF patches are applied
+with xdelta3 instead:
+
+    xdelta3 -d -s OLD_FILE PATCH NEW_FILE
+
+Usage:
+    python apply_delta.py OLD_FILE PATCH NEW_FILE
+"""
+import hashlib
+import struct
+import sys
+import zlib
+
+def read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated patch')
+    return data
+
+def apply_delta(source_path, patch_path, output_path):
+    with open(patch_path, 'rb') as patch, open(source_path, 'rb') as source, open(output_path, 'wb') as out:
+        if read_exact(patch, 4) != b'SDLT':
+            raise ValueError('Not a block patch; use xdelta3 for VCDIFF patches')
+        version, block_size, target_size = struct.unpack('<BIQ', read_exact(patch, 13))
+        source_digest = read_exact(patch, 32).hex()
+        target_digest = read_exact(patch, 32).hex()
+        
+        # Check the old file first, a patch only applies to that exact file
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            sha256.update(chunk)
+        if sha256.hexdigest() != source_digest:
+            raise ValueError('OLD_FILE is not the version this patch was made for')
+        
+        sha256 = hashlib.sha256()
+        while True:
+            op = read_exact(patch, 1)
+            if op == b'E':
+                break
+            if op == b'C':
+                offset, length = struct.unpack('<QQ', read_exact(patch, 16))
+                source.seek(offset)
+                while length:
+                    data = read_exact(source, min(length, 1024 * 1024))
+                    sha256.update(data)
+                    out.write(data)
+                    length -= len(data)
+            elif op == b'I':
+                length, = struct.unpack('<Q', read_exact(patch, 8))
+                data = zlib.decompress(read_exact(patch, length))
+                sha256.update(data)
+                out.write(data)
+            else:
+                raise ValueError('Corrupt patch')
+        
+        if out.tell() != target_size or sha256.hexdigest() != target_digest:
+            raise ValueError('Patched file does not match the new firmware')
+    return target_digest
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(2)
+    try:
+        print(f"OK sha256={apply_delta(*sys.argv[1:])}")
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
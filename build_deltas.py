@@ -0,0 +1,48 @@
+"""Build firmware delta patches offline.
+
+Pending patches are queued by the admin views whenever a firmware
+version is added or replaced. This script builds them in a pool of
+processes, away from the web workers; run it from cron or keep it
+running with --loop.
+
+Usage:
+    python build_deltas.py [--workers 4] [--loop] [--schedule-all]
+"""
+import argparse
+import logging
+import time
+from samtech import create_app
+from samtech.deltas import build_pending_deltas, collect_deltas, schedule_all_deltas
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Build firmware delta patches')
+    parser.add_argument('--workers', type=int, help='Number of build processes (default DELTA_WORKERS)')
+    parser.add_argument('--loop', action='store_true', help='Keep polling for new work')
+    parser.add_argument('--interval', type=int, default=60, help='Seconds between polls with --loop')
+    parser.add_argument('--schedule-all', action='store_true', help='Queue patches for every existing model series first')
+    args = parser.parse_args()
+    
+    app = create_app()
+    with app.app_context():
+        workers = args.workers or app.config['DELTA_WORKERS']
+        if args.schedule_all:
+            logger.info(f"Scheduled {schedule_all_deltas()} deltas")
+        
+        while True:
+            removed = collect_deltas()
+            if removed:
+                logger.info(f"Removed {removed} deltas of deleted firmware")
+            
+            built = build_pending_deltas(workers)
+            if built:
+                logger.info(f"Processed {built} deltas")
+            elif not args.loop:
+                break
+            elif not built:
+                time.sleep(args.interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Delete firmware blobs that were uploaded but never attached to a firmware.
+
+Files streamed to /admin/firmware/upload are kept until a firmware
+references them. This removes the ones still unreferenced after a grace
+period; run it from cron, e.g. daily.
+
+Usage:
+    python collect_blobs.py [--older-than-hours 24]
+"""
+import argparse
+import logging
+from datetime import timedelta
+from samtech import create_app
+from samtech.blobs import collect_unreferenced_blobs
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete unreferenced firmware blobs')
+    parser.add_argument('--older-than-hours', type=float, default=24,
+                        help='Only delete blobs uploaded at least this long ago')
+    args = parser.parse_args()
+    
+    app = create_app()
+    with app.app_context():
+        removed = collect_unreferenced_blobs(timedelta(hours=args.older_than_hours))
+        logger.info(f"Removed {removed} unreferenced blobs")
+
+if __name__ == '__main__':
+    main()
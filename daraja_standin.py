@@ -0,0 +1,183 @@
+"""Local stand-in for the Safaricom Daraja API when testing M-Pesa payments.
+
+Serves what samtech.daraja uses: oauth/v1/generate (HTTP Basic with the
+consumer key and secret), STK push and STK push query (Bearer tokens it
+issued). An accepted STK push is "paid" after --callback-delay seconds:
+the result is posted to the push's CallBackURL and reported by queries.
+Failures and slowness can be injected to exercise retries and the
+circuit breaker. It is not meant for anything but testing.
+
+Point the app at it with MPESA_BASE_URL=http://127.0.0.1:8089.
+
+Usage:
+    python daraja_standin.py --port 8089 --consumer-key dev --consumer-secret devsecret \\
+        [--callback-delay 3] [--result-code 0] [--fail-rate 0.2] [--latency 0.5]
+"""
+from datetime import datetime
+from werkzeug.exceptions import HTTPException, BadRequest, Unauthorized
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+import argparse
+import json
+import logging
+import os
+import random
+import requests
+import threading
+import time
+import uuid
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def error_response(status, code, message):
+    body = {'requestId': uuid.uuid4().hex, 'errorCode': code, 'errorMessage': message}
+    return Response(json.dumps(body), status=status, mimetype='application/json')
+
+class DarajaStandIn:
+    """A WSGI app answering like Daraja's sandbox"""
+    
+    def __init__(self, consumer_key, consumer_secret, token_seconds=3599, callback_delay=3.0,
+                 result_code=0, fail_rate=0.0, latency=0.0):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.token_seconds = token_seconds
+        self.callback_delay = callback_delay
+        self.result_code = result_code
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = {}
+        # CheckoutRequestID -> push, with its result once it is "paid"
+        self.pushes = {}
+    
+    def check_token(self, request):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        expires = self.tokens.get(token)
+        if scheme != 'Bearer' or expires is None or expires < time.time():
+            raise Unauthorized('Invalid Access Token')
+    
+    def generate(self, request):
+        auth = request.authorization
+        if auth is None or (auth.username, auth.password) != (self.consumer_key, self.consumer_secret):
+            raise Unauthorized('Invalid credentials')
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_seconds
+        return {'access_token': token, 'expires_in': str(self.token_seconds)}
+    
+    def stk_push(self, request):
+        self.check_token(request)
+        data = request.get_json(silent=True) or {}
+        missing = [field for field in ('BusinessShortCode', 'Password', 'Timestamp', 'Amount',
+                                       'PhoneNumber', 'CallBackURL', 'AccountReference') if not data.get(field)]
+        if missing:
+            raise BadRequest(f"Missing {', '.join(missing)}")
+        
+        push = {
+            'merchant_request_id': f'{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1',
+            'checkout_request_id': f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:12]}",
+            'amount': data['Amount'],
+            'phone': data['PhoneNumber'],
+            'callback_url': data['CallBackURL'],
+            'result': None
+        }
+        with self.lock:
+            self.pushes[push['checkout_request_id']] = push
+        if self.callback_delay >= 0:
+            threading.Timer(self.callback_delay, self.complete, (push,)).start()
+        return {
+            'MerchantRequestID': push['merchant_request_id'],
+            'CheckoutRequestID': push['checkout_request_id'],
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing'
+        }
+    
+    def complete(self, push):
+        """Settle a push and post its result to the callback URL"""
+        result = {
+            'MerchantRequestID': push['merchant_request_id'],
+            'CheckoutRequestID': push['checkout_request_id'],
+            'ResultCode': self.result_code,
+            'ResultDesc': ('The service request is processed successfully.' if self.result_code == 0
+                           else 'Request cancelled by user')
+        }
+        if self.result_code == 0:
+            result['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': push['amount']},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(push['phone'])}
+            ]}
+        push['result'] = result
+        try:
+            requests.post(push['callback_url'], json={'Body': {'stkCallback': result}}, timeout=10)
+        except requests.RequestException as e:
+            logger.error(f"Error posting callback for {push['checkout_request_id']}: {str(e)}")
+    
+    def stk_query(self, request):
+        self.check_token(request)
+        data = request.get_json(silent=True) or {}
+        push = self.pushes.get(data.get('CheckoutRequestID'))
+        if push is None:
+            raise BadRequest('Invalid CheckoutRequestID')
+        if push['result'] is None:
+            return error_response(500, '500.001.1001', 'The transaction is being processed')
+        return {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': push['merchant_request_id'],
+            'CheckoutRequestID': push['checkout_request_id'],
+            'ResultCode': str(push['result']['ResultCode']),
+            'ResultDesc': push['result']['ResultDesc']
+        }
+    
+    def dispatch(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            return error_response(503, '503.001.01', 'Service Unavailable')
+        
+        routes = {
+            '/oauth/v1/generate': self.generate,
+            '/mpesa/stkpush/v1/processrequest': self.stk_push,
+            '/mpesa/stkpushquery/v1/query': self.stk_query
+        }
+        handler = routes.get(request.path)
+        if handler is None:
+            return error_response(404, '404.001.01', 'Resource not found')
+        result = handler(request)
+        if isinstance(result, Response):
+            return result
+        return Response(json.dumps(result), mimetype='application/json')
+    
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        try:
+            response = self.dispatch(request)
+        except HTTPException as e:
+            codes = {400: '400.002.02', 401: '404.001.03'}
+            response = error_response(e.code, codes.get(e.code, '500.001.1001'), e.description)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {str(e)}")
+            response = error_response(500, '500.001.1001', str(e))
+        return response(environ, start_response)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Daraja API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--consumer-key', default=os.environ.get('MPESA_CONSUMER_KEY', 'dev'))
+    parser.add_argument('--consumer-secret', default=os.environ.get('MPESA_CONSUMER_SECRET', 'devsecret'))
+    parser.add_argument('--token-seconds', type=int, default=3599, help='Lifetime of issued tokens')
+    parser.add_argument('--callback-delay', type=float, default=3.0,
+                        help='Seconds before a push is settled; negative never settles it')
+    parser.add_argument('--result-code', type=int, default=0, help='ResultCode of settled pushes, 1032 = cancelled')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of calls answered with 503')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every call')
+    args = parser.parse_args()
+    
+    app = DarajaStandIn(args.consumer_key, args.consumer_secret, args.token_seconds, args.callback_delay,
+                        args.result_code, args.fail_rate, args.latency)
+    run_simple(args.host, args.port, app, threaded=True)
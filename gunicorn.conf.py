@@ -37,3 +37,11 @@ certfile = None
 
 # Hook application into the server
 wsgi_app = 'run:app'
+
+# Server hooks
+def worker_exit(server, worker):
+    """Called just after a worker has been exited."""
+    # Write buffered download counts before the worker goes away
+    from samtech.counters import download_counter
+    if download_counter.app is not None:
+        download_counter.stop()
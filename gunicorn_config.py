@@ -75,4 +75,7 @@ def worker_abort(worker):
 
 def worker_exit(server, worker):
     """Called just after a worker has been exited."""
-    pass
+    # Write buffered download counts before the worker goes away
+    from samtech.counters import download_counter
+    if download_counter.app is not None:
+        download_counter.stop()
@@ -0,0 +1,50 @@
+"""Move uploaded files from the old flat folders to the sharded layout.
+
+Legacy firmware files (stored before blobs), firmware images and brand
+logos are moved in batches, and Firmware.filename, Firmware.image and
+Brand.logo are rewritten as each batch is committed. Progress is kept
+in the shared state store, so the command can be stopped and run again
+at any time; it carries on where it left off.
+
+Usage:
+    python migrate_layout.py [--batch-size 500] [--only firmware-images] [--restart]
+"""
+import argparse
+import logging
+import time
+from samtech import create_app
+from samtech.layout import MIGRATIONS, migrate_batch, reset_migration
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Move uploads to the hash-sharded layout')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows moved per commit')
+    parser.add_argument('--only', choices=sorted(MIGRATIONS), action='append', help='Run only these migrations')
+    parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+    parser.add_argument('--restart', action='store_true', help='Forget saved progress and scan every row again')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        for name in args.only or MIGRATIONS:
+            if args.restart:
+                reset_migration(name)
+
+            scanned = moved = missing = 0
+            while True:
+                rows, batch_moved, batch_missing = migrate_batch(name, args.batch_size)
+                if not rows:
+                    break
+                scanned += rows
+                moved += batch_moved
+                missing += batch_missing
+                logger.info(f"{name}: {scanned} rows scanned, {moved} files moved")
+                if args.pause:
+                    time.sleep(args.pause)
+
+            logger.info(f"{name} done: {moved} files moved, {missing} missing")
+
+if __name__ == '__main__':
+    main()
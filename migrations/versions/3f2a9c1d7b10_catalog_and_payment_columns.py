@@ -0,0 +1,92 @@
+"""Add blob, device code and version columns to firmwares, and new indexes
+
+Tables added since (firmware_blobs, firmware_deltas, latest_firmware,
+upload sessions, mpesa_callbacks, revoked_downloads) are created by
+db.create_all() when the app starts. This brings the tables that already
+existed up to date. Databases created from the current models already
+match, so every step checks the live schema first.
+
+Run `python reindex_catalog.py` afterwards to fill the new columns.
+
+Revision ID: 3f2a9c1d7b10
+Revises:
+Create Date: 2026-10-18 17:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+FIRMWARE_COLUMNS = [
+    ('original_filename', sa.String(255)),
+    ('blob_digest', sa.String(64)),
+    ('model_code', sa.String(32)),
+    ('model_key', sa.String(32)),
+    ('region', sa.String(8)),
+    ('build_id', sa.String(64)),
+    ('version_key', sa.String(64)),
+    ('series', sa.String(100)),
+]
+
+# name, table, columns, dialect options
+INDEXES = [
+    ('ix_firmwares_blob_digest', 'firmwares', ['blob_digest'], {}),
+    ('ix_firmwares_region', 'firmwares', ['region'], {}),
+    ('ix_firmwares_model_key_region', 'firmwares', ['model_key', 'region'],
+     {'postgresql_ops': {'model_key': 'text_pattern_ops'}}),
+    ('ix_firmwares_build_id', 'firmwares', ['build_id'],
+     {'postgresql_ops': {'build_id': 'text_pattern_ops'}}),
+    ('ix_firmwares_series', 'firmwares', ['brand_id', 'series', 'region', 'version_key'], {}),
+    ('ix_firmwares_brand_created', 'firmwares', ['brand_id', 'created_at', 'id'], {}),
+    ('ix_firmwares_created', 'firmwares', ['created_at', 'id'], {}),
+    ('ix_firmwares_brand_updated', 'firmwares', ['brand_id', 'updated_at', 'id'], {}),
+    ('ix_payments_status_created', 'payments', ['status', 'created_at'], {}),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    sqlite = bind.dialect.name == 'sqlite'
+
+    columns = {column['name']: column for column in inspector.get_columns('firmwares')}
+    for name, type_ in FIRMWARE_COLUMNS:
+        if name not in columns:
+            op.add_column('firmwares', sa.Column(name, type_, nullable=True))
+
+    # SQLite cannot add a constraint to an existing table
+    if not sqlite and 'firmware_blobs' in inspector.get_table_names():
+        foreign_keys = inspector.get_foreign_keys('firmwares')
+        if not any(fk['constrained_columns'] == ['blob_digest'] for fk in foreign_keys):
+            op.create_foreign_key('fk_firmwares_blob_digest', 'firmwares', 'firmware_blobs',
+                                  ['blob_digest'], ['digest'])
+
+    # Files over 2GB; SQLite integers are 64-bit already
+    if not sqlite and not isinstance(columns['size']['type'], sa.BigInteger):
+        op.alter_column('firmwares', 'size', type_=sa.BigInteger(), existing_nullable=True)
+
+    for name, table, index_columns, options in INDEXES:
+        existing = {index['name'] for index in inspector.get_indexes(table)}
+        if name not in existing:
+            op.create_index(name, table, index_columns, **options)
+
+
+def downgrade():
+    bind = op.get_bind()
+    sqlite = bind.dialect.name == 'sqlite'
+
+    for name, table, index_columns, options in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+
+    with op.batch_alter_table('firmwares') as batch_op:
+        if not sqlite:
+            batch_op.drop_constraint('fk_firmwares_blob_digest', type_='foreignkey')
+            batch_op.alter_column('size', type_=sa.Integer(), existing_nullable=True)
+        for name, type_ in reversed(FIRMWARE_COLUMNS):
+            batch_op.drop_column(name)
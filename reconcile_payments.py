@@ -0,0 +1,46 @@
+"""Settle M-Pesa payments whose result callback never arrived.
+
+Payments still pending after MPESA_RECONCILE_AFTER_SECONDS are checked
+with STK push queries, a batch at a time with a bounded number of
+queries in flight, and their outcomes applied in bulk. Run it from cron
+or keep it running with --loop. Progress is reported under "reconcile"
+in /admin/metrics.
+
+Usage:
+    python reconcile_payments.py [--older-than 120] [--concurrency 4] [--loop]
+"""
+import argparse
+import logging
+import time
+from samtech import create_app
+from samtech.payments import reconcile_payments
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile pending M-Pesa payments')
+    parser.add_argument('--older-than', type=int, help='Seconds a payment must have been pending (default MPESA_RECONCILE_AFTER_SECONDS)')
+    parser.add_argument('--batch-size', type=int, help='Payments read per batch (default MPESA_RECONCILE_BATCH)')
+    parser.add_argument('--concurrency', type=int, help='Queries in flight (default MPESA_RECONCILE_CONCURRENCY)')
+    parser.add_argument('--loop', action='store_true', help='Keep reconciling')
+    parser.add_argument('--interval', type=int, default=60, help='Seconds between runs with --loop')
+    args = parser.parse_args()
+    
+    app = create_app()
+    with app.app_context():
+        while True:
+            stats = reconcile_payments(args.older_than, args.batch_size, args.concurrency)
+            if stats is None:
+                logger.info("Another reconciliation is running")
+            elif stats['checked']:
+                logger.info(f"Checked {stats['checked']} of {stats['backlog']} payments in "
+                            f"{stats['finished_at'] - stats['started_at']:.1f}s: {stats['completed']} completed, "
+                            f"{stats['failed']} failed, {stats['unsent']} never sent, "
+                            f"{stats['pending']} still pending, {stats['errors']} errors")
+            if not args.loop:
+                break
+            time.sleep(args.interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Rebuild the catalog's derived data after an upgrade or a bulk import.
+
+Admin views keep these up to date as firmware is added and edited; this
+fills them in for rows written before they existed:
+
+    --search    rebuild the full-text search index
+    --devices   extract model codes, regions and build ids where missing
+    --versions  fill version keys and the latest build of each model
+    --manifests hash files stored before chunk manifests and CRC-32s were recorded
+
+Device codes, version keys and manifests are filled in batches with progress kept in the shared
+state store, so an interrupted run carries on where it left off.
+
+Usage:
+    python reindex_catalog.py [--search] [--devices] [--versions] [--manifests] [--batch-size 500] [--restart]
+"""
+import argparse
+import logging
+from samtech import create_app
+from samtech.devices import backfill_device_codes
+from samtech.manifests import backfill_manifests
+from samtech.search import search_index
+from samtech.versions import backfill_versions
+from samtech.shared import shared
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild derived catalog data')
+    parser.add_argument('--search', action='store_true', help='Rebuild the full-text search index')
+    parser.add_argument('--devices', action='store_true', help='Extract missing device codes')
+    parser.add_argument('--versions', action='store_true', help='Fill version keys and latest builds')
+    parser.add_argument('--manifests', action='store_true', help='Hash files that have no chunk manifest or CRC-32')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows updated per commit')
+    parser.add_argument('--restart', action='store_true', help='Forget saved progress and scan every row again')
+    args = parser.parse_args()
+    everything = not (args.search or args.devices or args.versions or args.manifests)
+    
+    app = create_app()
+    with app.app_context():
+        if args.search or everything:
+            logger.info(f"Indexed {search_index.rebuild()} firmwares for search")
+        
+        if args.devices or everything:
+            if args.restart:
+                shared.delete('device-codes-backfill')
+            scanned = 0
+            while True:
+                rows = backfill_device_codes(args.batch_size)
+                if not rows:
+                    break
+                scanned += rows
+                logger.info(f"Device codes: {scanned} firmwares scanned")
+        
+        # Version series come from the model codes, so these go last
+        if args.versions or everything:
+            if args.restart:
+                shared.delete('version-keys-backfill')
+            scanned = 0
+            while True:
+                rows = backfill_versions(args.batch_size)
+                if not rows:
+                    break
+                scanned += rows
+                logger.info(f"Version keys: {scanned} firmwares scanned")
+        
+        if args.manifests or everything:
+            if args.restart:
+                shared.delete('manifest-backfill')
+            scanned = 0
+            while True:
+                rows = backfill_manifests(args.batch_size)
+                if not rows:
+                    break
+                scanned += rows
+                logger.info(f"Manifests: {scanned} firmwares scanned")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Local stand-in for an S3-compatible service when testing STORAGE_BACKEND=s3.
+
+Serves path-style /<bucket>/<key> URLs from a directory, checking AWS
+Signature V4 in the Authorization header or in a presigned query string.
+Supports what the s3 storage driver uses: PUT, GET and HEAD with Range,
+DELETE, server-side copies and multipart uploads. It is not meant for
+production; use MinIO or a real bucket there.
+
+Usage:
+    python s3_standin.py --root /tmp/s3 --port 9000 --access-key dev --secret-key devsecret
+"""
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+from werkzeug.exceptions import HTTPException, BadRequest, Forbidden, NotFound
+from werkzeug.security import safe_join
+from werkzeug.serving import run_simple
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Request, Response
+from xml.etree import ElementTree
+from samtech.storage import signature
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import re
+import shutil
+import uuid
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CREDENTIAL = re.compile(
+    r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, '
+    r'SignedHeaders=([^,]+), Signature=([0-9a-f]+)'
+)
+
+def error_response(status, code, message):
+    body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'
+    return Response(body, status=status, mimetype='application/xml')
+
+class S3StandIn:
+    """A WSGI app answering the subset of the S3 API the storage driver uses"""
+    
+    def __init__(self, root, access_key, secret_key):
+        self.root = root
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.uploads = os.path.join(root, '.uploads')
+        os.makedirs(self.uploads, exist_ok=True)
+    
+    def authorize(self, request):
+        """Check the request's SigV4 signature"""
+        params = {k: v for k, v in request.args.items(multi=False)}
+        headers = {name.lower(): value for name, value in request.headers.items()}
+        path = request.path
+        
+        if 'X-Amz-Signature' in params:
+            given = params.pop('X-Amz-Signature')
+            access_key, date, region = params['X-Amz-Credential'].split('/')[:3]
+            amz_date = params['X-Amz-Date']
+            signed_headers = params['X-Amz-SignedHeaders'].split(';')
+            issued = datetime.strptime(amz_date, '%Y%m%dT%H%M%SZ')
+            if issued + timedelta(seconds=int(params['X-Amz-Expires'])) < datetime.utcnow():
+                raise Forbidden('Request has expired')
+            payload_hash = 'UNSIGNED-PAYLOAD'
+        else:
+            match = CREDENTIAL.match(headers.get('authorization', ''))
+            if not match:
+                raise Forbidden('Missing or malformed Authorization header')
+            access_key, date, region, signed_headers, given = match.groups()
+            signed_headers = signed_headers.split(';')
+            amz_date = headers['x-amz-date']
+            payload_hash = headers.get('x-amz-content-sha256', 'UNSIGNED-PAYLOAD')
+        
+        if access_key != self.access_key:
+            raise Forbidden('Unknown access key')
+        expected = signature(self.secret_key, region, amz_date, request.method, path, params,
+                             headers, signed_headers, payload_hash)
+        if not hmac.compare_digest(expected, given):
+            raise Forbidden('Signature does not match')
+    
+    def object_path(self, request):
+        parts = request.path.lstrip('/').split('/', 1)
+        if len(parts) < 2 or not parts[1]:
+            raise BadRequest('Only path-style object URLs are supported')
+        path = safe_join(self.root, *parts)
+        if path is None:
+            raise BadRequest('Invalid key')
+        return path
+    
+    def write(self, request, path):
+        """Write the request body to `path` atomically and return its MD5"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        md5 = hashlib.md5()
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: request.stream.read(1024 * 1024), b''):
+                md5.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        return md5.hexdigest()
+    
+    def upload_dir(self, upload_id):
+        path = safe_join(self.uploads, upload_id)
+        if path is None or not os.path.isdir(path):
+            raise NotFound('No such upload')
+        return path
+    
+    def dispatch(self, request):
+        self.authorize(request)
+        path = self.object_path(request)
+        args = request.args
+        
+        if request.method == 'POST' and 'uploads' in args:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.uploads, upload_id))
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+            return Response(body, mimetype='application/xml')
+        
+        if request.method == 'PUT' and 'uploadId' in args:
+            part_path = os.path.join(self.upload_dir(args['uploadId']), f"{int(args['partNumber']):05d}")
+            etag = self.write(request, part_path)
+            return Response(headers={'ETag': f'"{etag}"'})
+        
+        if request.method == 'POST' and 'uploadId' in args:
+            upload_dir = self.upload_dir(args['uploadId'])
+            document = ElementTree.fromstring(request.get_data())
+            numbers = [int(part.findtext('{*}PartNumber') or part.findtext('PartNumber'))
+                       for part in document]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as out:
+                for number in numbers:
+                    with open(os.path.join(upload_dir, f"{number:05d}"), 'rb') as part:
+                        shutil.copyfileobj(part, out)
+            os.replace(tmp_path, path)
+            shutil.rmtree(upload_dir)
+            return Response('<CompleteMultipartUploadResult/>', mimetype='application/xml')
+        
+        if request.method == 'DELETE' and 'uploadId' in args:
+            shutil.rmtree(self.upload_dir(args['uploadId']))
+            return Response(status=204)
+        
+        if request.method == 'PUT' and 'X-Amz-Copy-Source' in request.headers:
+            source = safe_join(self.root, *unquote(request.headers['X-Amz-Copy-Source']).lstrip('/').split('/', 1))
+            if source is None or not os.path.isfile(source):
+                raise NotFound('No such copy source')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(source, path)
+            return Response('<CopyObjectResult/>', mimetype='application/xml')
+        
+        if request.method == 'PUT':
+            etag = self.write(request, path)
+            return Response(headers={'ETag': f'"{etag}"'})
+        
+        if request.method == 'DELETE':
+            if not os.path.isfile(path):
+                raise NotFound('No such key')
+            os.remove(path)
+            return Response(status=204)
+        
+        if request.method in ('GET', 'HEAD'):
+            if not os.path.isfile(path):
+                raise NotFound('No such key')
+            response = send_file(path, request.environ, conditional=True, etag=True)
+            response.headers['Accept-Ranges'] = 'bytes'
+            disposition = args.get('response-content-disposition')
+            if disposition:
+                response.headers['Content-Disposition'] = disposition
+            return response
+        
+        return error_response(405, 'MethodNotAllowed', 'Method not allowed')
+    
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        try:
+            response = self.dispatch(request)
+        except HTTPException as e:
+            codes = {400: 'InvalidRequest', 403: 'SignatureDoesNotMatch', 404: 'NoSuchKey'}
+            response = error_response(e.code, codes.get(e.code, 'InternalError'), e.description)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {str(e)}")
+            response = error_response(500, 'InternalError', str(e))
+        return response(environ, start_response)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a directory as an S3-compatible bucket store')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3-data'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--access-key', default=os.environ.get('S3_ACCESS_KEY_ID', 'dev'))
+    parser.add_argument('--secret-key', default=os.environ.get('S3_SECRET_ACCESS_KEY', 'devsecret'))
+    args = parser.parse_args()
+    
+    app = S3StandIn(args.root, args.access_key, args.secret_key)
+    run_simple(args.host, args.port, app, threaded=True)
@@ -12,9 +12,11 @@ db = SQLAlchemy()
 mail = Mail()
 migrate = Migrate()
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
     app.config.from_object(Config)
+    if test_config:
+        app.config.update(test_config)
 
     # Configure logging
     log_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'logs')
@@ -34,6 +36,19 @@ def create_app():
     mail.init_app(app)
     migrate.init_app(app, db)
     
+    from .shared import shared
+    shared.init_app(app)
+    
+    from .storage import storage
+    storage.init_app(app)
+    
+    from .counters import download_counter
+    download_counter.init_app(app)
+    
+    from .payments import payment_dispatcher, callback_applier
+    payment_dispatcher.init_app(app)
+    callback_applier.init_app(app)
+    
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
     login_manager.init_app(app)
@@ -59,6 +74,9 @@ def create_app():
             from .init_db import init_db
             init_db(app)
             
+            from .search import search_index
+            search_index.init_app(app)
+            
             # Check if admin user exists
             admin = User.query.filter_by(is_admin=True).first()
             if not admin:
@@ -74,6 +92,10 @@ def create_app():
     from .auth import auth as auth_blueprint
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
     
+    # Ahead of main, whose legacy /admin/firmware views would otherwise shadow these
+    from .admin import admin as admin_blueprint
+    app.register_blueprint(admin_blueprint, url_prefix='/admin')
+    
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
     
@@ -83,7 +105,7 @@ def create_app():
     from .firmware import firmware as firmware_blueprint
     app.register_blueprint(firmware_blueprint, url_prefix='/firmware')
     
-    from .admin import admin as admin_blueprint
-    app.register_blueprint(admin_blueprint, url_prefix='/admin')
+    from .uploads import uploads as uploads_blueprint
+    app.register_blueprint(uploads_blueprint, url_prefix='/admin/uploads')
     
     return app
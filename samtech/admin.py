@@ -1,15 +1,46 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, send_file
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, send_file, abort
 from flask_login import login_required, current_user
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from werkzeug.wsgi import get_input_stream
+from datetime import datetime, timedelta
 from PIL import Image
 import os
 import uuid
 from . import db
-from .models import Brand, Firmware, User, Payment
+from .models import Brand, Firmware, User, Payment, DownloadToken
+from .tokens import revoke_downloads
+from .shared import shared
+from .admission import admission_stats
+from .deltas import schedule_deltas
+from .storage import storage
+from .layout import sharded_path, IMAGE_FOLDER, LOGO_FOLDER
+from .search import index_brand, index_firmware, unindex_firmware
+from .devices import set_device_codes
+from .versions import set_version_fields, latest_group, refresh_latest
+from .pagination import paginate, page_size
+from .pagecache import invalidate, invalidate_brand, invalidate_firmware
+from .conditional import touch_brand
+from .blobs import (blob_key, get_blob, store_blob, acquire_blob, release_blob, collect_blob,
+                    discard_blob)
 
 admin = Blueprint('admin', __name__)
 
+def firmware_blob_from_request():
+    """Return the blob and file name of the firmware file sent with a form
+    
+    The file is either part of the form, or was streamed beforehand to
+    /admin/firmware/upload and is referenced by blob_digest.
+    """
+    firmware_file = request.files.get('firmware_file')
+    if firmware_file and firmware_file.filename:
+        return store_blob(firmware_file.stream), secure_filename(firmware_file.filename)
+    
+    blob_digest = request.form.get('blob_digest', '').strip().lower()
+    if blob_digest:
+        return get_blob(blob_digest), secure_filename(request.form.get('firmware_filename', ''))
+    return None, None
+
 def save_logo(file):
     """Save brand logo and return the file path"""
     if not file:
@@ -19,11 +50,10 @@ def save_logo(file):
     filename = secure_filename(file.filename)
     unique_filename = f"{uuid.uuid4()}_{filename}"
     
-    # Create brands directory if it doesn't exist
-    logos_dir = os.path.join(current_app.static_folder, 'images', 'brands')
-    os.makedirs(logos_dir, exist_ok=True)
-    
-    filepath = os.path.join(logos_dir, unique_filename)
+    # Create the logo's shard directory if it doesn't exist
+    logo_path = sharded_path(LOGO_FOLDER, unique_filename)
+    filepath = os.path.join(current_app.static_folder, logo_path)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
     
     # Save and optimize image
     try:
@@ -36,7 +66,7 @@ def save_logo(file):
             image.thumbnail((800, 800))
         # Save with optimization
         image.save(filepath, optimize=True, quality=85)
-        return os.path.join('images', 'brands', unique_filename)
+        return logo_path
     except Exception as e:
         current_app.logger.error(f"Error saving logo: {str(e)}")
         return None
@@ -79,6 +109,7 @@ def add_brand():
         db.session.add(brand)
         db.session.commit()
         flash('Brand added successfully!', 'success')
+        invalidate('brands')
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error adding brand: {str(e)}")
@@ -123,10 +154,16 @@ def edit_brand(id):
                             current_app.logger.error(f"Error deleting old logo: {str(e)}")
                 brand.logo = new_logo_path
         
+        renamed = brand.name != name
         brand.name = name
         brand.description = description
         db.session.commit()
         flash('Brand updated successfully!', 'success')
+        invalidate_brand(brand.id)
+        
+        # Firmware is also found by its brand's name
+        if renamed:
+            index_brand(brand)
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error updating brand: {str(e)}")
@@ -153,6 +190,8 @@ def delete_brand(id):
         db.session.delete(brand)
         db.session.commit()
         flash('Brand deleted successfully!', 'success')
+        invalidate_brand(id)
+        invalidate(f'brand-firmware:{id}', 'firmware-list')
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error deleting brand: {str(e)}")
@@ -372,9 +411,13 @@ def manage_firmware():
         flash('Access denied. Admin privileges required.', 'error')
         return redirect(url_for('main.index'))
     
-    firmwares = Firmware.query.order_by(Firmware.created_at.desc()).all()
+    try:
+        page = paginate(Firmware.query, [Firmware.created_at, Firmware.id], after=request.args.get('after'),
+                        before=request.args.get('before'), per_page=page_size())
+    except ValueError:
+        abort(400)
     brands = Brand.query.order_by(Brand.name).all()
-    return render_template('admin/firmware.html', firmwares=firmwares, brands=brands)
+    return render_template('admin/firmware.html', firmwares=page.items, page=page, brands=brands)
 
 @admin.route('/firmware/add', methods=['GET', 'POST'])
 @login_required
@@ -384,7 +427,7 @@ def add_firmware():
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
-        firmware_path = None
+        firmware_blob = None
         image_path = None
         
         try:
@@ -418,8 +461,10 @@ def add_firmware():
             # Handle file uploads
             firmware_file = request.files.get('firmware_file')
             image = request.files.get('image')
+            # Clients that already know the file's SHA-256 can skip the upload
+            blob_digest = request.form.get('blob_digest', '').strip()
             
-            if not firmware_file or not firmware_file.filename:
+            if (not firmware_file or not firmware_file.filename) and not blob_digest:
                 flash('Firmware file is required.', 'error')
                 return redirect(url_for('admin.manage_firmware'))
             
@@ -431,21 +476,21 @@ def add_firmware():
             
             os.makedirs(upload_dir, exist_ok=True)
             
-            # Save firmware file
-            firmware_filename = secure_filename(firmware_file.filename)
-            unique_firmware_filename = f"{uuid.uuid4()}_{firmware_filename}"
-            firmware_path = os.path.join(upload_dir, unique_firmware_filename)
-            firmware_file.save(firmware_path)
+            # Store firmware file once per content
+            firmware_blob, firmware_filename = firmware_blob_from_request()
+            if not firmware_blob or not firmware_filename:
+                flash('Firmware file not found. Please upload it again.', 'error')
+                return redirect(url_for('admin.manage_firmware'))
+            acquire_blob(firmware_blob)
             
             # Save image if provided
             if image and image.filename:
                 try:
                     image_filename = secure_filename(image.filename)
                     unique_image_filename = f"{uuid.uuid4()}_{image_filename}"
-                    images_dir = os.path.join(current_app.static_folder, 'images', 'firmware')
-                    os.makedirs(images_dir, exist_ok=True)
-                    
-                    temp_image_path = os.path.join(images_dir, unique_image_filename)
+                    image_path = sharded_path(IMAGE_FOLDER, unique_image_filename)
+                    temp_image_path = os.path.join(current_app.static_folder, image_path)
+                    os.makedirs(os.path.dirname(temp_image_path), exist_ok=True)
                     image.save(temp_image_path)
                     
                     # Optimize image
@@ -455,8 +500,6 @@ def add_firmware():
                         if max(img.size) > 800:
                             img.thumbnail((800, 800))
                         img.save(temp_image_path, optimize=True, quality=85)
-                    
-                    image_path = os.path.join('images', 'firmware', unique_image_filename)
                 except Exception as e:
                     current_app.logger.error(f"Error processing image: {str(e)}")
                     if os.path.exists(temp_image_path):
@@ -470,29 +513,38 @@ def add_firmware():
                 version=version,
                 description=description,
                 features=features,
-                filename=unique_firmware_filename,
+                filename=blob_key(firmware_blob.digest),
+                original_filename=firmware_filename,
+                blob_digest=firmware_blob.digest,
                 image=image_path,
-                size=os.path.getsize(firmware_path),
+                size=firmware_blob.size,
                 price=price,
                 brand_id=brand_id,
                 creator_id=current_user.id
             )
             
+            # Model code, region and build id for exact lookups
+            set_device_codes(firmware, request.form)
+            set_version_fields(firmware)
+            
             db.session.add(firmware)
             db.session.commit()
             flash('Firmware added successfully!', 'success')
             
+            # Patches from earlier versions are built offline
+            schedule_deltas(firmware)
+            index_firmware(firmware)
+            refresh_latest(latest_group(firmware))
+            invalidate_firmware(firmware.id, firmware.brand_id)
+        
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"Error adding firmware: {str(e)}")
             flash('An error occurred while adding the firmware.', 'error')
             
-            # Clean up files on error
-            if firmware_path and os.path.exists(firmware_path):
-                try:
-                    os.remove(firmware_path)
-                except Exception as e:
-                    current_app.logger.error(f"Error removing firmware file: {str(e)}")
+            # Clean up files on error, keeping blobs other firmware uses
+            if firmware_blob is not None:
+                discard_blob(firmware_blob.digest)
             
             if image_path and os.path.exists(os.path.join(current_app.static_folder, image_path)):
                 try:
@@ -502,6 +554,61 @@ def add_firmware():
     
     return redirect(url_for('admin.manage_firmware'))
 
+@admin.route('/firmware/upload', methods=['PUT'])
+@login_required
+def upload_firmware_file():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    filename = secure_filename(request.args.get('filename', ''))
+    if not filename:
+        return jsonify({'status': 'error', 'message': 'A file name is required.'}), 400
+    
+    # The body is read as it arrives, so its size must be known up front
+    max_size = current_app.config['FIRMWARE_MAX_SIZE']
+    if request.content_length is None:
+        return jsonify({'status': 'error', 'message': 'Content-Length is required.'}), 411
+    if request.content_length > max_size:
+        return jsonify({
+            'status': 'error',
+            'message': f'Firmware files are limited to {max_size // (1024 * 1024)} MB.'
+        }), 413
+    
+    blob = None
+    try:
+        # Bypass request.stream, which is capped at MAX_CONTENT_LENGTH, and
+        # hash the raw body while it is written to the blob store
+        stream = get_input_stream(request.environ, max_content_length=max_size)
+        blob = store_blob(stream)
+        if blob.size != request.content_length:
+            raise ClientDisconnected()
+        
+        expected = request.headers.get('X-Content-SHA256', '').strip().lower()
+        if expected and expected != blob.digest:
+            db.session.rollback()
+            discard_blob(blob.digest)
+            return jsonify({'status': 'error', 'message': 'Checksum mismatch.'}), 400
+        
+        db.session.commit()
+    except ClientDisconnected:
+        db.session.rollback()
+        if blob is not None:
+            discard_blob(blob.digest)
+        return jsonify({'status': 'error', 'message': 'Upload was interrupted.'}), 400
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error streaming firmware upload: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'An error occurred while storing the file.'}), 500
+    
+    return jsonify({
+        'status': 'success',
+        'data': {
+            'sha256': blob.digest,
+            'size': blob.size,
+            'filename': filename
+        }
+    })
+
 @admin.route('/firmware/<int:id>/edit', methods=['POST'])
 @login_required
 def edit_firmware(id):
@@ -510,6 +617,11 @@ def edit_firmware(id):
         return redirect(url_for('main.index'))
     
     firmware = Firmware.query.get_or_404(id)
+    new_blob = None
+    released_digest = None
+    old_firmware_key = None
+    # A new version or model may change which build is newest in both groups
+    old_group = latest_group(firmware)
     
     try:
         # Validate required fields
@@ -528,25 +640,35 @@ def edit_firmware(id):
         firmware.version = version
         firmware.description = description
         firmware.features = request.form.get('features')
+        if firmware.brand_id != int(brand_id):
+            # The firmware leaves its old brand's page
+            touch_brand(firmware.brand_id)
         firmware.brand_id = int(brand_id)
         firmware.price = float(price)
         
         # Handle firmware file update
-        firmware_file = request.files.get('firmware_file')
-        if firmware_file and firmware_file.filename:
-            # Delete old file
-            old_firmware_path = os.path.join(current_app.config['UPLOAD_FOLDER'], firmware.filename)
-            if os.path.exists(old_firmware_path):
-                os.remove(old_firmware_path)
-            
-            # Save new file
-            firmware_filename = secure_filename(firmware_file.filename)
-            unique_firmware_filename = f"{uuid.uuid4()}_{firmware_filename}"
-            firmware_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_firmware_filename)
-            firmware_file.save(firmware_path)
-            
-            firmware.filename = unique_firmware_filename
-            firmware.size = os.path.getsize(firmware_path)
+        new_blob, firmware_filename = firmware_blob_from_request()
+        if request.form.get('blob_digest') and not new_blob:
+            flash('Firmware file not found. Please upload it again.', 'error')
+            return redirect(url_for('admin.manage_firmware'))
+        if new_blob:
+            # Old content is only removed once the update is committed
+            if new_blob.digest != firmware.blob_digest:
+                acquire_blob(new_blob)
+                if firmware.blob_digest:
+                    release_blob(firmware.blob_digest)
+                    released_digest = firmware.blob_digest
+                else:
+                    old_firmware_key = firmware.filename
+                
+                firmware.filename = blob_key(new_blob.digest)
+                firmware.blob_digest = new_blob.digest
+                firmware.size = new_blob.size
+            firmware.original_filename = firmware_filename or firmware.original_filename
+        
+        # Blank device codes are extracted again from the new details
+        set_device_codes(firmware, request.form)
+        set_version_fields(firmware)
         
         # Handle image update
         image = request.files.get('image')
@@ -560,9 +682,9 @@ def edit_firmware(id):
             # Save new image
             image_filename = secure_filename(image.filename)
             unique_image_filename = f"{uuid.uuid4()}_{image_filename}"
-            images_dir = os.path.join(current_app.static_folder, 'images', 'firmware')
-            os.makedirs(images_dir, exist_ok=True)
-            image_path = os.path.join(images_dir, unique_image_filename)
+            new_image = sharded_path(IMAGE_FOLDER, unique_image_filename)
+            image_path = os.path.join(current_app.static_folder, new_image)
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
             
             # Optimize image
             img = Image.open(image)
@@ -571,15 +693,29 @@ def edit_firmware(id):
             if max(img.size) > 800:
                 img.thumbnail((800, 800))
             img.save(image_path, optimize=True, quality=85)
-            firmware.image = os.path.join('images', 'firmware', unique_image_filename)
+            firmware.image = new_image
         
         db.session.commit()
         flash('Firmware updated successfully!', 'success')
         
+        # Remove the replaced file if nothing else uses it
+        if released_digest:
+            collect_blob(released_digest)
+        if old_firmware_key:
+            storage.delete(old_firmware_key)
+        
+        # The content or the model may have changed
+        schedule_deltas(firmware)
+        index_firmware(firmware)
+        refresh_latest(old_group, latest_group(firmware))
+        invalidate_firmware(firmware.id, old_group[0], firmware.brand_id)
+    
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error updating firmware: {str(e)}")
         flash('An error occurred while updating the firmware.', 'error')
+        if new_blob is not None:
+            discard_blob(new_blob.digest)
     
     return redirect(url_for('admin.manage_firmware'))
 
@@ -591,12 +727,15 @@ def delete_firmware(id):
         return redirect(url_for('main.index'))
     
     firmware = Firmware.query.get_or_404(id)
+    blob_digest = firmware.blob_digest
+    group = latest_group(firmware)
     
     try:
-        # Delete firmware file
-        firmware_path = os.path.join(current_app.config['UPLOAD_FOLDER'], firmware.filename)
-        if os.path.exists(firmware_path):
-            os.remove(firmware_path)
+        # Drop the blob reference, or delete a file stored before blobs
+        if blob_digest:
+            release_blob(blob_digest)
+        else:
+            storage.delete(firmware.filename)
         
         # Delete image if exists
         if firmware.image:
@@ -604,10 +743,18 @@ def delete_firmware(id):
             if os.path.exists(image_path):
                 os.remove(image_path)
         
+        touch_brand(firmware.brand_id)
         db.session.delete(firmware)
         db.session.commit()
         flash('Firmware deleted successfully!', 'success')
+        unindex_firmware(id)
+        refresh_latest(group)
+        invalidate_firmware(id, group[0])
         
+        # Unlink the file once the last firmware using it is gone
+        if blob_digest:
+            collect_blob(blob_digest)
+    
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error deleting firmware: {str(e)}")
@@ -628,5 +775,65 @@ def get_firmware(id):
         'description': firmware.description,
         'features': firmware.features,
         'brand_id': firmware.brand_id,
-        'price': firmware.price
+        'price': firmware.price,
+        'sha256': firmware.blob_digest,
+        'model_code': firmware.model_code,
+        'region': firmware.region,
+        'build_id': firmware.build_id
+    })
+
+@admin.route('/downloads/revoke', methods=['POST'])
+@login_required
+def revoke_download():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or request.form
+    try:
+        user_id = int(data.get('user_id'))
+        firmware_id = int(data.get('firmware_id'))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'user_id and firmware_id are required.'}), 400
+    
+    try:
+        # Signed tokens are refused once workers reload the revocation list;
+        # database tokens are simply removed
+        revoke_downloads(user_id, firmware_id, reason=data.get('reason'))
+        DownloadToken.query.filter_by(user_id=user_id, firmware_id=firmware_id).delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error revoking downloads: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'An error occurred while revoking downloads.'}), 500
+    
+    return jsonify({'status': 'success'})
+
+@admin.route('/firmware/blobs/<digest>')
+@login_required
+def get_firmware_blob(digest):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Lets upload clients skip sending content that is already stored
+    blob = get_blob(digest.lower())
+    if not blob:
+        return jsonify({'exists': False}), 404
+    return jsonify({
+        'exists': True,
+        'sha256': blob.digest,
+        'size': blob.size,
+        'references': blob.ref_count
+    })
+
+@admin.route('/metrics')
+@login_required
+def metrics():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Counters are shared by all workers on this host
+    return jsonify({
+        'counters': shared.counters(),
+        'admission': admission_stats(),
+        'reconcile': shared.get('mpesa-reconcile')
     })
@@ -0,0 +1,129 @@
+"""Admission control for firmware download streams.
+
+Each stream served by a worker holds one slot per scope (global, user
+and firmware). Slots are flock()ed files, so limits hold across gunicorn
+workers and a crashed worker frees its slots. Requests that find no free
+slot are turned away at once with Retry-After, and wait in a shared
+queue per scope so earlier clients are admitted first.
+"""
+from flask import current_app
+from .shared import shared
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class AdmissionTicket:
+    """The slots held by one admitted download stream"""
+    
+    def __init__(self, locks):
+        self.locks = locks
+    
+    def release(self):
+        for lock in self.locks:
+            lock.release()
+        self.locks = []
+    
+    def hold(self, response):
+        """Keep the slots until the response body has been sent"""
+        # Bodies passed straight through (send_file) are closed by the
+        # server without running response.call_on_close callbacks, so hook
+        # the body itself and keep it the server's file wrapper
+        body = response.response
+        body_close = getattr(body, 'close', None)
+        
+        def close():
+            try:
+                if body_close:
+                    body_close()
+            finally:
+                self.release()
+        
+        try:
+            body.close = close
+        except AttributeError:
+            pass
+        response.call_on_close(self.release)
+        return response
+
+def stream_limits(user_id, firmware_id):
+    """Return the (scope, limit) pairs that apply to a stream"""
+    config = current_app.config
+    limits = [
+        ('global', config['DOWNLOAD_MAX_STREAMS']),
+        (f'user-{user_id}', config['DOWNLOAD_MAX_STREAMS_PER_USER']),
+        (f'firmware-{firmware_id}', config['DOWNLOAD_MAX_STREAMS_PER_FIRMWARE'])
+    ]
+    return [(scope, limit) for scope, limit in limits if limit > 0]
+
+def acquire_slot(scope, limit):
+    """Take a free slot in a scope without blocking, or return None"""
+    for index in range(limit):
+        lock = shared.lock(os.path.join('slots', scope, str(index)))
+        if lock.acquire(blocking=False):
+            return lock
+    return None
+
+def admit(user_id, firmware_id):
+    """Try to admit a download stream
+    
+    Returns an AdmissionTicket, or None and the scope that was full.
+    """
+    key = f'{user_id}:{firmware_id}'
+    stale_after = 3 * current_app.config['DOWNLOAD_RETRY_AFTER_SECONDS']
+    limits = stream_limits(user_id, firmware_id)
+    # A user over their own limit only waits for their own streams
+    queued_scopes = [scope for scope, _ in limits if not scope.startswith('user-')]
+    
+    # Clients already waiting for a scope go first
+    for scope in queued_scopes:
+        if shared.queue_position(scope, key, stale_after) > 0:
+            shared.enqueue(scope, key)
+            shared.incr('admission.rejected.queued')
+            return None, scope
+    
+    locks = []
+    for scope, limit in limits:
+        lock = acquire_slot(scope, limit)
+        if lock is None:
+            for held in locks:
+                held.release()
+            if scope in queued_scopes:
+                shared.enqueue(scope, key)
+            shared.incr(f"admission.rejected.{scope.split('-')[0]}")
+            return None, scope
+        locks.append(lock)
+    
+    for scope in queued_scopes:
+        shared.dequeue(scope, key)
+    shared.incr('admission.admitted')
+    return AdmissionTicket(locks), None
+
+def queue_position(user_id, firmware_id, scope):
+    """Return a waiting client's 1-based place in a scope's queue"""
+    if scope.startswith('user-'):
+        return None
+    stale_after = 3 * current_app.config['DOWNLOAD_RETRY_AFTER_SECONDS']
+    return shared.queue_position(scope, f'{user_id}:{firmware_id}', stale_after) + 1
+
+def admission_stats():
+    """Report current admission state for the metrics endpoint"""
+    limit = current_app.config['DOWNLOAD_MAX_STREAMS']
+    active = None
+    if limit > 0:
+        # A slot that cannot be locked is held by a live stream
+        active = 0
+        for index in range(limit):
+            lock = shared.lock(os.path.join('slots', 'global', str(index)))
+            if lock.acquire(blocking=False):
+                lock.release()
+            else:
+                active += 1
+    
+    stale_after = 3 * current_app.config['DOWNLOAD_RETRY_AFTER_SECONDS']
+    return {
+        'active_streams': active,
+        'max_streams': limit or None,
+        'queue_depth': shared.queue_depth('global', stale_after),
+        'waiting_total': shared.queue_depth(None, stale_after)
+    }
@@ -0,0 +1,151 @@
+"""Content-addressed storage for firmware files.
+
+Uploads are hashed while they are staged in UPLOAD_FOLDER/tmp and kept
+once per SHA-256 digest under blobs/ in storage. Firmware rows reference blobs, which
+are reference counted and only unlinked when the last reference goes.
+"""
+from flask import current_app
+from sqlalchemy import delete, inspect, update
+from . import db
+from .models import FirmwareBlob
+from .storage import storage
+from .manifests import ContentHasher, set_manifest
+from datetime import datetime
+import os
+import re
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def blob_key(digest):
+    """Return the path of a blob relative to the upload folder"""
+    return os.path.join('blobs', digest[:2], digest[2:4], digest)
+
+def write_blob(stream):
+    """Write a stream into the store, returning its ContentHasher"""
+    tmp_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    
+    # Hash while writing so the upload is read exactly once
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+    hasher = ContentHasher()
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+        
+        place_blob(tmp_path, hasher.digest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return hasher
+
+def place_blob(tmp_path, digest, keep=False):
+    """Move a finished file to its blob key, dropping duplicates
+    
+    With `keep` the file is linked (or copied) and left in place, for
+    callers that only remove it once the blob's row is committed.
+    """
+    key = blob_key(digest)
+    if storage.exists(key):
+        # Identical content is already stored
+        if not keep:
+            os.remove(tmp_path)
+    else:
+        storage.put_file(key, tmp_path, keep=keep)
+
+def hash_file(path):
+    """Return a ContentHasher that has read a whole file"""
+    with open(path, 'rb') as f:
+        return ContentHasher().read(f)
+
+def get_blob(digest):
+    """Return a stored blob by digest, or None if it is not available"""
+    if not digest or not DIGEST_RE.match(digest):
+        return None
+    blob = db.session.get(FirmwareBlob, digest)
+    if blob is None or not storage.exists(blob_key(digest)):
+        return None
+    return blob
+
+def blob_record(hasher):
+    """Return the row for a stored blob, adding it if it is new"""
+    blob = db.session.get(FirmwareBlob, hasher.digest)
+    if blob is None:
+        blob = FirmwareBlob(digest=hasher.digest, size=hasher.size, crc32=hasher.crc32, ref_count=0)
+        db.session.add(blob)
+    else:
+        if blob.ref_count <= 0:
+            # Uploaded again, so give it a full grace period before collection
+            blob.created_at = datetime.utcnow()
+        if blob.crc32 is None:
+            blob.crc32 = hasher.crc32
+    if blob.chunk_digests is None:
+        set_manifest(blob, hasher)
+    return blob
+
+def store_blob(stream):
+    """Store an upload and return its blob, reusing identical content"""
+    return blob_record(write_blob(stream))
+
+def acquire_blob(blob):
+    """Add a reference to a blob in the current transaction"""
+    if inspect(blob).pending:
+        blob.ref_count = (blob.ref_count or 0) + 1
+    else:
+        blob.ref_count = FirmwareBlob.ref_count + 1
+
+def release_blob(digest):
+    """Drop a reference to a blob in the current transaction"""
+    db.session.execute(
+        update(FirmwareBlob)
+        .where(FirmwareBlob.digest == digest)
+        .values(ref_count=FirmwareBlob.ref_count - 1)
+    )
+
+def collect_blob(digest, created_before=None):
+    """Delete a blob nothing references any more; call after commit"""
+    condition = [FirmwareBlob.digest == digest, FirmwareBlob.ref_count <= 0]
+    if created_before is not None:
+        condition.append(FirmwareBlob.created_at < created_before)
+    try:
+        result = db.session.execute(delete(FirmwareBlob).where(*condition))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error collecting blob {digest}: {str(e)}")
+        return False
+    
+    if result.rowcount:
+        discard_blob(digest)
+        return True
+    return False
+
+def discard_blob(digest):
+    """Remove a blob file that has no row, e.g. after a failed upload"""
+    if db.session.get(FirmwareBlob, digest) is not None:
+        return
+    try:
+        storage.delete(blob_key(digest))
+    except Exception as e:
+        current_app.logger.error(f"Error removing blob file: {str(e)}")
+
+def collect_unreferenced_blobs(older_than):
+    """Delete blobs uploaded more than `older_than` ago but never attached to a firmware
+    
+    Run offline by collect_blobs.py. The age is checked again as each row
+    is deleted, so a blob uploaded again meanwhile is kept.
+    """
+    cutoff = datetime.utcnow() - older_than
+    digests = [digest for (digest,) in db.session.query(FirmwareBlob.digest).filter(
+        FirmwareBlob.ref_count <= 0,
+        FirmwareBlob.created_at < cutoff
+    ).all()]
+    return sum(1 for digest in digests if collect_blob(digest, created_before=cutoff))
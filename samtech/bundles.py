@@ -0,0 +1,246 @@
+"""Streaming ZIP bundles of purchased firmware.
+
+Entries are stored without compression and their sizes and CRC-32s are
+known up front, so the whole archive layout is computed before the first
+byte is sent: Content-Length is exact and any byte range can be served
+by seeking into the right stored file. Nothing is buffered beyond one read and
+no archive is written to disk. Archives over 4GB use ZIP64 records.
+"""
+from .manifests import firmware_manifest
+from .storage import storage
+import bisect
+import hashlib
+import io
+import logging
+import os
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+# Names are UTF-8
+FLAGS = 0x0800
+UNIX_FILE = 0o100644 << 16
+
+def dos_datetime(mtime):
+    """Convert a unix timestamp to the DOS time and date fields"""
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    )
+
+class ChecksumPending(Exception):
+    """Raised when a file's CRC-32 has not been recorded yet"""
+
+def entry_crc32(firmware, stat):
+    """Return the recorded CRC-32 of a firmware file, or None if there is none yet
+    
+    Nothing is read here: files stored before CRCs were recorded are
+    hashed offline by reindex_catalog.py --manifests.
+    """
+    blob = firmware.blob
+    if blob is not None:
+        return blob.crc32
+    manifest = firmware_manifest(firmware, stat)
+    return manifest.get('crc32') if manifest is not None else None
+
+class ZipEntry:
+    def __init__(self, name, key, size, crc, mtime):
+        self.name = name.encode('utf-8')
+        self.key = key
+        self.size = size
+        self.crc = crc
+        self.time, self.date = dos_datetime(mtime)
+        self.offset = None
+    
+    def local_header(self):
+        extra = b''
+        size = self.size
+        version = VERSION_DEFAULT
+        if self.size >= ZIP64_LIMIT:
+            extra = struct.pack('<HHQQ', 1, 16, self.size, self.size)
+            size = ZIP64_LIMIT
+            version = VERSION_ZIP64
+        return struct.pack(
+            '<4sHHHHHLLLHH', b'PK\x03\x04', version, FLAGS, 0, self.time, self.date,
+            self.crc, size, size, len(self.name), len(extra)
+        ) + self.name + extra
+    
+    def central_header(self):
+        # Only fields that overflow go in the ZIP64 extra field, in order
+        fields = []
+        size = self.size
+        offset = self.offset
+        if self.size >= ZIP64_LIMIT:
+            fields += [self.size, self.size]
+            size = ZIP64_LIMIT
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+            offset = ZIP64_LIMIT
+        extra = b''
+        version = VERSION_DEFAULT
+        if fields:
+            extra = struct.pack(f'<HH{len(fields)}Q', 1, 8 * len(fields), *fields)
+            version = VERSION_ZIP64
+        return struct.pack(
+            '<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02', (3 << 8) | version, version, FLAGS, 0,
+            self.time, self.date, self.crc, size, size, len(self.name), len(extra), 0, 0, 0,
+            UNIX_FILE, offset
+        ) + self.name + extra
+
+def end_records(count, cd_offset, cd_size):
+    """Build the end of central directory records"""
+    records = b''
+    if count >= ZIP_FILECOUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+        zip64_offset = cd_offset + cd_size
+        records += struct.pack(
+            '<4sQHHLLQQQQ', b'PK\x06\x06', 44, (3 << 8) | VERSION_ZIP64, VERSION_ZIP64,
+            0, 0, count, count, cd_size, cd_offset
+        )
+        records += struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_offset, 1)
+        count = min(count, ZIP_FILECOUNT_LIMIT)
+        cd_offset = min(cd_offset, ZIP64_LIMIT)
+        cd_size = min(cd_size, ZIP64_LIMIT)
+    return records + struct.pack(
+        '<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0
+    )
+
+class ZipBundle(io.RawIOBase):
+    """A seekable, read-only view of a ZIP archive built from stored files"""
+    
+    def __init__(self, entries):
+        super().__init__()
+        # The archive is a list of segments, each either bytes or a stored file
+        self.segments = []
+        self.starts = []
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset = self.add(offset, entry.local_header())
+            offset = self.add(offset, entry.key, entry.size)
+        cd_offset = offset
+        for entry in entries:
+            offset = self.add(offset, entry.central_header())
+        offset = self.add(offset, end_records(len(entries), cd_offset, offset - cd_offset))
+        
+        self.size = offset
+        self.position = 0
+        self.file = None
+        self.file_key = None
+    
+    def add(self, offset, data, size=None):
+        size = len(data) if size is None else size
+        if size:
+            self.starts.append(offset)
+            self.segments.append((offset, size, data))
+        return offset + size
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+    
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            filled += self.read_segment(view[filled:])
+        return filled
+    
+    def read_segment(self, view):
+        """Read from the segment at the current position into `view`"""
+        index = bisect.bisect_right(self.starts, self.position) - 1
+        start, size, data = self.segments[index]
+        skip = self.position - start
+        length = min(len(view), size - skip)
+        
+        if isinstance(data, bytes):
+            view[:length] = data[skip:skip + length]
+        else:
+            if self.file_key != data:
+                self.close_file()
+                self.file = storage.open(data)
+                self.file_key = data
+            self.file.seek(skip)
+            filled = 0
+            while filled < length:
+                count = self.file.readinto(view[filled:length])
+                if not count:
+                    raise IOError(f"Firmware file changed while bundling: {data}")
+                filled += count
+        
+        self.position += length
+        return length
+    
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_key = None
+    
+    def close(self):
+        self.close_file()
+        super().close()
+
+def entry_names(firmwares):
+    """Give each firmware a unique file name inside the archive"""
+    from .firmware import firmware_download_name
+    names = {}
+    seen = set()
+    for firmware in firmwares:
+        name = firmware_download_name(firmware) or f'firmware-{firmware.id}'
+        if name in seen:
+            base, ext = os.path.splitext(name)
+            name = f'{base}-{firmware.id}{ext}'
+        seen.add(name)
+        names[firmware.id] = name
+    return names
+
+def build_bundle(firmwares):
+    """Lay out a ZIP of firmware files; returns the bundle, ETag and mtime
+    
+    Raises ChecksumPending if any file has no recorded CRC-32.
+    """
+    from .firmware import firmware_etag
+    names = entry_names(firmwares)
+    entries = []
+    validators = []
+    last_modified = 0
+    for firmware in firmwares:
+        stat = storage.stat(firmware.filename)
+        etag = firmware_etag(firmware, stat)
+        crc = entry_crc32(firmware, stat)
+        if crc is None:
+            raise ChecksumPending(f"No CRC-32 recorded for firmware {firmware.id}")
+        entries.append(ZipEntry(
+            names[firmware.id],
+            firmware.filename,
+            stat.size,
+            crc,
+            stat.mtime
+        ))
+        validators.append(f'{names[firmware.id]}:{etag}:{stat.mtime_ns}')
+        last_modified = max(last_modified, stat.mtime)
+    
+    # The archive bytes only depend on these, so resumed ranges stay valid
+    etag = 'zip-' + hashlib.sha256('|'.join(validators).encode('utf-8')).hexdigest()[:40]
+    return ZipBundle(entries), etag, last_modified
@@ -0,0 +1,81 @@
+"""Conditional GET (ETag / Last-Modified) for catalog pages.
+
+A page's validators come from one aggregate query over the rows it shows
+(their updated_at, plus firmware counts and ids so deletions change them
+too), the signed-in user and the templates in use. A browser revisiting
+an unchanged page gets a 304 without any ORM object being loaded or any
+template rendered.
+"""
+from datetime import datetime
+from functools import lru_cache, wraps
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import func
+from werkzeug.http import is_resource_modified
+from . import db
+from .models import Brand, Firmware
+import hashlib
+import os
+
+@lru_cache(maxsize=1)
+def template_version():
+    """Return the newest template mtime, so a deploy changes every validator"""
+    newest = 0
+    for folder, _, files in os.walk(os.path.join(current_app.root_path, current_app.template_folder)):
+        for name in files:
+            newest = max(newest, os.stat(os.path.join(folder, name)).st_mtime_ns)
+    return newest
+
+def touch_brand(brand_id):
+    """Mark a brand's page as changed, e.g. when firmware leaves it; call before commit"""
+    Brand.query.filter_by(id=brand_id).update({'updated_at': datetime.utcnow()}, synchronize_session=False)
+
+def brand_version(brand_id):
+    """Return (version, last modified) of a brand page, or None if there is no such brand"""
+    row = db.session.query(
+        Brand.updated_at, func.max(Firmware.updated_at), func.count(Firmware.id), func.max(Firmware.id)
+    ).outerjoin(Firmware, Firmware.brand_id == Brand.id).filter(Brand.id == brand_id).group_by(Brand.id).first()
+    if row is None:
+        return None
+    return tuple(row), max((value for value in row[:2] if value is not None), default=None)
+
+def firmware_version(firmware_id):
+    """Return (version, last modified) of a firmware page, or None if there is no such firmware"""
+    row = db.session.query(Firmware.updated_at, Brand.updated_at).outerjoin(
+        Brand, Firmware.brand_id == Brand.id
+    ).filter(Firmware.id == firmware_id).first()
+    if row is None:
+        return None
+    return tuple(row), max((value for value in row if value is not None), default=None)
+
+def conditional_page(version):
+    """Answer conditional GETs of a page from `version(**view_args)`"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flashed messages are shown once, so those pages always render
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+            found = version(**kwargs)
+            if found is None:
+                return view(*args, **kwargs)
+            
+            data, last_modified = found
+            user = current_user.get_id() if current_user.is_authenticated else ''
+            etag = hashlib.sha1(repr((data, user, template_version())).encode('utf-8')).hexdigest()[:32]
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            else:
+                response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Pages differ per user; browsers revalidate on every visit
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
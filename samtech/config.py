@@ -34,7 +34,140 @@ class Config:
     
     # Uploads configuration
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'uploads')
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max form/request size
+    # Firmware is streamed through /admin/firmware/upload, which is not
+    # bound by MAX_CONTENT_LENGTH
+    FIRMWARE_MAX_SIZE = int(os.getenv('FIRMWARE_MAX_SIZE', 8 * 1024 * 1024 * 1024))  # 8GB
+    # Resumable uploads through /admin/uploads
+    UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # 8MB
+    UPLOAD_SESSION_HOURS = int(os.getenv('UPLOAD_SESSION_HOURS', 24))
+    # Sessions still finalizing after this long are assumed to belong to a
+    # dead worker and can be finalized again
+    UPLOAD_FINALIZE_TIMEOUT_SECONDS = int(os.getenv('UPLOAD_FINALIZE_TIMEOUT_SECONDS', 3600))
+    
+    # Where firmware files, blobs and patches live: 'local' (UPLOAD_FOLDER)
+    # or 's3' (any S3-compatible service; see s3_standin.py for a local one)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local').lower()
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', 'http://127.0.0.1:9000')
+    S3_BUCKET = os.getenv('S3_BUCKET', 'samtech-firmware')
+    S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+    S3_ACCESS_KEY_ID = os.getenv('S3_ACCESS_KEY_ID')
+    S3_SECRET_ACCESS_KEY = os.getenv('S3_SECRET_ACCESS_KEY')
+    S3_POOL_SIZE = int(os.getenv('S3_POOL_SIZE', 20))
+    # Larger uploads are sent as multipart uploads in parts of this size
+    S3_PART_SIZE = int(os.getenv('S3_PART_SIZE', 64 * 1024 * 1024))  # 64MB
+    
+    # Catalog pages and /firmware/catalog are paged by cursor; clients may
+    # ask for up to CATALOG_MAX_PAGE_SIZE rows with ?per_page=
+    CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 24))
+    CATALOG_MAX_PAGE_SIZE = int(os.getenv('CATALOG_MAX_PAGE_SIZE', 100))
+    
+    # Downloads configuration
+    # How to answer a Range header asking for several ranges at once:
+    # 'full' ignores it and sends the whole file, 'reject' answers 416
+    DOWNLOAD_MULTIRANGE_POLICY = os.getenv('DOWNLOAD_MULTIRANGE_POLICY', 'full').lower()
+    # Who streams the file bytes: 'direct' sends them from the worker,
+    # 'accel' hands off to nginx with X-Accel-Redirect and 'sendfile'
+    # to Apache/lighttpd with X-Sendfile. 'redirect' sends clients to a
+    # presigned storage URL (S3 storage only, otherwise 'direct').
+    DOWNLOAD_SERVE_MODE = os.getenv('DOWNLOAD_SERVE_MODE', 'direct').lower()
+    DOWNLOAD_PRESIGN_SECONDS = int(os.getenv('DOWNLOAD_PRESIGN_SECONDS', 300))
+    # Internal nginx location aliased to UPLOAD_FOLDER (see nginx.example.conf)
+    DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX', '/protected-firmware/')
+    # 'db' keeps a DownloadToken row per purchase; 'signed' issues HMAC
+    # tokens that are verified without touching the database
+    DOWNLOAD_TOKEN_MODE = os.getenv('DOWNLOAD_TOKEN_MODE', 'db').lower()
+    DOWNLOAD_TOKEN_HOURS = int(os.getenv('DOWNLOAD_TOKEN_HOURS', 24))
+    # Comma separated, oldest first: the last key signs, all keys verify.
+    # Falls back to SECRET_KEY when empty.
+    DOWNLOAD_SIGNING_KEYS = [key.strip() for key in os.getenv('DOWNLOAD_SIGNING_KEYS', '').split(',') if key.strip()]
+    # Largest number of bytes a single signed-token request may fetch
+    DOWNLOAD_TOKEN_BYTE_BUDGET = int(os.getenv('DOWNLOAD_TOKEN_BYTE_BUDGET', 0)) or None
+    # Still record issued signed tokens in download_tokens as an audit log
+    DOWNLOAD_TOKEN_AUDIT = os.getenv('DOWNLOAD_TOKEN_AUDIT', 'False').lower() == 'true'
+    DOWNLOAD_REVOCATION_REFRESH_SECONDS = int(os.getenv('DOWNLOAD_REVOCATION_REFRESH_SECONDS', 30))
+    # Download counts are buffered per worker and written in batches
+    DOWNLOAD_COUNTER_FLUSH_SECONDS = float(os.getenv('DOWNLOAD_COUNTER_FLUSH_SECONDS', 10))
+    DOWNLOAD_COUNTER_BATCH = int(os.getenv('DOWNLOAD_COUNTER_BATCH', 1000))
+    # Concurrent download streams served by the workers; 0 means no limit
+    DOWNLOAD_MAX_STREAMS = int(os.getenv('DOWNLOAD_MAX_STREAMS', 0))
+    DOWNLOAD_MAX_STREAMS_PER_USER = int(os.getenv('DOWNLOAD_MAX_STREAMS_PER_USER', 0))
+    DOWNLOAD_MAX_STREAMS_PER_FIRMWARE = int(os.getenv('DOWNLOAD_MAX_STREAMS_PER_FIRMWARE', 0))
+    # Sent with 503 responses when no stream slot is free
+    DOWNLOAD_RETRY_AFTER_SECONDS = int(os.getenv('DOWNLOAD_RETRY_AFTER_SECONDS', 10))
+    # Bandwidth caps in bytes per second, 0 means no limit. The global cap
+    # is shared by all workers on this host.
+    DOWNLOAD_RATE_PER_STREAM = int(os.getenv('DOWNLOAD_RATE_PER_STREAM', 0))
+    DOWNLOAD_RATE_GLOBAL = int(os.getenv('DOWNLOAD_RATE_GLOBAL', 0))
+    # Shaped downloads are written in chunks of this size
+    DOWNLOAD_STREAM_CHUNK_SIZE = int(os.getenv('DOWNLOAD_STREAM_CHUNK_SIZE', 64 * 1024))  # 64KB
+    # Most firmware files one /firmware/bundle ZIP may contain
+    DOWNLOAD_BUNDLE_MAX_FILES = int(os.getenv('DOWNLOAD_BUNDLE_MAX_FILES', 20))
+    # Chunk size of the checksum manifests recorded for uploads
+    MANIFEST_CHUNK_SIZE = int(os.getenv('MANIFEST_CHUNK_SIZE', 4 * 1024 * 1024))  # 4MB
+    
+    # Delta updates between versions of a model, built by build_deltas.py.
+    # DELTA_TOOL is 'auto' (xdelta3 if installed), 'vcdiff' or 'blocks'.
+    DELTA_TOOL = os.getenv('DELTA_TOOL', 'auto').lower()
+    DELTA_WORKERS = int(os.getenv('DELTA_WORKERS', 2))
+    DELTA_BLOCK_SIZE = int(os.getenv('DELTA_BLOCK_SIZE', 64 * 1024))  # 64KB
+    # The built-in block format scans in Python; larger files need xdelta3
+    DELTA_BLOCKS_MAX_SIZE = int(os.getenv('DELTA_BLOCKS_MAX_SIZE', 256 * 1024 * 1024))  # 256MB
+    # Patches are built from this many previous versions
+    DELTA_MAX_SOURCES = int(os.getenv('DELTA_MAX_SOURCES', 2))
+    # Patches larger than this fraction of the full file are not served
+    DELTA_MAX_RATIO = float(os.getenv('DELTA_MAX_RATIO', 0.5))
+    
+    # Public catalog pages are cached for anonymous visitors. Admin edits
+    # invalidate the pages they affect at once; entries are also re-rendered
+    # after PAGE_CACHE_SECONDS, served stale for up to PAGE_CACHE_STALE_SECONDS
+    # more while one worker renders the new copy.
+    PAGE_CACHE_ENABLED = os.getenv('PAGE_CACHE_ENABLED', 'True').lower() == 'true'
+    PAGE_CACHE_SECONDS = int(os.getenv('PAGE_CACHE_SECONDS', 300))
+    PAGE_CACHE_STALE_SECONDS = int(os.getenv('PAGE_CACHE_STALE_SECONDS', 3600))
+    
+    # State shared by the gunicorn workers of one host (locks, counters,
+    # queues); defaults to instance/shared
+    SHARED_STATE_DIR = os.getenv('SHARED_STATE_DIR')
+    
+    # M-Pesa (Daraja) configuration
+    MPESA_BASE_URL = os.getenv('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke').rstrip('/')
+    MPESA_CONSUMER_KEY = os.getenv('MPESA_CONSUMER_KEY')
+    MPESA_CONSUMER_SECRET = os.getenv('MPESA_CONSUMER_SECRET')
+    MPESA_SHORTCODE = os.getenv('MPESA_SHORTCODE', '174379')
+    # STK push passwords are derived from the passkey and a timestamp
+    MPESA_PASSKEY = os.getenv('MPESA_PASSKEY', '')
+    MPESA_CALLBACK_URL = os.getenv('MPESA_CALLBACK_URL')
+    MPESA_TIMEOUT = float(os.getenv('MPESA_TIMEOUT', 30))
+    MPESA_CONNECT_TIMEOUT = float(os.getenv('MPESA_CONNECT_TIMEOUT', 5))
+    # Keep-alive connections per worker thread
+    MPESA_POOL_SIZE = int(os.getenv('MPESA_POOL_SIZE', 10))
+    # Idempotent calls (tokens, status queries) are retried after this
+    # doubling, jittered delay; STK pushes are never resent
+    MPESA_RETRIES = int(os.getenv('MPESA_RETRIES', 2))
+    MPESA_RETRY_DELAY = float(os.getenv('MPESA_RETRY_DELAY', 0.25))
+    MPESA_RETRY_MAX_DELAY = float(os.getenv('MPESA_RETRY_MAX_DELAY', 2))
+    # Calls fail fast for MPESA_BREAKER_SECONDS after this many failures in a row
+    MPESA_BREAKER_FAILURES = int(os.getenv('MPESA_BREAKER_FAILURES', 5))
+    MPESA_BREAKER_SECONDS = int(os.getenv('MPESA_BREAKER_SECONDS', 30))
+    # Access tokens are refreshed this long before they expire
+    MPESA_TOKEN_REFRESH_SECONDS = int(os.getenv('MPESA_TOKEN_REFRESH_SECONDS', 300))
+    # Threads per worker sending STK pushes after checkout; 0 sends them during the request
+    MPESA_DISPATCH_WORKERS = int(os.getenv('MPESA_DISPATCH_WORKERS', 4))
+    # Payments a worker lets wait for a dispatch thread before turning checkouts away
+    MPESA_DISPATCH_QUEUE = int(os.getenv('MPESA_DISPATCH_QUEUE', 200))
+    # Payments waiting longer than this for a dispatch thread are not sent
+    MPESA_DISPATCH_MAX_WAIT = int(os.getenv('MPESA_DISPATCH_MAX_WAIT', 60))
+    # Stored payment callbacks are applied in batches at least this often
+    MPESA_CALLBACK_APPLY_SECONDS = float(os.getenv('MPESA_CALLBACK_APPLY_SECONDS', 5))
+    MPESA_CALLBACK_BATCH = int(os.getenv('MPESA_CALLBACK_BATCH', 100))
+    # How long a callback waits for its payment's CheckoutRequestID to be recorded
+    MPESA_CALLBACK_MATCH_SECONDS = int(os.getenv('MPESA_CALLBACK_MATCH_SECONDS', 600))
+    # Payments still pending after this long are checked with STK push queries
+    MPESA_RECONCILE_AFTER_SECONDS = int(os.getenv('MPESA_RECONCILE_AFTER_SECONDS', 120))
+    MPESA_RECONCILE_BATCH = int(os.getenv('MPESA_RECONCILE_BATCH', 100))
+    # Queries in flight at once; keep within MPESA_POOL_SIZE
+    MPESA_RECONCILE_CONCURRENCY = int(os.getenv('MPESA_RECONCILE_CONCURRENCY', 4))
     
     # Email configuration
     MAIL_SERVER = os.getenv('MAIL_SERVER')
@@ -0,0 +1,121 @@
+"""Write-behind download counters.
+
+Downloads are added up in memory and written as batched
+``UPDATE ... SET x = x + n`` statements from a background thread, on an
+interval, as soon as DOWNLOAD_COUNTER_BATCH downloads are buffered, and
+when the worker exits, instead of a commit per request.
+"""
+from collections import Counter
+from sqlalchemy import bindparam, func
+from . import db
+from .models import DownloadToken, Firmware
+import atexit
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+class DownloadCounter:
+    """Buffer download counts per worker and flush them in batches"""
+    
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.tokens = Counter()
+        self.firmwares = Counter()
+        self.pending = 0
+        self.pid = None
+        self.thread = None
+        self.stopping = False
+        self.wakeup = threading.Event()
+    
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['DOWNLOAD_COUNTER_FLUSH_SECONDS']
+        self.batch = app.config['DOWNLOAD_COUNTER_BATCH']
+        atexit.register(self.stop)
+    
+    def record(self, token_id, firmware_id):
+        """Count one download of a firmware through a token"""
+        with self.lock:
+            if token_id is not None:
+                self.tokens[token_id] += 1
+            self.firmwares[firmware_id] += 1
+            self.pending += 1
+            full = self.pending >= self.batch
+        self.start()
+        if full:
+            self.wakeup.set()
+    
+    def start(self):
+        """Start the flush thread in this process if it is not running"""
+        # Threads do not survive gunicorn's fork, so track the owning pid
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name='download-counter', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Wake the flush thread for a last flush and wait for it"""
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(timeout=10)
+        # Anything counted after the thread's last flush, or without a thread
+        self.flush()
+    
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+    
+    def flush(self):
+        """Write buffered counts to the database"""
+        with self.lock:
+            tokens, self.tokens = self.tokens, Counter()
+            firmwares, self.firmwares = self.firmwares, Counter()
+            self.pending = 0
+        
+        if not tokens and not firmwares:
+            return
+        
+        with self.app.app_context():
+            try:
+                # One executemany per table, each row incremented atomically
+                if tokens:
+                    table = DownloadToken.__table__
+                    db.session.execute(
+                        table.update()
+                        .where(table.c.id == bindparam('row_id'))
+                        .values(download_count=func.coalesce(table.c.download_count, 0) + bindparam('hits')),
+                        [{'row_id': id, 'hits': hits} for id, hits in tokens.items()]
+                    )
+                if firmwares:
+                    table = Firmware.__table__
+                    db.session.execute(
+                        table.update()
+                        .where(table.c.id == bindparam('row_id'))
+                        # Counts are not edits: keep updated_at, which page ETags are built from
+                        .values(downloads=func.coalesce(table.c.downloads, 0) + bindparam('hits'),
+                                updated_at=table.c.updated_at),
+                        [{'row_id': id, 'hits': hits} for id, hits in firmwares.items()]
+                    )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error flushing download counters: {str(e)}")
+                # Keep the counts for the next attempt
+                with self.lock:
+                    self.tokens.update(tokens)
+                    self.firmwares.update(firmwares)
+                    self.pending += sum(firmwares.values())
+            finally:
+                db.session.remove()
+
+download_counter = DownloadCounter()
@@ -0,0 +1,304 @@
+"""Safaricom Daraja (M-Pesa) API access.
+
+Every Daraja call goes through DarajaClient, which keeps a pooled
+keep-alive session per worker thread, retries idempotent calls with
+jittered exponential backoff, records a latency histogram per call in
+the shared counters and fails fast through a circuit breaker while
+Daraja keeps failing. daraja_standin.py serves the same API locally.
+
+OAuth access tokens are valid for about an hour, so one token is shared
+by every worker on this host through the shared store and refreshed
+shortly before it expires. Refreshes are single-flight: one worker calls
+oauth/v1/generate while the others keep using the current token, or wait
+for the new one if there is none.
+"""
+from datetime import datetime
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .shared import shared
+import base64
+import logging
+import os
+import random
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY = 'mpesa-token'
+BREAKER_KEY = 'mpesa-breaker'
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Answers that mean Daraja is overloaded or failing, not that the call was wrong
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Sent with a 500 by STK push query while the customer has not answered yet
+PENDING_ERROR = '500.001.1001'
+
+class DarajaError(Exception):
+    """A Daraja call failed; `status` and `data` hold its answer, if any
+    
+    `sent` is true when the request may have reached Daraja without an
+    answer coming back, so whether it took effect is unknown.
+    """
+    
+    def __init__(self, message, status=None, data=None, sent=False):
+        super().__init__(message)
+        self.status = status
+        self.data = data or {}
+        self.sent = sent
+
+class CircuitOpen(DarajaError):
+    """Daraja is failing, so calls are not being made"""
+
+def request_sent(error):
+    """Return whether a failed request may have reached Daraja"""
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    # Refused connections show up as a NewConnectionError inside the ConnectionError
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, NewConnectionError)
+
+def stk_password(timestamp):
+    """Return the STK push password, base64(shortcode + passkey + timestamp)"""
+    config = current_app.config
+    raw = f"{config['MPESA_SHORTCODE']}{config['MPESA_PASSKEY']}{timestamp}"
+    return base64.b64encode(raw.encode('utf-8')).decode('ascii')
+
+class TokenCache:
+    """The Daraja OAuth token, shared by the workers of this host"""
+    
+    def __init__(self):
+        # This worker's copy, so most calls do not read the shared store
+        self.local = None
+    
+    def get(self):
+        """Return a valid access token, or None if one cannot be had"""
+        now = time.time()
+        cached = self.local
+        if cached is None or cached['refresh_at'] <= now:
+            cached = shared.get(TOKEN_KEY)
+            self.local = cached
+        
+        if cached is not None and cached['refresh_at'] > now:
+            shared.incr('mpesa.token.hit')
+            return cached['token']
+        
+        if cached is not None and cached['expires_at'] > now:
+            # Expiring soon: one worker refreshes, the rest carry on with it
+            lock = shared.lock('mpesa-token')
+            if not lock.acquire(blocking=False):
+                shared.incr('mpesa.token.hit')
+                return cached['token']
+            try:
+                return self.refresh() or cached['token']
+            finally:
+                lock.release()
+        
+        with shared.lock('mpesa-token'):
+            # Another worker may have refreshed while this one waited
+            cached = shared.get(TOKEN_KEY)
+            if cached is not None and cached['refresh_at'] > time.time():
+                shared.incr('mpesa.token.hit')
+                self.local = cached
+                return cached['token']
+            shared.incr('mpesa.token.miss')
+            return self.refresh()
+    
+    def refresh(self):
+        """Fetch a new token and share it; call with the lock held"""
+        config = current_app.config
+        if not config['MPESA_CONSUMER_KEY'] or not config['MPESA_CONSUMER_SECRET']:
+            logger.error("M-Pesa credentials not configured")
+            return None
+        
+        started = time.time()
+        try:
+            data = daraja.call(
+                'token', 'GET', '/oauth/v1/generate', idempotent=True, authorized=False,
+                params={'grant_type': 'client_credentials'},
+                auth=(config['MPESA_CONSUMER_KEY'], config['MPESA_CONSUMER_SECRET'])
+            )
+            token = data['access_token']
+            # Daraja sends expires_in as a string of seconds
+            expires_in = int(data.get('expires_in') or 3599)
+        except Exception as e:
+            shared.incr('mpesa.token.refresh_errors')
+            logger.error(f"Error getting M-Pesa access token: {str(e)}")
+            return None
+        finally:
+            shared.incr('mpesa.token.refresh_seconds', time.time() - started)
+        
+        shared.incr('mpesa.token.refreshes')
+        # Short-lived tokens are refreshed halfway through their life
+        margin = min(config['MPESA_TOKEN_REFRESH_SECONDS'], expires_in / 2)
+        self.local = {
+            'token': token,
+            'expires_at': started + expires_in,
+            'refresh_at': started + expires_in - margin
+        }
+        shared.set(TOKEN_KEY, self.local, ttl=expires_in)
+        return token
+    
+    def invalidate(self):
+        """Forget the token, e.g. after Daraja rejected it"""
+        self.local = None
+        shared.delete(TOKEN_KEY)
+
+access_tokens = TokenCache()
+
+def observe(call, seconds, outcome):
+    """Add a call to its latency histogram and count its outcome"""
+    bucket = next((str(bound) for bound in LATENCY_BUCKETS if seconds <= bound), 'inf')
+    shared.incr(f'mpesa.latency.{call}.le_{bucket}')
+    shared.incr(f'mpesa.latency.{call}.count')
+    shared.incr(f'mpesa.latency.{call}.seconds', seconds)
+    shared.incr(f'mpesa.calls.{call}.{outcome}')
+
+class CircuitBreaker:
+    """Fail fast while Daraja is down, for every worker on this host
+    
+    After MPESA_BREAKER_FAILURES failed calls in a row the circuit opens
+    and calls fail at once for MPESA_BREAKER_SECONDS. Then a single trial
+    call is let through; it closes the circuit or opens it again.
+    """
+    
+    def before(self):
+        """Raise CircuitOpen if calls are blocked; returns the trial lock of a trial call"""
+        state = shared.get(BREAKER_KEY)
+        if state is None or state['open_until'] is None:
+            return None
+        if state['open_until'] > time.time():
+            shared.incr('mpesa.breaker.rejected')
+            raise CircuitOpen('M-Pesa is unavailable')
+        trial = shared.lock('mpesa-breaker-trial')
+        if not trial.acquire(blocking=False):
+            shared.incr('mpesa.breaker.rejected')
+            raise CircuitOpen('M-Pesa is unavailable')
+        return trial
+    
+    def success(self):
+        if shared.get(BREAKER_KEY) is not None:
+            shared.delete(BREAKER_KEY)
+    
+    def failure(self):
+        config = current_app.config
+        with shared.lock('mpesa-breaker'):
+            state = shared.get(BREAKER_KEY) or {'failures': 0, 'open_until': None}
+            state['failures'] += 1
+            # A failed trial opens the circuit again straight away
+            if state['open_until'] is not None or state['failures'] >= config['MPESA_BREAKER_FAILURES']:
+                state['open_until'] = time.time() + config['MPESA_BREAKER_SECONDS']
+                shared.incr('mpesa.breaker.opened')
+                logger.error(f"M-Pesa circuit opened after {state['failures']} failures")
+            shared.set(BREAKER_KEY, state)
+
+class DarajaClient:
+    """Pooled, retrying calls to the Daraja API"""
+    
+    def __init__(self):
+        self.local = threading.local()
+        self.breaker = CircuitBreaker()
+    
+    def session(self):
+        """Return this thread's pooled session, recreated after a fork"""
+        session = getattr(self.local, 'session', None)
+        if session is None or self.local.pid != os.getpid():
+            session = requests.Session()
+            # Retries are made by call(), which knows which calls are safe to repeat
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=current_app.config['MPESA_POOL_SIZE'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            self.local.pid = os.getpid()
+        return session
+    
+    def backoff(self, attempt):
+        """Sleep before a retry, with full jitter"""
+        config = current_app.config
+        time.sleep(random.uniform(0, min(config['MPESA_RETRY_MAX_DELAY'], config['MPESA_RETRY_DELAY'] * 2 ** attempt)))
+    
+    def call(self, name, method, path, idempotent=False, authorized=True, **kwargs):
+        """Make a Daraja call and return its JSON answer
+        
+        Idempotent calls are retried after timeouts, connection errors and
+        429/5xx answers. Other calls are only retried when no connection
+        could be made, so a payment prompt is never sent twice. Raises
+        DarajaError, or CircuitOpen while Daraja is failing.
+        """
+        config = current_app.config
+        attempts = 1 + config['MPESA_RETRIES']
+        attempt = 0
+        renewed = False
+        while True:
+            attempt += 1
+            headers = {}
+            # Before the breaker, so a trial call does not wait on its own token call
+            if authorized:
+                token = access_tokens.get()
+                if token is None:
+                    raise DarajaError('No M-Pesa access token')
+                headers['Authorization'] = f'Bearer {token}'
+            
+            trial = self.breaker.before()
+            try:
+                started = time.time()
+                try:
+                    response = self.session().request(
+                        method, config['MPESA_BASE_URL'] + path, headers=headers,
+                        timeout=(config['MPESA_CONNECT_TIMEOUT'], config['MPESA_TIMEOUT']), **kwargs
+                    )
+                except requests.RequestException as e:
+                    observe(name, time.time() - started, 'error')
+                    self.breaker.failure()
+                    sent = request_sent(e)
+                    if attempt < attempts and (idempotent or not sent):
+                        self.backoff(attempt)
+                        continue
+                    raise DarajaError(f'M-Pesa {name} failed: {str(e)}', sent=sent)
+                
+                observe(name, time.time() - started, response.status_code)
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = {}
+                if response.status_code in RETRY_STATUSES and data.get('errorCode') != PENDING_ERROR:
+                    self.breaker.failure()
+                    if idempotent and attempt < attempts:
+                        self.backoff(attempt)
+                        continue
+                else:
+                    self.breaker.success()
+                
+                if response.status_code == 401 and authorized and not renewed:
+                    # Revoked before it expired; nothing was done, so try once more
+                    access_tokens.invalidate()
+                    renewed = True
+                    attempts += 1
+                    continue
+                
+                if response.status_code >= 400:
+                    message = data.get('errorMessage') or response.text[:200]
+                    raise DarajaError(f'M-Pesa {name} failed with {response.status_code}: {message}',
+                                      response.status_code, data)
+                return data
+            finally:
+                if trial is not None:
+                    trial.release()
+    
+    def stk_push(self, payload):
+        """Send a payment prompt to a phone; not retried once sent"""
+        return self.call('stk_push', 'POST', '/mpesa/stkpush/v1/processrequest', json=payload)
+    
+    def stk_query(self, checkout_request_id):
+        """Ask for the outcome of an STK push"""
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        return self.call('stk_query', 'POST', '/mpesa/stkpushquery/v1/query', idempotent=True, json={
+            'BusinessShortCode': current_app.config['MPESA_SHORTCODE'],
+            'Password': stk_password(timestamp),
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id
+        })
+
+daraja = DarajaClient()
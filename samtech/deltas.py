@@ -0,0 +1,381 @@
+"""Binary delta updates between versions of the same firmware model.
+
+Versions of a model are firmware sharing a brand and name, in upload
+order. When a version is added, patches from the versions before it are
+scheduled as FirmwareDelta rows and built offline by build_deltas.py in
+a process pool. Patches are keyed by blob digests and stored under
+deltas/ in storage. A client that sends the SHA-256 of the file it
+holds in X-Delta-Base, and bought that version, is sent the patch
+instead of the full image.
+
+Patches are VCDIFF (xdelta3) when xdelta3 is installed, otherwise a
+simple block format that apply_delta.py understands. Its encoder runs
+in Python, so pairs larger than DELTA_BLOCKS_MAX_SIZE are skipped
+unless xdelta3 is available:
+
+    header  b'SDLT' 1 block_size:u32 target_size:u64 source:sha256 target:sha256
+    ops     b'C' offset:u64 length:u64   copy bytes from the source
+            b'I' length:u64 <zlib data>  insert literal bytes
+            b'E'                         end
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from itertools import accumulate
+from flask import current_app
+from sqlalchemy import or_, update
+from . import db
+from .models import Firmware, FirmwareBlob, FirmwareDelta
+from .blobs import CHUNK_SIZE, blob_key
+from .storage import storage
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'vcdiff': 'vcdiff', 'blocks': 'sdlt'}
+# Literal runs are compressed and written in pieces of at most this size
+LITERAL_RUN = 4 * 1024 * 1024
+# Rows stuck in 'building' this long are assumed to belong to a dead builder
+BUILD_TIMEOUT = timedelta(hours=6)
+
+def delta_key(delta):
+    """Return the path of a patch relative to the upload folder"""
+    target = delta.target_digest
+    name = f"{delta.source_digest}-{target}.{EXTENSIONS[delta.method]}"
+    return os.path.join('deltas', target[:2], target[2:4], name)
+
+def staging_path(delta):
+    """Return where a patch is built before it is moved into storage"""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp', 'deltas', os.path.basename(delta_key(delta)))
+
+def model_versions(firmware):
+    """Return the stored versions of a firmware's model, oldest first"""
+    return Firmware.query.filter(
+        Firmware.brand_id == firmware.brand_id,
+        Firmware.name == firmware.name,
+        Firmware.blob_digest.isnot(None)
+    ).order_by(Firmware.created_at, Firmware.id).all()
+
+def schedule_deltas(firmware):
+    """Queue patches to a firmware from its previous versions, and from it to the next one"""
+    if not firmware.blob_digest:
+        return 0
+    try:
+        versions = model_versions(firmware)
+        index = versions.index(firmware)
+        max_sources = current_app.config['DELTA_MAX_SOURCES']
+        
+        pairs = [(older.blob_digest, firmware.blob_digest)
+                 for older in versions[max(0, index - max_sources):index]]
+        if index + 1 < len(versions):
+            pairs.append((firmware.blob_digest, versions[index + 1].blob_digest))
+        
+        added = 0
+        for source, target in set(pairs):
+            if source == target:
+                continue
+            if FirmwareDelta.query.filter_by(source_digest=source, target_digest=target).first():
+                continue
+            db.session.add(FirmwareDelta(source_digest=source, target_digest=target))
+            added += 1
+        db.session.commit()
+        return added
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error scheduling deltas for firmware {firmware.id}: {str(e)}")
+        return 0
+
+def available_delta(source_digest, target_digest):
+    """Return a built patch between two blobs, or None"""
+    delta = FirmwareDelta.query.filter_by(
+        source_digest=source_digest,
+        target_digest=target_digest,
+        status='ready'
+    ).first()
+    if delta is None or not storage.exists(delta_key(delta)):
+        return None
+    return delta
+
+def delta_method():
+    tool = current_app.config['DELTA_TOOL']
+    if tool == 'auto':
+        return 'vcdiff' if shutil.which('xdelta3') else 'blocks'
+    return tool
+
+class BlockDeltaWriter:
+    """Write copy and insert operations, merging adjacent ones"""
+    
+    def __init__(self, out):
+        self.out = out
+        self.copy_offset = None
+        self.copy_length = 0
+        self.literal = bytearray()
+    
+    def copy(self, offset, length):
+        self.flush_literal()
+        if self.copy_offset is not None and self.copy_offset + self.copy_length == offset:
+            self.copy_length += length
+            return
+        self.flush_copy()
+        self.copy_offset = offset
+        self.copy_length = length
+    
+    def insert(self, data):
+        self.flush_copy()
+        self.literal += data
+        if len(self.literal) >= LITERAL_RUN:
+            self.flush_literal()
+    
+    def flush_copy(self):
+        if self.copy_offset is not None:
+            self.out.write(b'C' + struct.pack('<QQ', self.copy_offset, self.copy_length))
+            self.copy_offset = None
+            self.copy_length = 0
+    
+    def flush_literal(self):
+        if self.literal:
+            data = zlib.compress(bytes(self.literal), 6)
+            self.out.write(b'I' + struct.pack('<Q', len(data)) + data)
+            self.literal = bytearray()
+    
+    def close(self):
+        self.flush_copy()
+        self.flush_literal()
+        self.out.write(b'E')
+
+def weak_checksum(block):
+    """Return rsync's rolling checksum of a block as its two 16-bit halves"""
+    return sum(block) & 0xffff, sum(accumulate(block)) & 0xffff
+
+def map_file(f):
+    """Map a whole file read-only; empty files cannot be mapped"""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def write_block_delta(source_path, target_path, out, block_size, source_digest, target_digest):
+    """Write a block patch: source blocks found at any offset of the target are copied
+    
+    Aligned source blocks are indexed by rsync's rolling checksum, which
+    the target is scanned with one byte at a time, so content that moved
+    by a few bytes between versions still matches. A strong hash and a
+    byte comparison confirm each candidate.
+    """
+    index = {}
+    with open(source_path, 'rb') as src:
+        offset = 0
+        while True:
+            block = src.read(block_size)
+            if len(block) < block_size:
+                break
+            a, b = weak_checksum(block)
+            strong = hashlib.blake2b(block, digest_size=16).digest()
+            index.setdefault(a | b << 16, {}).setdefault(strong, offset)
+            offset += block_size
+    
+    out.write(b'SDLT' + struct.pack('<BIQ', 1, block_size, os.path.getsize(target_path)))
+    out.write(bytes.fromhex(source_digest) + bytes.fromhex(target_digest))
+    writer = BlockDeltaWriter(out)
+    with open(source_path, 'rb') as src_file, open(target_path, 'rb') as tgt_file:
+        src = map_file(src_file)
+        tgt = map_file(tgt_file)
+        size = len(tgt)
+        pos = literal_start = 0
+        checksum = None
+        while pos + block_size <= size:
+            if checksum is None:
+                a, b = checksum = weak_checksum(tgt[pos:pos + block_size])
+            
+            candidates = index.get(a | b << 16)
+            if candidates:
+                block = tgt[pos:pos + block_size]
+                offset = candidates.get(hashlib.blake2b(block, digest_size=16).digest())
+                # Compare the bytes so a hash collision can never corrupt a patch
+                if offset is not None and src[offset:offset + block_size] == block:
+                    if literal_start < pos:
+                        writer.insert(tgt[literal_start:pos])
+                    writer.copy(offset, block_size)
+                    pos = literal_start = pos + block_size
+                    checksum = None
+                    continue
+            
+            # No match here: roll the window on by one byte
+            if pos + block_size == size:
+                break
+            out_byte = tgt[pos]
+            a = (a - out_byte + tgt[pos + block_size]) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+            checksum = a, b
+            pos += 1
+            if pos - literal_start >= LITERAL_RUN:
+                writer.insert(tgt[literal_start:pos])
+                literal_start = pos
+        
+        if literal_start < size:
+            writer.insert(tgt[literal_start:])
+    writer.close()
+
+def check_vcdiff(source_path, patch_path, target_digest):
+    """Decode a VCDIFF patch and compare the result with the target"""
+    process = subprocess.Popen(
+        ['xdelta3', '-d', '-c', '-s', source_path, patch_path],
+        stdout=subprocess.PIPE
+    )
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+        sha256.update(chunk)
+    if process.wait() != 0 or sha256.hexdigest() != target_digest:
+        raise ValueError('xdelta3 patch does not reproduce the target')
+
+def generate_delta(job):
+    """Build one patch file; runs in a pool process without the app"""
+    tmp_path = job['path'] + '.part'
+    os.makedirs(os.path.dirname(job['path']), exist_ok=True)
+    try:
+        if job['method'] == 'vcdiff':
+            subprocess.run(
+                ['xdelta3', '-e', '-9', '-f', '-s', job['source_path'], job['target_path'], tmp_path],
+                check=True, capture_output=True
+            )
+            check_vcdiff(job['source_path'], tmp_path, job['target_digest'])
+        else:
+            with open(tmp_path, 'wb') as out:
+                write_block_delta(job['source_path'], job['target_path'], out, job['block_size'],
+                                  job['source_digest'], job['target_digest'])
+        
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        os.replace(tmp_path, job['path'])
+        return os.path.getsize(job['path']), sha256.hexdigest()
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def claim_deltas(limit):
+    """Mark up to `limit` pending patches as being built by this process"""
+    # Builders that died leave rows behind; give them back
+    db.session.execute(
+        update(FirmwareDelta)
+        .where(FirmwareDelta.status == 'building',
+               FirmwareDelta.started_at < datetime.utcnow() - BUILD_TIMEOUT)
+        .values(status='pending')
+    )
+    db.session.commit()
+    
+    claimed = []
+    for delta in FirmwareDelta.query.filter_by(status='pending').order_by(FirmwareDelta.id).limit(limit).all():
+        result = db.session.execute(
+            update(FirmwareDelta)
+            .where(FirmwareDelta.id == delta.id, FirmwareDelta.status == 'pending')
+            .values(status='building', started_at=datetime.utcnow())
+        )
+        db.session.commit()
+        if result.rowcount:
+            claimed.append(db.session.get(FirmwareDelta, delta.id))
+    return claimed
+
+def finish_delta(delta, status, size=None, sha256=None, error=None):
+    delta.status = status
+    delta.size = size
+    delta.sha256 = sha256
+    delta.error = error[:255] if error else None
+    delta.completed_at = datetime.utcnow()
+    db.session.commit()
+
+def build_pending_deltas(workers, limit=100):
+    """Build pending patches in a pool of processes; returns how many were handled"""
+    deltas = claim_deltas(limit)
+    if not deltas:
+        return 0
+    
+    method = delta_method()
+    max_ratio = current_app.config['DELTA_MAX_RATIO']
+    blocks_max_size = current_app.config['DELTA_BLOCKS_MAX_SIZE']
+    with ExitStack() as stack:
+        # Builders read local files; remote blobs are fetched once per batch
+        local_paths = {}
+        
+        def local_path(digest):
+            if digest not in local_paths:
+                local_paths[digest] = stack.enter_context(storage.local_copy(blob_key(digest)))
+            return local_paths[digest]
+        
+        jobs = {}
+        for delta in deltas:
+            source = db.session.get(FirmwareBlob, delta.source_digest)
+            target = db.session.get(FirmwareBlob, delta.target_digest)
+            if source is None or target is None:
+                finish_delta(delta, 'failed', error='Source or target blob is gone')
+                continue
+            if method == 'blocks' and max(source.size, target.size) > blocks_max_size:
+                finish_delta(delta, 'skipped', error='Too large for block patches; install xdelta3')
+                continue
+            delta.method = method
+            db.session.commit()
+            try:
+                jobs[delta.id] = {
+                    'method': method,
+                    'source_path': local_path(delta.source_digest),
+                    'target_path': local_path(delta.target_digest),
+                    'source_digest': delta.source_digest,
+                    'target_digest': delta.target_digest,
+                    'block_size': current_app.config['DELTA_BLOCK_SIZE'],
+                    'path': staging_path(delta),
+                    'target_size': target.size
+                }
+            except Exception as e:
+                logger.error(f"Error fetching blobs for delta {delta.id}: {str(e)}")
+                finish_delta(delta, 'failed', error=str(e))
+        
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(generate_delta, job): id for id, job in jobs.items()}
+            for future in as_completed(futures):
+                delta = db.session.get(FirmwareDelta, futures[future])
+                job = jobs[delta.id]
+                try:
+                    size, sha256 = future.result()
+                    # A patch that saves little is not worth serving
+                    if size > job['target_size'] * max_ratio:
+                        os.remove(job['path'])
+                        finish_delta(delta, 'skipped', size=size)
+                        continue
+                    storage.put_file(delta_key(delta), job['path'])
+                except Exception as e:
+                    logger.error(f"Error building delta {delta.id}: {str(e)}")
+                    if os.path.exists(job['path']):
+                        os.remove(job['path'])
+                    finish_delta(delta, 'failed', error=str(e))
+                    continue
+                finish_delta(delta, 'ready', size=size, sha256=sha256)
+    return len(deltas)
+
+def collect_deltas():
+    """Remove patches whose source or target blob was deleted"""
+    live = db.session.query(FirmwareBlob.digest)
+    stale = FirmwareDelta.query.filter(or_(
+        FirmwareDelta.source_digest.notin_(live),
+        FirmwareDelta.target_digest.notin_(live)
+    )).all()
+    for delta in stale:
+        if delta.method:
+            storage.delete(delta_key(delta))
+        db.session.delete(delta)
+    db.session.commit()
+    return len(stale)
+
+def schedule_all_deltas():
+    """Queue patches for every stored model series, e.g. after an upgrade"""
+    added = 0
+    for firmware in Firmware.query.filter(Firmware.blob_digest.isnot(None)).all():
+        added += schedule_deltas(firmware)
+    return added
@@ -0,0 +1,132 @@
+"""Device model codes, regions and build ids of firmware.
+
+Customers look firmware up by the codes of their device (model SM-A525F,
+CSC region KEN, build A525FXXU4CVJB) rather than by marketing names.
+The codes come from the admin form or, when left blank, are extracted
+from the firmware's name, version and file name at upload time. They are
+stored normalized to upper-case letters and digits in indexed columns,
+so an exact or prefix lookup is a single index range scan.
+"""
+from sqlalchemy import and_
+from . import db
+from .models import Firmware
+from .shared import shared
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Samsung model codes first, then other vendors' dashed codes (XT-2041);
+# file names separate words with underscores, so \b is not enough
+MODEL_PATTERNS = [
+    re.compile(r'(?<![A-Z0-9])(SM-[A-Z]\d{3,4}[A-Z0-9]{0,4})(?![A-Z0-9])'),
+    re.compile(r'(?<![A-Z0-9])([A-Z]{1,4}-[A-Z0-9]*\d[A-Z0-9]*)(?![A-Z0-9])')
+]
+# Samsung builds: model suffix, region, type, bootloader, year, month, build
+SAMSUNG_BUILD = re.compile(r'^([A-Z]\d{3,4}[A-Z0-9]{0,3}?)[A-Z]{2}[SUE][0-9A-Z][A-Z]{2,3}[0-9A-Z]$')
+# Anything else that mixes letters and digits, e.g. QP1A.190711.020
+GENERIC_BUILD = re.compile(r'^(?=.*\d)(?=.*[A-Z])[A-Z0-9.]{6,40}$')
+REGION = re.compile(r'^[A-Z]{3}$')
+MIN_PREFIX = 2
+
+def normalize_code(value):
+    """Reduce a code to upper-case letters and digits"""
+    return re.sub(r'[^A-Z0-9]', '', (value or '').upper()) or None
+
+def find_model(*texts):
+    for pattern in MODEL_PATTERNS:
+        for value in texts:
+            match = pattern.search((value or '').upper())
+            if match and len(match.group(1)) <= 32:
+                return match.group(1)
+    return None
+
+def find_build(version, filename):
+    """Prefer the version field, then a build token of the file name"""
+    candidates = [(version or '').strip().upper()]
+    stem = os.path.splitext(os.path.basename(filename or ''))[0]
+    candidates += re.split(r'[_\s]+', stem.upper())
+    for pattern in (SAMSUNG_BUILD, GENERIC_BUILD):
+        for token in candidates:
+            if pattern.match(token):
+                return token
+    return None
+
+def find_region(filename):
+    """Samsung packages end in their CSC region: <AP>_<CSC>_KEN.zip"""
+    stem = os.path.splitext(os.path.basename(filename or ''))[0]
+    tokens = stem.upper().split('_')
+    if len(tokens) >= 2 and REGION.match(tokens[-1]) and any(SAMSUNG_BUILD.match(t) for t in tokens[:-1]):
+        return tokens[-1]
+    return None
+
+def extract_device_codes(name, version, filename, description=None):
+    """Guess the model code, region and build id of a firmware"""
+    build_id = find_build(version, filename)
+    model_code = find_model(name, filename, description)
+    if model_code is None and build_id:
+        # Samsung builds start with the model code without its SM- prefix
+        match = SAMSUNG_BUILD.match(build_id)
+        if match:
+            model_code = f'SM-{match.group(1)}'
+    return {
+        'model_code': model_code,
+        'region': find_region(filename),
+        'build_id': build_id
+    }
+
+def set_device_codes(firmware, data=None):
+    """Fill a firmware's device codes from form data, extracting blank ones"""
+    data = data or {}
+    found = extract_device_codes(firmware.name, firmware.version, firmware.original_filename,
+                                 firmware.description)
+    model_code = str(data.get('model_code') or '').strip().upper() or found['model_code']
+    firmware.model_code = model_code[:32] if model_code else None
+    firmware.model_key = normalize_code(model_code)
+    firmware.region = (normalize_code(data.get('region')) or found['region'] or '')[:8] or None
+    firmware.build_id = (normalize_code(data.get('build_id')) or normalize_code(found['build_id']) or '')[:64] or None
+
+def prefix_filter(column, prefix):
+    """Match a prefix with a condition a B-tree index can answer"""
+    if db.engine.dialect.name == 'postgresql':
+        # Served by the text_pattern_ops indexes
+        return column.like(prefix + '%')
+    # Keys are upper-case letters and digits, so everything starting with
+    # the prefix sorts before the prefix with its last character bumped
+    return and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+def lookup_firmware(model=None, region=None, build=None, prefix=False, limit=50):
+    """Find firmware by device codes; returns None if no usable code was given"""
+    model = normalize_code(model)
+    region = normalize_code(region)
+    build = normalize_code(build)
+    if not (model or region or build):
+        return None
+    if prefix and any(code and len(code) < MIN_PREFIX for code in (model, build)):
+        return None
+    
+    query = Firmware.query
+    for column, code in ((Firmware.model_key, model), (Firmware.build_id, build)):
+        if code:
+            query = query.filter(prefix_filter(column, code) if prefix else column == code)
+    if region:
+        query = query.filter(Firmware.region == region)
+    return query.order_by(Firmware.created_at.desc(), Firmware.id.desc()).limit(limit).all()
+
+def backfill_device_codes(batch_size=500):
+    """Extract device codes for the next batch of firmware; returns rows scanned
+    
+    Only rows without any code are filled in. Progress is kept in the
+    shared store, so an interrupted backfill carries on where it stopped.
+    """
+    checkpoint = 'device-codes-backfill'
+    last_id = shared.get(checkpoint, 0)
+    firmwares = Firmware.query.filter(Firmware.id > last_id).order_by(Firmware.id).limit(batch_size).all()
+    for firmware in firmwares:
+        if not (firmware.model_key or firmware.region or firmware.build_id):
+            set_device_codes(firmware)
+    db.session.commit()
+    if firmwares:
+        shared.set(checkpoint, firmwares[-1].id)
+    return len(firmwares)
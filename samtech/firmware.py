@@ -1,22 +1,390 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, send_file
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, abort
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import Forbidden, RequestedRangeNotSatisfiable
+from werkzeug.utils import secure_filename, send_file
+from werkzeug.wsgi import FileWrapper
+from collections import namedtuple
 from datetime import datetime, timedelta
+from urllib.parse import quote
 from . import db
 from .models import Firmware, Brand, Payment, DownloadToken
+from .counters import download_counter
+from .admission import admit, queue_position
+from .shaping import shape_response
+from .tokens import issue_token, verify_token, revocations, timestamp
+from .bundles import ChecksumPending, build_bundle
+from .blobs import CHUNK_SIZE
+from .deltas import EXTENSIONS, available_delta, delta_key
+from .shared import shared
+from .storage import storage
+from .manifests import firmware_manifest
+from .search import search_index
+from .devices import MIN_PREFIX, lookup_firmware, normalize_code
+from .versions import latest_builds
+from .pagination import paginate, page_size
+from .pagecache import cached_page, page_tags
+from .conditional import conditional_page, firmware_version
+import mimetypes
 import os
 import uuid
 
 firmware = Blueprint('firmware', __name__)
 
+def firmware_etag(firmware, stat):
+    """Build a strong ETag for a stored firmware file"""
+    # Content-addressed files are identified by their digest
+    if firmware.blob_digest:
+        return firmware.blob_digest
+    # Size and nanosecond mtime change whenever the file is replaced, and
+    # are identical across workers so resumed segments validate anywhere
+    return f"fw{firmware.id}-{stat.size:x}-{stat.mtime_ns:x}"
+
+def firmware_download_name(firmware):
+    """Return the file name offered to the user for a firmware file"""
+    return secure_filename(firmware.original_filename or os.path.basename(firmware.filename))
+
+def is_first_segment(byte_range):
+    """Check whether a request starts reading at byte zero"""
+    if byte_range is None:
+        return True
+    start, _ = byte_range.ranges[0]
+    return start == 0
+
+def requested_bytes(size):
+    """Return how many bytes the current request asks for"""
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) > 1:
+        return size
+    span = byte_range.range_for_length(size)
+    return span[1] - span[0] if span else size
+
+def counts_as_download(response):
+    """Check whether a download response delivers the file from its start"""
+    if 'X-Accel-Redirect' in response.headers or response.status_code == 302:
+        # The proxy or storage answers the Range header itself, so only the
+        # request is known
+        return is_first_segment(request.range)
+    return response.status_code == 200 or (
+        response.status_code == 206 and is_first_segment(request.range))
+
+def accel_redirect_response(key, download_name):
+    """Let the front proxy stream a stored file via X-Accel-Redirect"""
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    
+    # nginx keeps these headers and serves the internal location itself,
+    # including Range, If-Range and conditional requests
+    response = current_app.response_class(mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.headers['Cache-Control'] = 'private, no-transform'
+    prefix = current_app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/')
+    response.headers['X-Accel-Redirect'] = f"{prefix}/{quote(key)}"
+    if current_app.config['DOWNLOAD_RATE_PER_STREAM']:
+        response.headers['X-Accel-Limit-Rate'] = str(current_app.config['DOWNLOAD_RATE_PER_STREAM'])
+    return response
+
+def apply_multirange_policy(size):
+    """Handle a request for several byte ranges at once"""
+    # Download managers resume and split files with Range requests.
+    # Werkzeug serves single ranges, so apply our policy to multi-range
+    # requests before they reach it.
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) > 1:
+        if current_app.config['DOWNLOAD_MULTIRANGE_POLICY'] == 'reject':
+            raise RequestedRangeNotSatisfiable(length=size)
+        request.environ.pop('HTTP_RANGE', None)
+
+def serve_mode():
+    """Return how downloads are served with the configured storage"""
+    mode = current_app.config['DOWNLOAD_SERVE_MODE']
+    # Front proxies only see local files, and only S3 presigns URLs
+    if mode in ('accel', 'sendfile') and not storage.is_local:
+        return 'direct'
+    if mode == 'redirect' and not storage.presigns:
+        return 'direct'
+    return mode
+
+def send_seekable(file, size, download_name, etag, last_modified):
+    """Stream a seekable file object honouring Range and If-Range headers"""
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    response = current_app.response_class(
+        FileWrapper(file, CHUNK_SIZE),
+        mimetype=mimetype,
+        direct_passthrough=True
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.content_length = size
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = 'private, no-transform'
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        raise
+
+def send_stored_file(key, download_name, etag):
+    """Send a file from storage honouring Range and If-Range headers
+    
+    `etag` is called with the file's stat result.
+    """
+    mode = serve_mode()
+    if mode == 'accel':
+        return accel_redirect_response(key, download_name)
+    if mode == 'redirect':
+        # The client fetches the bytes, ranges included, from storage
+        url = storage.presigned_url(key, current_app.config['DOWNLOAD_PRESIGN_SECONDS'], download_name)
+        response = redirect(url)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    
+    stat = storage.stat(key)
+    apply_multirange_policy(stat.size)
+    
+    if not storage.is_local:
+        return send_seekable(storage.open(key), stat.size, download_name, etag(stat), stat.mtime)
+    
+    response = send_file(
+        storage.path(key),
+        request.environ,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=etag(stat),
+        last_modified=stat.mtime,
+        use_x_sendfile=(mode == 'sendfile'),
+        response_class=current_app.response_class
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    # Proxies must not recompress, otherwise byte offsets stop matching
+    response.headers['Cache-Control'] = 'private, no-transform'
+    return response
+
+def send_firmware_file(firmware, delta=None):
+    """Send a firmware file, or the patch to it from a version the client holds"""
+    download_name = firmware_download_name(firmware)
+    if delta is None:
+        response = send_stored_file(firmware.filename, download_name,
+                                    lambda stat: firmware_etag(firmware, stat))
+    else:
+        response = send_stored_file(delta_key(delta),
+                                    f"{download_name}.{delta.source_digest[:12]}.{EXTENSIONS[delta.method]}",
+                                    lambda stat: f"delta-{delta.sha256}")
+        response.headers['X-Delta-Base'] = delta.source_digest
+        response.headers['X-Delta-Target'] = delta.target_digest
+        response.headers['X-Delta-Format'] = delta.method
+    # Whether a patch is sent depends on X-Delta-Base
+    response.vary.add('X-Delta-Base')
+    return response
+
+def requested_delta(firmware, user_id):
+    """Return the patch for a client that holds a previous version, if built"""
+    base = (request.headers.get('X-Delta-Base') or request.args.get('base') or '').strip().lower()
+    if not base or not firmware.blob_digest or base == firmware.blob_digest or user_id is None:
+        return None
+    
+    # Knowing a digest is not proof of holding the file; the user must
+    # have bought a version of this model stored with that content
+    owned = db.session.query(Payment.id).join(Firmware, Payment.firmware_id == Firmware.id).filter(
+        Payment.user_id == user_id,
+        Payment.status == 'completed',
+        Firmware.blob_digest == base,
+        Firmware.brand_id == firmware.brand_id,
+        Firmware.name == firmware.name
+    ).first()
+    if owned is None:
+        return None
+    return available_delta(base, firmware.blob_digest)
+
+def busy_response(user_id, firmware_id, scope, firmware=None):
+    """Turn a download away while its stream limits are reached"""
+    retry_after = current_app.config['DOWNLOAD_RETRY_AFTER_SECONDS']
+    
+    # Browsers get a page that retries by itself; download managers and
+    # resumed segments get a plain 503 to retry later
+    if firmware and request.accept_mimetypes.accept_html and 'Range' not in request.headers:
+        body = render_template('firmware/queued.html',
+                               firmware=firmware,
+                               position=queue_position(user_id, firmware_id, scope),
+                               retry_after=retry_after)
+    else:
+        body = 'Too many downloads in progress, please retry later.'
+    response = current_app.make_response((body, 503))
+    response.headers['Retry-After'] = str(retry_after)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Fields /firmware/catalog and /firmware/latest can return, by name
+CATALOG_FIELDS = {
+    'id': lambda firmware: firmware.id,
+    'name': lambda firmware: firmware.name,
+    'version': lambda firmware: firmware.version,
+    'description': lambda firmware: firmware.description,
+    'features': lambda firmware: firmware.features,
+    'brand_id': lambda firmware: firmware.brand_id,
+    'brand': lambda firmware: firmware.brand.name,
+    'model_code': lambda firmware: firmware.model_code,
+    'region': lambda firmware: firmware.region,
+    'build_id': lambda firmware: firmware.build_id,
+    'price': lambda firmware: firmware.price,
+    'size': lambda firmware: firmware.size,
+    'created_at': lambda firmware: firmware.created_at.isoformat() if firmware.created_at else None,
+    'url': lambda firmware: url_for('firmware.view', id=firmware.id)
+}
+DEFAULT_FIELDS = ['id', 'name', 'version', 'brand', 'model_code', 'region', 'build_id', 'price', 'url']
+
+def catalog_fields():
+    """Return the fields asked for with ?fields=a,b or the defaults; None if one is unknown"""
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    if any(field not in CATALOG_FIELDS for field in fields):
+        return None
+    return fields or DEFAULT_FIELDS
+
+def catalog_response(page, fields):
+    return jsonify({
+        'status': 'success',
+        'data': {
+            'per_page': page.per_page,
+            'next': page.next_cursor,
+            'prev': page.prev_cursor,
+            'results': [{field: CATALOG_FIELDS[field](firmware) for field in fields} for firmware in page.items]
+        }
+    })
+
 @firmware.route('/')
+@cached_page
 def index():
-    """List all firmwares"""
+    """List firmwares, newest first, optionally of one brand"""
+    page_tags('brands', 'firmware-list')
     brands = Brand.query.all()
-    firmwares = Firmware.query.filter_by(is_active=True).all()
-    return render_template('firmware/index.html', brands=brands, firmwares=firmwares)
+    brand_id = request.args.get('brand', type=int)
+    query = Firmware.query
+    if brand_id:
+        query = query.filter_by(brand_id=brand_id)
+    try:
+        page = paginate(query, [Firmware.created_at, Firmware.id], after=request.args.get('after'),
+                        before=request.args.get('before'), per_page=page_size())
+    except ValueError:
+        abort(400)
+    return render_template('firmware/index.html', brands=brands, firmwares=page.items, page=page,
+                           brand_id=brand_id)
+
+@firmware.route('/catalog')
+def catalog():
+    """The catalog as JSON, newest first, paged by cursor"""
+    fields = catalog_fields()
+    if fields is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Unknown field; choose from {", ".join(CATALOG_FIELDS)}.'
+        }), 400
+    
+    query = Firmware.query
+    brand_id = request.args.get('brand', type=int)
+    if brand_id:
+        query = query.filter_by(brand_id=brand_id)
+    if 'brand' in fields:
+        query = query.options(joinedload(Firmware.brand))
+    try:
+        page = paginate(query, [Firmware.created_at, Firmware.id], after=request.args.get('after'),
+                        before=request.args.get('before'), per_page=page_size())
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+    return catalog_response(page, fields)
+
+@firmware.route('/search')
+def search():
+    """Search the catalog by name, version, description, features and brand"""
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 50)
+    results = search_index.search(query, page, per_page)
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'query': query,
+                'page': results.page,
+                'per_page': results.per_page,
+                'total': results.total,
+                'pages': results.pages,
+                'results': [{
+                    'id': firmware.id,
+                    'name': firmware.name,
+                    'version': firmware.version,
+                    'brand': firmware.brand.name,
+                    'price': firmware.price,
+                    'url': url_for('firmware.view', id=firmware.id)
+                } for firmware in results.items]
+            }
+        })
+    
+    return render_template('firmware/search.html', query=query, results=results)
+
+@firmware.route('/lookup')
+def lookup():
+    """Find firmware by model code, region and build id, exactly or by prefix"""
+    prefix = request.args.get('match', 'exact') == 'prefix'
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 100)
+    firmwares = lookup_firmware(
+        model=request.args.get('model'),
+        region=request.args.get('region'),
+        build=request.args.get('build'),
+        prefix=prefix,
+        limit=limit
+    )
+    if firmwares is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Give a model, region or build; prefixes need at least {MIN_PREFIX} characters.'
+        }), 400
+    
+    return jsonify({
+        'status': 'success',
+        'data': {
+            'match': 'prefix' if prefix else 'exact',
+            'results': [{
+                'id': firmware.id,
+                'name': firmware.name,
+                'version': firmware.version,
+                'brand': firmware.brand.name,
+                'model_code': firmware.model_code,
+                'region': firmware.region,
+                'build_id': firmware.build_id,
+                'price': firmware.price,
+                'url': url_for('firmware.view', id=firmware.id)
+            } for firmware in firmwares]
+        }
+    })
+
+@firmware.route('/latest')
+def latest():
+    """The newest build of each model, optionally of one brand, model or region"""
+    fields = catalog_fields()
+    if fields is None:
+        return jsonify({
+            'status': 'error',
+            'message': f'Unknown field; choose from {", ".join(CATALOG_FIELDS)}.'
+        }), 400
+    
+    region = request.args.get('region')
+    try:
+        page = latest_builds(
+            brand_id=request.args.get('brand', type=int),
+            series=normalize_code(request.args.get('model')),
+            region=(normalize_code(region) or '') if region is not None else None,
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=page_size()
+        )
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid cursor.'}), 400
+    return catalog_response(page, fields)
 
 @firmware.route('/<int:id>')
+@conditional_page(firmware_version)
 def view(id):
     """View firmware details"""
     firmware = Firmware.query.get_or_404(id)
@@ -37,7 +405,7 @@ def pay(id):
     
     if payment:
         return redirect(url_for('firmware.download', id=firmware.id))
-        
+    
     return render_template('payment/mpesa.html', firmware=firmware)
 
 @firmware.route('/<int:id>/download')
@@ -57,6 +425,31 @@ def download(id):
         flash('Please pay for the firmware first.', 'warning')
         return redirect(url_for('firmware.pay', id=firmware.id))
     
+    # Signed tokens are issued without touching the database
+    if current_app.config['DOWNLOAD_TOKEN_MODE'] == 'signed':
+        expires_at = datetime.utcnow() + timedelta(hours=current_app.config['DOWNLOAD_TOKEN_HOURS'])
+        audit_id = None
+        if current_app.config['DOWNLOAD_TOKEN_AUDIT']:
+            audit_id = str(uuid.uuid4())
+            db.session.add(DownloadToken(
+                token=audit_id,
+                user_id=current_user.id,
+                firmware_id=firmware.id,
+                expires_at=expires_at
+            ))
+            db.session.commit()
+        token = issue_token(
+            firmware.id,
+            current_user.id,
+            expires_at,
+            byte_budget=current_app.config['DOWNLOAD_TOKEN_BYTE_BUDGET'],
+            audit_id=audit_id
+        )
+        return render_template('firmware/download.html',
+                             firmware=firmware,
+                             token=token,
+                             expires_at=expires_at)
+    
     # Generate or get existing download token
     token = DownloadToken.query.filter_by(
         user_id=current_user.id,
@@ -67,7 +460,7 @@ def download(id):
         # Create new token
         if token:
             db.session.delete(token)
-            
+        
         token = DownloadToken(
             token=str(uuid.uuid4()),
             user_id=current_user.id,
@@ -79,37 +472,206 @@ def download(id):
     
     return render_template('firmware/download.html', 
                          firmware=firmware, 
-                         token=token,
+                         token=token.token,
                          expires_at=token.expires_at)
 
-@firmware.route('/<int:id>/download/<token>')
-def download_file(id, token):
-    """Download firmware file"""
-    firmware = Firmware.query.get_or_404(id)
+DownloadGrant = namedtuple('DownloadGrant', ['firmware', 'token_id', 'byte_budget', 'user_id'])
+
+def check_download_token(id, token):
+    """Verify a download token for a firmware; returns a DownloadGrant or None"""
+    if current_app.config['DOWNLOAD_TOKEN_MODE'] == 'signed':
+        claims = verify_token(token, id)
+        if not claims:
+            return None
+        return DownloadGrant(Firmware.query.get_or_404(id), None, claims.get('b'), claims.get('u'))
     
-    # Verify token
+    firmware = Firmware.query.get_or_404(id)
     token = DownloadToken.query.filter_by(
         token=token,
         firmware_id=firmware.id
     ).first()
-    
     if not token or token.expires_at < datetime.utcnow():
+        return None
+    return DownloadGrant(firmware, token.id, None, token.user_id)
+
+@firmware.route('/<int:id>/download/<token>')
+def download_file(id, token):
+    """Download firmware file"""
+    # Verify token
+    grant = check_download_token(id, token)
+    if grant is None:
         flash('Invalid or expired download token.', 'error')
-        return redirect(url_for('firmware.view', id=firmware.id))
-    
-    # Get file path
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], firmware.filename)
+        return redirect(url_for('firmware.view', id=id))
+    firmware, token_id, byte_budget, user_id = grant
     
-    if not os.path.exists(file_path):
+    # Check the file is still stored
+    stat = storage.stat(firmware.filename)
+    if stat is None:
         flash('Firmware file not found.', 'error')
         return redirect(url_for('firmware.view', id=firmware.id))
     
-    # Increment download count
-    token.download_count += 1
-    db.session.commit()
+    # Clients holding an earlier version of the model they bought get a patch
+    delta = requested_delta(firmware, user_id)
     
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=secure_filename(firmware.filename)
-    )
+    # A byte budget bounds how much a single request may fetch
+    size = delta.size if delta else firmware.size or stat.size
+    if byte_budget and requested_bytes(size) > byte_budget:
+        raise Forbidden('This download link does not allow fetching that much data at once.')
+    
+    # Streams served by the workers themselves hold an admission slot and
+    # are paced to the bandwidth caps
+    streamed = request.method == 'GET' and serve_mode() == 'direct'
+    ticket = None
+    if streamed:
+        ticket, scope = admit(user_id, firmware.id)
+        if ticket is None:
+            return busy_response(user_id, firmware.id, scope, firmware)
+    
+    try:
+        response = send_firmware_file(firmware, delta)
+    except Exception:
+        if ticket:
+            ticket.release()
+        raise
+    if streamed:
+        shape_response(response)
+    if ticket:
+        ticket.hold(response)
+    
+    # Count a download once, not for every resumed or parallel segment
+    if request.method == 'GET' and counts_as_download(response):
+        download_counter.record(token_id, firmware.id)
+        if delta:
+            shared.incr('deltas.served')
+            shared.incr('deltas.bytes_saved', (firmware.size or 0) - delta.size)
+    
+    return response
+
+@firmware.route('/<int:id>/manifest/<token>')
+def manifest(id, token):
+    """Chunk checksums of a firmware file, for verifying segmented downloads"""
+    grant = check_download_token(id, token)
+    if grant is None:
+        return jsonify({'status': 'error', 'message': 'Invalid or expired download token.'}), 403
+    firmware = grant.firmware
+    
+    stat = storage.stat(firmware.filename)
+    if stat is None:
+        return jsonify({'status': 'error', 'message': 'Firmware file not found.'}), 404
+    
+    try:
+        manifest = firmware_manifest(firmware, stat)
+    except Exception as e:
+        current_app.logger.error(f"Error loading manifest for firmware {firmware.id}: {str(e)}")
+        manifest = None
+    if manifest is None:
+        # Older files are hashed offline; a request never reads a whole file
+        response = jsonify({'status': 'error', 'message': 'Manifest is not available yet.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '3600'
+        return response
+    
+    digests = manifest['chunk_digests']
+    response = jsonify({
+        'status': 'success',
+        'data': {
+            'firmware_id': firmware.id,
+            'size': stat.size,
+            'sha256': manifest['sha256'],
+            'algorithm': 'sha256',
+            'chunk_size': manifest['chunk_size'],
+            'chunk_count': len(digests) // 32,
+            # SHA-256 of the chunk digests, concatenated in order
+            'root': manifest['root'],
+            'chunks': [digests[i:i + 32].hex() for i in range(0, len(digests), 32)]
+        }
+    })
+    response.set_etag(f"manifest-{manifest['root']}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def bundle_firmware_ids():
+    """Read the firmware ids of a bundle from ?ids=1,2&ids=3"""
+    ids = []
+    for value in request.args.getlist('ids'):
+        for part in value.split(','):
+            if part.strip().isdigit() and int(part) not in ids:
+                ids.append(int(part))
+    return ids
+
+@firmware.route('/bundle')
+@login_required
+def bundle():
+    """Download several purchased firmware files as one ZIP"""
+    ids = bundle_firmware_ids()
+    max_files = current_app.config['DOWNLOAD_BUNDLE_MAX_FILES']
+    if not ids or len(ids) > max_files:
+        flash(f'Choose between 1 and {max_files} firmware files to bundle.', 'error')
+        return redirect(url_for('firmware.index'))
+    
+    # Only purchases that were not revoked since they were paid
+    payments = Payment.query.filter(
+        Payment.user_id == current_user.id,
+        Payment.firmware_id.in_(ids),
+        Payment.status == 'completed'
+    ).all()
+    purchased = {
+        payment.firmware_id for payment in payments
+        if not revocations.is_revoked(current_user.id, payment.firmware_id,
+                                      timestamp(payment.completed_at or payment.created_at))
+    }
+    
+    firmwares = []
+    for firmware in Firmware.query.filter(Firmware.id.in_(purchased)).order_by(Firmware.id).all():
+        if storage.exists(firmware.filename):
+            firmwares.append(firmware)
+        else:
+            current_app.logger.error(f"Firmware file missing for bundle: {firmware.filename}")
+    
+    if not firmwares:
+        flash('None of the selected firmware is available for download.', 'error')
+        return redirect(url_for('firmware.index'))
+    
+    # Bundles are always built and streamed by the worker
+    ticket = None
+    if request.method == 'GET':
+        ticket, scope = admit(current_user.id, 'bundle')
+        if ticket is None:
+            return busy_response(current_user.id, 'bundle', scope)
+    
+    try:
+        archive, etag, last_modified = build_bundle(firmwares)
+    except ChecksumPending as e:
+        if ticket:
+            ticket.release()
+        # Older files are hashed offline; a request never reads a whole file
+        current_app.logger.warning(f"Bundle not ready: {str(e)}")
+        response = current_app.make_response(('This bundle is not ready yet, please retry later.', 503))
+        response.headers['Retry-After'] = '3600'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    except Exception:
+        if ticket:
+            ticket.release()
+        raise
+    
+    try:
+        apply_multirange_policy(archive.size)
+        response = send_seekable(archive, archive.size,
+                                 f'samtech-firmware-{len(firmwares)}-files.zip',
+                                 etag, last_modified)
+    except Exception:
+        archive.close()
+        if ticket:
+            ticket.release()
+        raise
+    if request.method == 'GET':
+        shape_response(response)
+    if ticket:
+        ticket.hold(response)
+    
+    if request.method == 'GET' and counts_as_download(response):
+        for firmware in firmwares:
+            download_counter.record(None, firmware.id)
+    
+    return response
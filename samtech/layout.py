@@ -0,0 +1,94 @@
+"""Hash-sharded layout for uploaded files.
+
+Files live two directory levels below their folder, in directories named
+after a hash of the file name (images/firmware/3f/a2/<uuid>_<name>), so
+no directory grows past a few hundred entries however large the catalog
+gets. Blobs and patches are already keyed this way by their digests.
+Files saved in the old flat layout are moved by migrate_layout.py.
+"""
+from flask import current_app
+from . import db
+from .models import Brand, Firmware
+from .shared import shared
+from .storage import storage
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Flat folders of the old layout, relative to where their paths point
+FIRMWARE_FOLDER = 'files'
+IMAGE_FOLDER = os.path.join('images', 'firmware')
+LOGO_FOLDER = os.path.join('images', 'brands')
+
+def sharded_path(folder, filename):
+    """Return folder/ab/cd/filename, with ab/cd taken from a hash of the name"""
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    return os.path.join(folder, digest[:2], digest[2:4], filename)
+
+def move_static(old_path, new_path):
+    """Move a file under the static folder; True once it is at the new path"""
+    static = current_app.static_folder
+    source = os.path.join(static, old_path)
+    target = os.path.join(static, new_path)
+    if os.path.exists(source):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        return True
+    # Moved by an earlier run that stopped before committing
+    return os.path.exists(target)
+
+def move_stored(old_key, new_key):
+    """Move a firmware file in storage; True once it is at the new key"""
+    if storage.exists(old_key):
+        storage.move(old_key, new_key)
+        return True
+    return storage.exists(new_key)
+
+# name -> (model, column, flat folder, new folder, mover)
+MIGRATIONS = {
+    'firmware-files': (Firmware, 'filename', '', FIRMWARE_FOLDER, move_stored),
+    'firmware-images': (Firmware, 'image', IMAGE_FOLDER, IMAGE_FOLDER, move_static),
+    'brand-logos': (Brand, 'logo', LOGO_FOLDER, LOGO_FOLDER, move_static)
+}
+
+def migrate_batch(name, batch_size):
+    """Move the next batch of rows of one migration to the sharded layout
+    
+    Returns (rows scanned, files moved, files missing). Progress is kept
+    in the shared store, and a row is only rewritten once its file is in
+    place, so an interrupted run can simply be started again.
+    """
+    model, column, flat_folder, folder, move = MIGRATIONS[name]
+    checkpoint = f'layout-migration:{name}'
+    last_id = shared.get(checkpoint, 0)
+    rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+    
+    moved = missing = 0
+    for row in rows:
+        path = getattr(row, column)
+        # Only files sitting directly in the flat folder are moved; blob
+        # keys and paths that are already sharded are left alone
+        if not path or os.path.dirname(path) != flat_folder:
+            continue
+        new_path = sharded_path(folder, os.path.basename(path))
+        try:
+            if move(path, new_path):
+                setattr(row, column, new_path)
+                moved += 1
+            else:
+                logger.warning(f"File missing, left as is: {name} {row.id} {path}")
+                missing += 1
+        except Exception as e:
+            logger.error(f"Error moving {path}: {str(e)}")
+            missing += 1
+    
+    db.session.commit()
+    if rows:
+        shared.set(checkpoint, rows[-1].id)
+    return len(rows), moved, missing
+
+def reset_migration(name):
+    """Start a migration over from the first row"""
+    shared.delete(f'layout-migration:{name}')
@@ -3,6 +3,10 @@ from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from . import db
 from .models import Firmware, Brand, Payment, DownloadToken, User
+from .versions import latest_builds
+from .pagination import paginate, page_size
+from .pagecache import cached_page, page_tags
+from .conditional import conditional_page, brand_version, firmware_version
 from datetime import datetime
 import os
 from sqlalchemy import func
@@ -25,19 +29,43 @@ def save_icon(icon_file):
     return icon_path
 
 @main.route('/')
+@cached_page
 def index():
+    page_tags('brands')
     brands = Brand.query.all()
     return render_template('index.html', brands=brands)
 
 @main.route('/brand/<int:brand_id>')
+@conditional_page(brand_version)
+@cached_page
 def brand(brand_id):
+    page_tags(f'brand:{brand_id}', f'brand-firmware:{brand_id}')
     brand = Brand.query.get_or_404(brand_id)
-    firmwares = Firmware.query.filter_by(brand_id=brand_id).all()
-    return render_template('brand.html', brand=brand, firmwares=firmwares)
+    # The newest build of each model by default, every build on request
+    view = request.args.get('view', 'latest')
+    after = request.args.get('after')
+    before = request.args.get('before')
+    per_page = page_size()
+    try:
+        page = None
+        if view == 'latest':
+            page = latest_builds(brand_id, after=after, before=before, per_page=per_page)
+        if page is None or not (page.items or after or before):
+            # Also covers catalogs whose versions were not backfilled yet
+            view = 'all'
+            page = paginate(Firmware.query.filter_by(brand_id=brand_id), [Firmware.created_at, Firmware.id],
+                            after=after, before=before, per_page=per_page)
+    except ValueError:
+        abort(400)
+    return render_template('brand.html', brand=brand, firmwares=page.items, page=page, view=view)
 
 @main.route('/firmware/<int:firmware_id>')
+@conditional_page(firmware_version)
+@cached_page
 def firmware(firmware_id):
+    page_tags(f'firmware:{firmware_id}')
     firmware = Firmware.query.get_or_404(firmware_id)
+    page_tags(f'brand:{firmware.brand_id}')
     return render_template('firmware.html', firmware=firmware)
 
 @main.route('/admin')
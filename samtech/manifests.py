@@ -0,0 +1,169 @@
+"""Chunk checksum manifests for firmware files.
+
+A file is split into fixed-size chunks (MANIFEST_CHUNK_SIZE, the last one
+may be shorter) and each chunk is hashed with SHA-256. The root digest
+is the SHA-256 of the chunk digests concatenated in order, so a client
+can check the manifest against one value and then verify, and re-fetch,
+each segment of a download on its own. Manifests are computed while an
+upload is hashed and stored with its blob; files stored before that are
+hashed offline by reindex_catalog.py --manifests, never in a request.
+The same pass records the file's CRC-32, which ZIP bundles need.
+"""
+from flask import current_app
+from . import db
+from .models import Firmware
+from .shared import shared
+from .storage import storage
+import hashlib
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+def manifest_root(chunk_digests):
+    """Return the root digest of a manifest's concatenated chunk digests"""
+    return hashlib.sha256(chunk_digests).hexdigest()
+
+class ContentHasher:
+    """Hash content in one pass: SHA-256, size, CRC-32 and chunk digests"""
+    
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or current_app.config['MANIFEST_CHUNK_SIZE']
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.crc32 = 0
+        self.chunks = []
+        self.chunk = hashlib.sha256()
+        self.chunk_filled = 0
+    
+    def update(self, data):
+        self.sha256.update(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
+        
+        # Reads rarely line up with chunk boundaries
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self.chunk_size - self.chunk_filled)
+            self.chunk.update(view[:length])
+            self.chunk_filled += length
+            view = view[length:]
+            if self.chunk_filled == self.chunk_size:
+                self.end_chunk()
+    
+    def end_chunk(self):
+        self.chunks.append(self.chunk.digest())
+        self.chunk = hashlib.sha256()
+        self.chunk_filled = 0
+    
+    @property
+    def digest(self):
+        return self.sha256.hexdigest()
+    
+    @property
+    def chunk_digests(self):
+        """Return the concatenated chunk digests, ending any partial chunk"""
+        if self.chunk_filled:
+            self.end_chunk()
+        return b''.join(self.chunks)
+    
+    def read(self, stream):
+        """Hash a stream to its end"""
+        for data in iter(lambda: stream.read(READ_SIZE), b''):
+            self.update(data)
+        return self
+
+def compute_manifest(key):
+    """Read a stored file and return its hasher"""
+    with storage.open(key) as f:
+        return ContentHasher().read(f)
+
+def legacy_manifest_key(firmware):
+    """Shared store key of a legacy firmware file's manifest"""
+    return f'manifest:fw{firmware.id}'
+
+def firmware_manifest(firmware, stat):
+    """Return a firmware file's recorded manifest, or None if there is none yet
+    
+    The manifest is a dict with the file's sha256, crc32, chunk_size, root
+    and chunk_digests (bytes, 32 per chunk). Nothing is hashed here: files
+    stored before manifests were recorded are filled in offline by
+    backfill_manifests.
+    """
+    blob = firmware.blob
+    if blob is not None:
+        if blob.chunk_digests is None:
+            return None
+        return {
+            'sha256': blob.digest,
+            'crc32': blob.crc32,
+            'chunk_size': blob.chunk_size,
+            'root': blob.manifest_root,
+            'chunk_digests': blob.chunk_digests
+        }
+    
+    # Legacy files keep theirs in the shared store, tied to the file's
+    # size and mtime so a replaced file is not checked against it
+    cached = shared.get(legacy_manifest_key(firmware))
+    if cached is None or cached.get('size') != stat.size or cached.get('mtime_ns') != stat.mtime_ns:
+        return None
+    return dict(cached, chunk_digests=bytes.fromhex(cached['chunk_digests']))
+
+def backfill_manifests(batch_size):
+    """Record manifests and CRC-32s for the next batch of firmware files
+    
+    Returns the number of rows scanned. Progress is kept in the shared
+    store, so an interrupted run carries on where it left off.
+    """
+    last_id = shared.get('manifest-backfill', 0)
+    rows = Firmware.query.filter(Firmware.id > last_id).order_by(Firmware.id).limit(batch_size).all()
+    
+    for firmware in rows:
+        try:
+            record_manifest(firmware)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error building manifest for firmware {firmware.id}: {str(e)}")
+    
+    if rows:
+        shared.set('manifest-backfill', rows[-1].id)
+    return len(rows)
+
+def record_manifest(firmware):
+    """Hash a firmware file and record its manifest and CRC-32 if either is missing"""
+    blob = firmware.blob
+    if blob is not None:
+        if blob.chunk_digests is None or blob.crc32 is None:
+            hasher = compute_manifest(firmware.filename)
+            if blob.chunk_digests is None:
+                set_manifest(blob, hasher)
+            if blob.crc32 is None:
+                blob.crc32 = hasher.crc32
+            db.session.commit()
+        return
+    
+    stat = storage.stat(firmware.filename) if firmware.filename else None
+    if stat is None:
+        return
+    # Manifests recorded before CRC-32s were kept are hashed again
+    manifest = firmware_manifest(firmware, stat)
+    if manifest is not None and manifest.get('crc32') is not None:
+        return
+    hasher = compute_manifest(firmware.filename)
+    shared.set(legacy_manifest_key(firmware), {
+        'sha256': hasher.digest,
+        'crc32': hasher.crc32,
+        'chunk_size': hasher.chunk_size,
+        'root': manifest_root(hasher.chunk_digests),
+        'chunk_digests': hasher.chunk_digests.hex(),
+        'size': stat.size,
+        'mtime_ns': stat.mtime_ns
+    })
+
+def set_manifest(blob, hasher):
+    """Record a hasher's manifest on a blob row"""
+    blob.chunk_size = hasher.chunk_size
+    blob.chunk_digests = hasher.chunk_digests
+    blob.manifest_root = manifest_root(blob.chunk_digests)
@@ -19,6 +19,14 @@ class DownloadToken(db.Model):
         self.user_id = user_id
         self.expires_at = expires_at
 
+class RevokedDownload(db.Model):
+    __tablename__ = 'revoked_downloads'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    firmware_id = db.Column(db.Integer, db.ForeignKey('firmwares.id'), nullable=False)
+    reason = db.Column(db.String(200), nullable=True)
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -61,36 +69,156 @@ class Brand(db.Model):
     # Relationships
     firmwares = db.relationship('Firmware', back_populates='brand', lazy=True)
 
+class FirmwareBlob(db.Model):
+    __tablename__ = 'firmware_blobs'
+    digest = db.Column(db.String(64), primary_key=True)  # SHA-256 of the content
+    size = db.Column(db.BigInteger, nullable=False)
+    crc32 = db.Column(db.BigInteger, nullable=True)  # Needed for ZIP bundles
+    # Checksum manifest: SHA-256 of each chunk_size piece, concatenated
+    chunk_size = db.Column(db.Integer, nullable=True)
+    chunk_digests = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    manifest_root = db.Column(db.String(64), nullable=True)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FirmwareBlob {self.digest[:12]} refs={self.ref_count}>'
+
+class FirmwareDelta(db.Model):
+    """A binary patch from one stored firmware file to another"""
+    __tablename__ = 'firmware_deltas'
+    __table_args__ = (db.UniqueConstraint('source_digest', 'target_digest'),)
+    id = db.Column(db.Integer, primary_key=True)
+    # Blob digests; deltas outlive firmware rows sharing the same content
+    source_digest = db.Column(db.String(64), nullable=False, index=True)
+    target_digest = db.Column(db.String(64), nullable=False, index=True)
+    method = db.Column(db.String(20))  # vcdiff, blocks
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, building, ready, skipped, failed
+    size = db.Column(db.BigInteger)
+    sha256 = db.Column(db.String(64))
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<FirmwareDelta {self.source_digest[:8]}->{self.target_digest[:8]} {self.status}>'
+
 class Firmware(db.Model):
     __tablename__ = 'firmwares'
+    __table_args__ = (
+        # Exact and prefix lookups by device code; PostgreSQL needs
+        # text_pattern_ops for LIKE 'prefix%' to use the index
+        db.Index('ix_firmwares_model_key_region', 'model_key', 'region',
+                 postgresql_ops={'model_key': 'text_pattern_ops'}),
+        db.Index('ix_firmwares_build_id', 'build_id',
+                 postgresql_ops={'build_id': 'text_pattern_ops'}),
+        # Newest build of a model, see versions.py
+        db.Index('ix_firmwares_series', 'brand_id', 'series', 'region', 'version_key'),
+        # Catalog pages, newest first, see pagination.py
+        db.Index('ix_firmwares_brand_created', 'brand_id', 'created_at', 'id'),
+        db.Index('ix_firmwares_created', 'created_at', 'id'),
+        # Conditional GET validators of brand pages, see conditional.py
+        db.Index('ix_firmwares_brand_updated', 'brand_id', 'updated_at', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     version = db.Column(db.String(50), nullable=False)
     description = db.Column(db.Text)
     features = db.Column(db.Text)
     filename = db.Column(db.String(255), nullable=False)
+    original_filename = db.Column(db.String(255))
+    blob_digest = db.Column(db.String(64), db.ForeignKey('firmware_blobs.digest'), index=True)
     image = db.Column(db.String(255))
-    size = db.Column(db.Integer)
+    size = db.Column(db.BigInteger)
     price = db.Column(db.Float, default=0.0)
     downloads = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     brand_id = db.Column(db.Integer, db.ForeignKey('brands.id'), nullable=False)
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Device codes, see devices.py; keys are upper-case letters and digits
+    model_code = db.Column(db.String(32))  # As printed, e.g. SM-A525F
+    model_key = db.Column(db.String(32))
+    region = db.Column(db.String(8), index=True)
+    build_id = db.Column(db.String(64))
+    # Sorts like the version string; series names the model it belongs to
+    version_key = db.Column(db.String(64))
+    series = db.Column(db.String(100))
     
-    brand = db.relationship('Brand', backref=db.backref('firmwares', lazy=True))
-    creator = db.relationship('User', backref=db.backref('firmwares', lazy=True))
+    # Brand.firmwares and User.firmwares (backref 'creator') define the other sides
+    brand = db.relationship('Brand', back_populates='firmwares')
+    blob = db.relationship('FirmwareBlob')
     
     def __repr__(self):
         return f'<Firmware {self.name} v{self.version}>'
 
+class LatestFirmware(db.Model):
+    """The newest build of each brand, model and region, kept by versions.py"""
+    __tablename__ = 'latest_firmware'
+    __table_args__ = (
+        db.UniqueConstraint('brand_id', 'series', 'region'),
+        # Brand pages read the firmware ids straight from the index
+        db.Index('ix_latest_firmware_brand', 'brand_id', 'series', 'region', 'firmware_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    brand_id = db.Column(db.Integer, db.ForeignKey('brands.id'), nullable=False)
+    series = db.Column(db.String(100), nullable=False)
+    region = db.Column(db.String(8), nullable=False, default='')
+    firmware_id = db.Column(db.Integer, db.ForeignKey('firmwares.id', ondelete='CASCADE'), nullable=False)
+    version_key = db.Column(db.String(64))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    firmware = db.relationship('Firmware')
+    
+    def __repr__(self):
+        return f'<LatestFirmware {self.series} {self.region} -> {self.firmware_id}>'
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String(36), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)  # expected digest, if known
+    status = db.Column(db.String(20), default='open')  # open, finalizing, complete
+    blob_digest = db.Column(db.String(64), nullable=True)
+    # Finalizing runs in the background; the client polls for the outcome
+    details = db.Column(db.Text, nullable=True)  # JSON firmware details sent to finalize
+    firmware_id = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    finalize_started_at = db.Column(db.DateTime, nullable=True)
+    creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    
+    chunks = db.relationship('UploadChunk', backref='session', lazy=True, cascade='all, delete-orphan')
+    
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+    
+    def chunk_length(self, index):
+        """Expected length of a chunk; the last one may be shorter"""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+class UploadChunk(db.Model):
+    __tablename__ = 'upload_chunks'
+    session_id = db.Column(db.String(36), db.ForeignKey('upload_sessions.id'), primary_key=True)
+    index = db.Column(db.Integer, primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Payment(db.Model):
     __tablename__ = 'payments'
+    # Reconciliation reads pending payments oldest first
+    __table_args__ = (db.Index('ix_payments_status_created', 'status', 'created_at'),)
     id = db.Column(db.Integer, primary_key=True)
     reference = db.Column(db.String(50), unique=True, nullable=False)
     amount = db.Column(db.Float, nullable=False)
     amount_paid = db.Column(db.Float, nullable=True)
-    status = db.Column(db.String(20), default='pending')  # pending, completed, failed
+    status = db.Column(db.String(20), default='pending')  # pending, sending, unconfirmed, completed, failed
     phone_number = db.Column(db.String(15), nullable=False)
     checkout_request_id = db.Column(db.String(50), unique=True, nullable=True)
     mpesa_receipt = db.Column(db.String(20), unique=True, nullable=True)
@@ -107,3 +235,15 @@ class Payment(db.Model):
         self.phone_number = phone_number
         self.firmware_id = firmware_id
         self.user_id = user_id
+
+class MpesaCallback(db.Model):
+    """An STK push result as Daraja posted it, applied to its payment in the background"""
+    __tablename__ = 'mpesa_callbacks'
+    __table_args__ = (db.Index('ix_mpesa_callbacks_applied', 'applied_at', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    # Daraja may post a result more than once; only the first is kept
+    checkout_request_id = db.Column(db.String(50), unique=True, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    applied_at = db.Column(db.DateTime, nullable=True)
+    outcome = db.Column(db.String(20), nullable=True)  # completed, failed, duplicate, unmatched
@@ -1,10 +1,11 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify
 from flask_login import current_user, login_required
-from datetime import datetime
 from . import db
-from .models import Payment
-import requests
-import json
+from .models import MpesaCallback, Payment
+from .daraja import access_tokens
+from .payments import payment_dispatcher, payment_reference, callback_applier, DispatchQueueFull
+from .shared import shared
+from sqlalchemy.exc import IntegrityError
 import logging
 
 mpesa = Blueprint('mpesa', __name__)
@@ -12,25 +13,7 @@ logger = logging.getLogger(__name__)
 
 def get_access_token():
     """Get M-Pesa access token"""
-    consumer_key = current_app.config.get('MPESA_CONSUMER_KEY')
-    consumer_secret = current_app.config.get('MPESA_CONSUMER_SECRET')
-    
-    if not consumer_key or not consumer_secret:
-        logger.error("M-Pesa credentials not configured")
-        return None
-    
-    try:
-        url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-        response = requests.get(
-            url,
-            auth=(consumer_key, consumer_secret),
-            timeout=30
-        )
-        response.raise_for_status()
-        return response.json()['access_token']
-    except Exception as e:
-        logger.error(f"Error getting M-Pesa access token: {str(e)}")
-        return None
+    return access_tokens.get()
 
 @mpesa.route('/stk_push', methods=['POST'])
 @login_required
@@ -56,7 +39,7 @@ def stk_push():
             phone = '254' + phone[1:]
         elif not phone.startswith('254'):
             phone = '254' + phone
-            
+        
         # Validate phone number format
         if not phone.isdigit() or len(phone) != 12:
             logger.error(f"Invalid phone number format: {phone}")
@@ -64,7 +47,7 @@ def stk_push():
                 'status': 'error',
                 'message': 'Invalid phone number format. Use format: 254XXXXXXXXX'
             }), 400
-
+        
         # Validate amount
         try:
             amount = float(data['amount'])
@@ -77,9 +60,9 @@ def stk_push():
                 'message': 'Invalid amount. Amount must be a positive number'
             }), 400
         
-        # Create payment record
+        # Create payment record; its STK push is sent in the background
         payment = Payment(
-            reference=f"FW{data['firmware_id']}_{current_user.id}",
+            reference=payment_reference(),
             amount=amount,
             phone_number=phone,
             firmware_id=data['firmware_id'],
@@ -88,81 +71,25 @@ def stk_push():
         db.session.add(payment)
         db.session.commit()
         
-        # Get access token
-        access_token = get_access_token()
-        if not access_token:
-            logger.error("Failed to get M-Pesa access token")
+        try:
+            payment_dispatcher.submit(payment.id)
+        except DispatchQueueFull:
+            payment.status = 'failed'
+            payment.failure_reason = 'Too many payments in progress'
+            db.session.commit()
             return jsonify({
                 'status': 'error',
-                'message': 'Could not initiate payment. Please try again later.'
-            }), 500
-        
-        # Prepare STK Push request
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        
-        payload = {
-            'BusinessShortCode': current_app.config['MPESA_SHORTCODE'],
-            'Password': current_app.config['MPESA_PASSWORD'],
-            'Timestamp': timestamp,
-            'TransactionType': 'CustomerPayBillOnline',
-            'Amount': int(amount),
-            'PartyA': phone,
-            'PartyB': current_app.config['MPESA_SHORTCODE'],
-            'PhoneNumber': phone,
-            'CallBackURL': current_app.config['MPESA_CALLBACK_URL'],
-            'AccountReference': payment.reference,
-            'TransactionDesc': f'Firmware Payment - {payment.reference}'
-        }
-        
-        logger.info(f"Initiating STK push for payment {payment.reference}")
-        
-        # Make STK Push request
-        response = requests.post(
-            'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest',
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"M-Pesa API error: {response.text}")
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to initiate payment. Please try again.'
-            }), 500
-            
-        response_data = response.json()
-        if response_data.get('ResponseCode') != '0':
-            logger.error(f"M-Pesa STK push failed: {response_data}")
-            return jsonify({
-                'status': 'error',
-                'message': response_data.get('ResponseDescription', 'Failed to initiate payment')
-            }), 400
-            
-        # Update payment record with CheckoutRequestID
-        payment.checkout_request_id = response_data.get('CheckoutRequestID')
-        db.session.commit()
+                'message': 'M-Pesa is busy. Please try again in a minute.'
+            }), 503
         
         return jsonify({
             'status': 'success',
             'message': 'Payment initiated. Please check your phone to complete payment.',
             'data': {
-                'reference': payment.reference,
-                'checkout_request_id': payment.checkout_request_id
+                'reference': payment.reference
             }
-        })
-        
-    except requests.RequestException as e:
-        logger.error(f"Network error during STK push: {str(e)}")
-        return jsonify({
-            'status': 'error',
-            'message': 'Network error. Please try again.'
-        }), 500
+        }), 202
+    
     except Exception as e:
         logger.error(f"Unexpected error during STK push: {str(e)}")
         return jsonify({
@@ -182,18 +109,21 @@ def payment_status(reference):
                 'status': 'error',
                 'message': 'Payment not found'
             }), 404
-            
+        
         if payment.user_id != current_user.id:
             return jsonify({
                 'status': 'error',
                 'message': 'Unauthorized'
             }), 403
-            
+        
         return jsonify({
-            'status': payment.status,
-            'message': payment.failure_reason if payment.status == 'failed' else None
+            # A push being sent is still pending to the customer
+            'status': 'pending' if payment.status == 'sending' else payment.status,
+            'message': payment.failure_reason if payment.status in ('failed', 'unconfirmed') else None,
+            # False while the payment prompt is still waiting to be sent
+            'prompt_sent': payment.checkout_request_id is not None
         })
-        
+    
     except Exception as e:
         logger.error(f"Error checking payment status: {str(e)}")
         return jsonify({
@@ -203,50 +133,32 @@ def payment_status(reference):
 
 @mpesa.route('/callback', methods=['POST'])
 def callback():
-    """Handle M-Pesa callback"""
+    """Handle M-Pesa callback
+    
+    The raw result is stored and acknowledged at once; callback_applier
+    settles the payment from it in the background.
+    """
     try:
-        data = request.get_json()
-        logger.info(f"M-Pesa callback received: {json.dumps(data)}")
-        
-        # Get the callback data
-        body = data.get('Body', {})
-        result = body.get('stkCallback', {})
-        
-        # Get the payment using checkout request ID
+        data = request.get_json(silent=True) or {}
+        result = data.get('Body', {}).get('stkCallback', {})
         checkout_id = result.get('CheckoutRequestID')
-        payment = Payment.query.filter_by(mpesa_request=checkout_id).first()
-        
-        if not payment:
-            logger.error(f"Payment not found for checkout ID: {checkout_id}")
-            return jsonify({'status': 'error'}), 404
+        if not checkout_id:
+            logger.error(f"M-Pesa callback without CheckoutRequestID: {request.get_data(as_text=True)[:500]}")
+            return jsonify({'status': 'error'}), 400
         
-        # Check if payment was successful
-        if result.get('ResultCode') == 0:
-            # Update payment status
-            payment.status = 'completed'
-            payment.completed_at = datetime.utcnow()
-            
-            # Get the amount paid
-            items = result.get('CallbackMetadata', {}).get('Item', [])
-            for item in items:
-                if item.get('Name') == 'Amount':
-                    payment.amount_paid = item.get('Value')
-                elif item.get('Name') == 'MpesaReceiptNumber':
-                    payment.mpesa_receipt = item.get('Value')
-                elif item.get('Name') == 'TransactionDate':
-                    payment.mpesa_date = item.get('Value')
-            
-            db.session.commit()
-            logger.info(f"Payment {payment.reference} completed successfully")
-        else:
-            # Update payment status as failed
-            payment.status = 'failed'
-            payment.failure_reason = result.get('ResultDesc')
+        logger.info(f"M-Pesa callback received for checkout ID: {checkout_id}")
+        try:
+            db.session.add(MpesaCallback(checkout_request_id=checkout_id, payload=request.get_data(as_text=True)))
             db.session.commit()
-            logger.error(f"Payment {payment.reference} failed: {result.get('ResultDesc')}")
+            shared.incr('mpesa.callbacks.received')
+        except IntegrityError:
+            # Daraja retries callbacks; the first copy is already stored
+            db.session.rollback()
+            shared.incr('mpesa.callbacks.redelivered')
         
+        callback_applier.notify()
         return jsonify({'status': 'success'})
-        
+    
     except Exception as e:
         logger.error(f"Error processing M-Pesa callback: {str(e)}")
         return jsonify({'status': 'error'}), 500
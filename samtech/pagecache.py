@@ -0,0 +1,135 @@
+"""Rendered page cache for anonymous catalog traffic.
+
+Public catalog pages are rendered once and kept in the shared store,
+keyed by endpoint, path and query string, so every worker serves them
+without touching the database. A view names the data it shows as tags
+(brand:3, firmware:12, ...) and each entry records the generation of its
+tags at render time. The admin views bump the generations of the tags a
+write affects, which invalidates exactly the pages showing that data.
+
+Entries are fresh for PAGE_CACHE_SECONDS and then stale for up to
+PAGE_CACHE_STALE_SECONDS more. A stale entry is still served while one
+worker renders its replacement, so a burst of traffic costs a single
+render. An invalidated entry is never served: after an edit every
+request renders until a new copy is stored.
+"""
+from functools import wraps
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from urllib.parse import urlencode
+from .shared import shared
+import hashlib
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Tags of the catalog data pages are built from:
+#   brands              the list of brands and their names
+#   brand:<id>          one brand's details
+#   brand-firmware:<id> the firmware listed under a brand
+#   firmware:<id>       one firmware's details
+#   firmware-list       the firmware listed on /firmware/
+TAG_PREFIX = 'page-tag:'
+# Expired entries are swept on roughly one store in this many
+PURGE_EVERY = 200
+
+def page_tags(*tags):
+    """Declare the data the page being rendered shows
+    
+    Call before loading the data: the generations read here are the ones
+    stored, so an edit committed while rendering still invalidates it.
+    """
+    if 'page_tags' not in g:
+        return
+    tags = [tag for tag in tags if tag not in g.page_tags]
+    if tags:
+        generations = shared.counter_values(TAG_PREFIX + tag for tag in tags)
+        g.page_tags.update({tag: generations[TAG_PREFIX + tag] for tag in tags})
+
+def invalidate(*tags):
+    """Drop every cached page showing any of the tags; call after commit"""
+    try:
+        for tag in set(tags):
+            shared.incr(TAG_PREFIX + tag)
+    except Exception as e:
+        logger.error(f"Error invalidating cached pages: {str(e)}")
+
+def invalidate_brand(brand_id):
+    invalidate('brands', f'brand:{brand_id}')
+
+def invalidate_firmware(firmware_id, *brand_ids):
+    """Invalidate a firmware's page and the lists of the brands it is or was in"""
+    invalidate(f'firmware:{firmware_id}', 'firmware-list',
+               *(f'brand-firmware:{brand_id}' for brand_id in brand_ids if brand_id))
+
+def cacheable():
+    # Signed-in users see their own navigation, flashed messages are shown once
+    return (
+        current_app.config['PAGE_CACHE_ENABLED']
+        and request.method in ('GET', 'HEAD')
+        and '_flashes' not in session
+        and not current_user.is_authenticated
+    )
+
+def cache_key():
+    query = urlencode(sorted(request.args.items(multi=True)))
+    digest = hashlib.sha1(f'{request.path}?{query}'.encode('utf-8')).hexdigest()
+    return f'page:{request.endpoint}:{digest}'
+
+def cached_response(entry, state):
+    response = current_app.response_class(entry['body'], mimetype='text/html')
+    response.headers['X-Page-Cache'] = state
+    return response
+
+def render(key, view, args, kwargs):
+    """Render a page and store it if it is cacheable"""
+    g.page_tags = {}
+    response = make_response(view(*args, **kwargs))
+    if response.status_code != 200 or response.mimetype != 'text/html' or session.modified or not g.page_tags:
+        return response
+    
+    fresh = current_app.config['PAGE_CACHE_SECONDS']
+    stale = current_app.config['PAGE_CACHE_STALE_SECONDS']
+    try:
+        shared.set(key, {
+            'body': response.get_data(as_text=True),
+            'tags': g.page_tags,
+            'fresh_until': time.time() + fresh
+        }, ttl=fresh + stale)
+        if random.randrange(PURGE_EVERY) == 0:
+            shared.purge_expired()
+    except Exception as e:
+        logger.error(f"Error caching page {request.path}: {str(e)}")
+    response.headers['X-Page-Cache'] = 'miss'
+    return response
+
+def cached_page(view):
+    """Serve a public page from the shared page cache"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not cacheable():
+            return view(*args, **kwargs)
+        
+        key = cache_key()
+        entry = shared.get(key)
+        if entry is None:
+            return render(key, view, args, kwargs)
+        
+        # Pages showing data that has since been edited are a miss
+        current = shared.counter_values(TAG_PREFIX + tag for tag in entry['tags'])
+        if any(current[TAG_PREFIX + tag] != generation for tag, generation in entry['tags'].items()):
+            return render(key, view, args, kwargs)
+        if entry['fresh_until'] > time.time():
+            return cached_response(entry, 'hit')
+        
+        # Merely expired: one worker renders the new copy, the others serve the old one
+        lock = shared.lock(f'page-{key[-2:]}')
+        if not lock.acquire(blocking=False):
+            return cached_response(entry, 'stale')
+        try:
+            return render(key, view, args, kwargs)
+        finally:
+            lock.release()
+    return wrapper
@@ -0,0 +1,94 @@
+"""Keyset (cursor) pagination.
+
+A page is read as "the next n rows after the last one shown", e.g.
+WHERE (created_at, id) < (:created_at, :id) ORDER BY created_at DESC,
+id DESC LIMIT n, which an index on the sort columns answers directly.
+Deep pages cost the same as the first one, and rows added while someone
+is paging do not shift what comes next. Cursors are opaque url-safe
+strings holding the sort key of the row a page starts or ends on.
+"""
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import tuple_
+import base64
+import json
+
+class KeysetPage:
+    """One page of rows with cursors to the pages around it"""
+    
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+    
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+    
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+def encode_cursor(values):
+    data = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, columns):
+    """Return the sort key in a cursor; raises ValueError if it is not valid"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, list) or len(data) != len(columns):
+            raise ValueError('wrong number of values')
+        values = []
+        for column, value in zip(columns, data):
+            if value is not None and column.type.python_type is datetime:
+                value = datetime.fromisoformat(value)
+            values.append(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {str(e)}')
+    return values
+
+def page_size(default=None):
+    """Return the ?per_page= of the request, within the configured bounds"""
+    default = default or current_app.config['CATALOG_PAGE_SIZE']
+    per_page = request.args.get('per_page', default, type=int)
+    return min(max(per_page, 1), current_app.config['CATALOG_MAX_PAGE_SIZE'])
+
+def paginate(query, columns, after=None, before=None, per_page=20, descending=True):
+    """Return a KeysetPage of a query ordered by `columns`
+    
+    The columns must end in a unique one (usually the id) so every row
+    has its own position. `after` and `before` are cursors from an
+    earlier page; invalid cursors raise ValueError.
+    """
+    key = tuple_(*columns)
+    # Paging backwards reads the rows before the cursor in reverse
+    backwards = before is not None and after is None
+    if after is not None:
+        position = tuple_(*decode_cursor(after, columns))
+        query = query.filter(key < position if descending else key > position)
+    elif backwards:
+        position = tuple_(*decode_cursor(before, columns))
+        query = query.filter(key > position if descending else key < position)
+    
+    newest_first = descending != backwards
+    order = [column.desc() if newest_first else column.asc() for column in columns]
+    rows = query.order_by(*order).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    
+    def cursor(row):
+        return encode_cursor([getattr(row, column.key) for column in columns])
+    
+    if not rows:
+        return KeysetPage([], per_page)
+    has_next = True if backwards else more
+    has_prev = more if backwards else after is not None
+    return KeysetPage(
+        rows, per_page,
+        next_cursor=cursor(rows[-1]) if has_next else None,
+        prev_cursor=cursor(rows[0]) if has_prev else None
+    )
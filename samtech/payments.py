@@ -0,0 +1,528 @@
+"""Background dispatch of M-Pesa STK pushes.
+
+A checkout only records the pending Payment and hands its id to this
+worker's dispatch pool, so the request returns as soon as the row is
+committed. A pool thread claims the payment (pending -> sending), sends
+the STK push through the Daraja client and records the CheckoutRequestID,
+or marks the payment failed. The browser follows the payment through
+/mpesa/status/<reference>.
+
+Daraja's result callbacks are only appended to mpesa_callbacks before
+they are acknowledged. CallbackApplier applies them in batches from a
+background thread: payments are settled with set-based updates keyed on
+the CheckoutRequestID, and only while still pending, so a redelivered
+callback or a reused MpesaReceiptNumber cannot settle a payment twice.
+
+Payments whose callback never came are settled by reconcile_payments(),
+run periodically by reconcile_payments.py, which asks Daraja for their
+outcome with STK push queries.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam, update
+from . import db
+from .daraja import daraja, stk_password, DarajaError, CircuitOpen, PENDING_ERROR
+from .models import MpesaCallback, Payment
+from .pagination import paginate
+from .shared import shared
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+UNCONFIRMED = ('We could not confirm that the payment request reached your phone. '
+               'If you approve it, the payment will be confirmed here. Please do not pay again yet.')
+
+class DispatchQueueFull(Exception):
+    """Too many payments are waiting to be sent"""
+
+def payment_reference():
+    """Return a new payment reference; Daraja allows 12 characters of AccountReference"""
+    return f'FW{secrets.token_hex(5).upper()}'
+
+class PaymentDispatcher:
+    """Send the STK pushes of new payments from a per-worker thread pool"""
+    
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.waiting = 0
+    
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['MPESA_DISPATCH_WORKERS']
+        self.queue_size = app.config['MPESA_DISPATCH_QUEUE']
+    
+    def pool(self):
+        """Return this process's pool; threads do not survive gunicorn's fork"""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='mpesa-dispatch')
+                    self.waiting = 0
+                    self.pid = os.getpid()
+        return self.executor
+    
+    def submit(self, payment_id):
+        """Queue a committed payment's STK push; raises DispatchQueueFull"""
+        if self.workers <= 0:
+            self.dispatch(payment_id, time.time())
+            return
+        pool = self.pool()
+        with self.lock:
+            if self.waiting >= self.queue_size:
+                shared.incr('mpesa.dispatch.rejected')
+                raise DispatchQueueFull('Too many payments waiting')
+            self.waiting += 1
+        shared.incr('mpesa.dispatch.queued')
+        pool.submit(self.run, payment_id, time.time())
+    
+    def run(self, payment_id, queued_at):
+        with self.lock:
+            self.waiting -= 1
+        with self.app.app_context():
+            self.dispatch(payment_id, queued_at)
+    
+    def dispatch(self, payment_id, queued_at):
+        """Send a payment's STK push and record the outcome"""
+        config = self.app.config
+        try:
+            shared.incr('mpesa.dispatch.wait_seconds', time.time() - queued_at)
+            # Claimed atomically; a payment queued too long is left for reconcile_payments()
+            claimed = db.session.execute(
+                update(Payment)
+                .where(Payment.id == payment_id, Payment.status == 'pending',
+                       Payment.checkout_request_id.is_(None),
+                       Payment.created_at >= datetime.utcnow() - timedelta(seconds=config['MPESA_DISPATCH_MAX_WAIT']))
+                .values(status='sending')
+            )
+            db.session.commit()
+            if not claimed.rowcount:
+                shared.incr('mpesa.dispatch.expired')
+                return
+            payment = db.session.get(Payment, payment_id)
+            
+            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+            payload = {
+                'BusinessShortCode': config['MPESA_SHORTCODE'],
+                'Password': stk_password(timestamp),
+                'Timestamp': timestamp,
+                'TransactionType': 'CustomerPayBillOnline',
+                'Amount': int(payment.amount),
+                'PartyA': payment.phone_number,
+                'PartyB': config['MPESA_SHORTCODE'],
+                'PhoneNumber': payment.phone_number,
+                'CallBackURL': config['MPESA_CALLBACK_URL'],
+                'AccountReference': payment.reference,
+                'TransactionDesc': f'Firmware Payment - {payment.reference}'
+            }
+            
+            logger.info(f"Initiating STK push for payment {payment.reference}")
+            sent = False
+            try:
+                response_data = daraja.stk_push(payload)
+            except CircuitOpen:
+                response_data = None
+                reason = 'M-Pesa is temporarily unavailable. Please try again in a minute.'
+            except DarajaError as e:
+                logger.error(f"M-Pesa API error: {str(e)}")
+                response_data = None
+                sent = e.sent
+                reason = 'Failed to initiate payment. Please try again.'
+            
+            # Recorded only on the claimed row, whatever happened to it meanwhile
+            sending = update(Payment).where(Payment.id == payment_id, Payment.status == 'sending')
+            if sent:
+                # The prompt may be on the phone; paying again could charge twice
+                db.session.execute(sending.values(status='unconfirmed', failure_reason=UNCONFIRMED))
+                shared.incr('mpesa.dispatch.unconfirmed')
+            elif response_data is not None and response_data.get('ResponseCode') == '0':
+                db.session.execute(sending.values(
+                    status='pending', checkout_request_id=response_data.get('CheckoutRequestID')))
+                shared.incr('mpesa.dispatch.sent')
+            else:
+                if response_data is not None:
+                    logger.error(f"M-Pesa STK push failed: {response_data}")
+                    reason = response_data.get('ResponseDescription', 'Failed to initiate payment')
+                db.session.execute(sending.values(status='failed', failure_reason=reason[:200]))
+                shared.incr('mpesa.dispatch.failed')
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            shared.incr('mpesa.dispatch.errors')
+            logger.error(f"Error dispatching STK push for payment {payment_id}: {str(e)}")
+        finally:
+            if self.workers > 0:
+                db.session.remove()
+
+payment_dispatcher = PaymentDispatcher()
+
+def callback_metadata(result):
+    """Return the CallbackMetadata items of an STK result as a dict"""
+    items = result.get('CallbackMetadata', {}).get('Item', [])
+    return {item.get('Name'): item.get('Value') for item in items}
+
+def payment_statuses(checkout_ids):
+    return dict(db.session.query(Payment.checkout_request_id, Payment.status).filter(
+        Payment.checkout_request_id.in_(checkout_ids)))
+
+def adopt_unconfirmed(results):
+    """Give unconfirmed payments the CheckoutRequestID of a matching paid callback
+    
+    `results` maps CheckoutRequestIDs no payment has to their STK results.
+    A paid result names the phone and amount; it is matched when exactly
+    one unconfirmed payment has both. Returns how many were matched.
+    """
+    paid = {}
+    for checkout_id, result in results.items():
+        metadata = callback_metadata(result)
+        try:
+            if str(result.get('ResultCode')) == '0':
+                paid[checkout_id] = (str(metadata.get('PhoneNumber')), int(float(metadata.get('Amount'))))
+        except (TypeError, ValueError):
+            continue
+    if not paid:
+        return 0
+    
+    candidates = db.session.query(Payment.id, Payment.phone_number, Payment.amount).filter(
+        Payment.status == 'unconfirmed', Payment.phone_number.in_({phone for phone, _ in paid.values()})).all()
+    adopted = 0
+    for checkout_id, (phone, amount) in paid.items():
+        matches = [row for row in candidates if row.phone_number == phone and int(row.amount) == amount]
+        if len(matches) != 1:
+            continue
+        result = db.session.execute(
+            update(Payment)
+            .where(Payment.id == matches[0].id, Payment.status == 'unconfirmed')
+            .values(status='pending', checkout_request_id=checkout_id, failure_reason=None)
+        )
+        if result.rowcount:
+            candidates.remove(matches[0])
+            adopted += 1
+            shared.incr('mpesa.callbacks.adopted')
+    return adopted
+
+def apply_callbacks(limit, match_seconds, after=0):
+    """Apply up to `limit` stored callbacks with ids above `after`; returns the rows read
+    
+    A callback can arrive before its push's CheckoutRequestID is recorded,
+    so one with no payment is retried until it is `match_seconds` old. A
+    paid one may also belong to a payment whose push had no answer.
+    """
+    now = datetime.utcnow()
+    rows = MpesaCallback.query.filter(
+        MpesaCallback.applied_at.is_(None), MpesaCallback.id > after
+    ).order_by(MpesaCallback.id).limit(limit).all()
+    if not rows:
+        return rows
+    
+    results = {}
+    for row in rows:
+        try:
+            results[row.id] = json.loads(row.payload)['Body']['stkCallback']
+        except (ValueError, KeyError, TypeError):
+            results[row.id] = {}
+    
+    checkout_ids = [row.checkout_request_id for row in rows]
+    statuses = payment_statuses(checkout_ids)
+    unknown = {row.checkout_request_id: results[row.id] for row in rows if row.checkout_request_id not in statuses}
+    if unknown and adopt_unconfirmed(unknown):
+        statuses = payment_statuses(checkout_ids)
+    pending = {checkout_id for checkout_id, status in statuses.items() if status == 'pending'}
+    receipts = [str(callback_metadata(result).get('MpesaReceiptNumber')) for result in results.values()]
+    used = {receipt for (receipt,) in db.session.query(Payment.mpesa_receipt).filter(
+        Payment.mpesa_receipt.in_(receipts))}
+    
+    completed, failed, applied = [], [], []
+    for row in rows:
+        result = results[row.id]
+        if row.checkout_request_id not in statuses:
+            if row.received_at > now - timedelta(seconds=match_seconds):
+                continue
+            logger.error(f"Payment not found for checkout ID: {row.checkout_request_id}")
+            outcome = 'unmatched'
+        elif row.checkout_request_id not in pending:
+            outcome = 'duplicate'
+        elif str(result.get('ResultCode')) == '0':
+            metadata = callback_metadata(result)
+            receipt = str(metadata.get('MpesaReceiptNumber'))
+            if receipt in used:
+                logger.error(f"M-Pesa receipt {receipt} already recorded, ignoring {row.checkout_request_id}")
+                outcome = 'duplicate'
+            else:
+                used.add(receipt)
+                completed.append({
+                    'checkout_id': row.checkout_request_id,
+                    'paid': metadata.get('Amount'),
+                    'receipt': receipt,
+                    'paid_on': str(metadata.get('TransactionDate') or '')[:14] or None,
+                    'now': now
+                })
+                outcome = 'completed'
+        else:
+            failed.append({
+                'checkout_id': row.checkout_request_id,
+                'reason': str(result.get('ResultDesc') or 'Payment failed')[:200]
+            })
+            outcome = 'failed'
+        pending.discard(row.checkout_request_id)
+        applied.append({'row_id': row.id, 'outcome': outcome, 'now': now})
+    
+    # Only pending payments are settled, so applying a callback twice changes nothing
+    table = Payment.__table__
+    if completed:
+        db.session.execute(
+            table.update()
+            .where(table.c.checkout_request_id == bindparam('checkout_id'), table.c.status == 'pending')
+            .values(status='completed', amount_paid=bindparam('paid'), mpesa_receipt=bindparam('receipt'),
+                    mpesa_date=bindparam('paid_on'), completed_at=bindparam('now')),
+            completed
+        )
+    if failed:
+        db.session.execute(
+            table.update()
+            .where(table.c.checkout_request_id == bindparam('checkout_id'), table.c.status == 'pending')
+            .values(status='failed', failure_reason=bindparam('reason')),
+            failed
+        )
+    if applied:
+        callbacks = MpesaCallback.__table__
+        db.session.execute(
+            callbacks.update()
+            .where(callbacks.c.id == bindparam('row_id'))
+            .values(applied_at=bindparam('now'), outcome=bindparam('outcome')),
+            applied
+        )
+    db.session.commit()
+    
+    for params in applied:
+        shared.incr(f"mpesa.callbacks.{params['outcome']}")
+    return rows
+
+class CallbackApplier:
+    """Apply stored M-Pesa callbacks from a background thread in each worker"""
+    
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pid = None
+        self.wakeup = threading.Event()
+    
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['MPESA_CALLBACK_APPLY_SECONDS']
+        self.batch_size = app.config['MPESA_CALLBACK_BATCH']
+        self.match_seconds = app.config['MPESA_CALLBACK_MATCH_SECONDS']
+    
+    def notify(self):
+        """Apply new callbacks soon"""
+        self.start()
+        self.wakeup.set()
+    
+    def start(self):
+        """Start the apply thread in this process if it is not running"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        thread = threading.Thread(target=self.run, name='mpesa-callbacks', daemon=True)
+        thread.start()
+    
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.app.app_context():
+                self.apply()
+    
+    def apply(self):
+        """Apply every stored callback that can be; one worker at a time"""
+        lock = shared.lock('mpesa-callbacks')
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            after = 0
+            while True:
+                rows = apply_callbacks(self.batch_size, self.match_seconds, after)
+                if len(rows) < self.batch_size:
+                    break
+                after = rows[-1].id
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error applying M-Pesa callbacks: {str(e)}")
+        finally:
+            lock.release()
+            db.session.remove()
+
+callback_applier = CallbackApplier()
+
+RECONCILE_KEY = 'mpesa-reconcile'
+
+def query_outcome(app, checkout_request_id):
+    """Return Daraja's STK push query answer, or the DarajaError it raised"""
+    with app.app_context():
+        try:
+            return daraja.stk_query(checkout_request_id)
+        except DarajaError as e:
+            return e
+
+def dispatch_deadline(config):
+    """Return the seconds after checkout by which a payment's push has been sent or given up
+    
+    The dispatcher claims a payment only within MPESA_DISPATCH_MAX_WAIT of
+    checkout, and every attempt of the push ends within its timeouts.
+    """
+    attempt = config['MPESA_CONNECT_TIMEOUT'] + config['MPESA_TIMEOUT'] + config['MPESA_RETRY_MAX_DELAY']
+    return config['MPESA_DISPATCH_MAX_WAIT'] + (1 + config['MPESA_RETRIES']) * attempt
+
+def settle_undispatched(config):
+    """Settle payments whose push was never sent or has no known outcome; returns how many failed"""
+    deadline = datetime.utcnow() - timedelta(seconds=dispatch_deadline(config))
+    # Never claimed, e.g. the worker holding them in its queue exited
+    unsent = db.session.execute(
+        update(Payment)
+        .where(Payment.status == 'pending', Payment.created_at < deadline, Payment.checkout_request_id.is_(None))
+        .values(status='failed', failure_reason='Payment request was not sent')
+    ).rowcount
+    # Claimed by a worker that exited while sending; the push may have gone out
+    db.session.execute(
+        update(Payment)
+        .where(Payment.status == 'sending', Payment.created_at < deadline)
+        .values(status='unconfirmed', failure_reason=UNCONFIRMED)
+    )
+    # No callback could be matched to them while callbacks are kept waiting
+    unconfirmed = db.session.execute(
+        update(Payment)
+        .where(Payment.status == 'unconfirmed',
+               Payment.created_at < deadline - timedelta(seconds=config['MPESA_CALLBACK_MATCH_SECONDS']))
+        .values(status='failed', failure_reason='The payment could not be confirmed')
+    ).rowcount
+    db.session.commit()
+    return unsent + unconfirmed
+
+def reconcile_payments(older_than=None, batch_size=None, concurrency=None):
+    """Settle payments pending for longer than `older_than` seconds from STK push queries
+    
+    Reads the sent pending payments oldest first, a batch at a time,
+    queries each batch with `concurrency` queries in flight and applies
+    the outcomes with one UPDATE per kind. Progress of the run is kept in
+    the shared store under mpesa-reconcile. Returns the run's stats, or
+    None if another run is in progress.
+    """
+    app = current_app._get_current_object()
+    config = app.config
+    older_than = config['MPESA_RECONCILE_AFTER_SECONDS'] if older_than is None else older_than
+    batch_size = batch_size or config['MPESA_RECONCILE_BATCH']
+    concurrency = concurrency or config['MPESA_RECONCILE_CONCURRENCY']
+    
+    lock = shared.lock('mpesa-reconcile')
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        # Callbacks stored by a worker that died before applying them come first
+        callback_applier.apply()
+        
+        started = time.time()
+        unsent = settle_undispatched(config)
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        query = db.session.query(Payment.id, Payment.created_at, Payment.checkout_request_id).filter(
+            Payment.status == 'pending', Payment.created_at < cutoff, Payment.checkout_request_id.isnot(None))
+        stats = {
+            'started_at': started,
+            'backlog': query.count(),
+            'checked': 0,
+            'completed': 0,
+            'failed': 0,
+            'unsent': unsent,
+            'pending': 0,
+            'errors': 0,
+            'position': None,
+            'finished_at': None
+        }
+        shared.set(RECONCILE_KEY, stats)
+        shared.incr('mpesa.reconcile.runs')
+        shared.incr('mpesa.reconcile.failed', unsent)
+        
+        cursor = None
+        with ThreadPoolExecutor(concurrency, thread_name_prefix='mpesa-reconcile') as pool:
+            while True:
+                page = paginate(query, [Payment.created_at, Payment.id], after=cursor, per_page=batch_size,
+                                descending=False)
+                if not page.items:
+                    break
+                
+                answers = pool.map(lambda row: query_outcome(app, row.checkout_request_id), page.items)
+                completed, failed = [], []
+                circuit_open = False
+                for row, answer in zip(page.items, answers):
+                    if isinstance(answer, CircuitOpen):
+                        circuit_open = True
+                        stats['errors'] += 1
+                    elif isinstance(answer, DarajaError):
+                        if answer.data.get('errorCode') == PENDING_ERROR:
+                            stats['pending'] += 1
+                        else:
+                            logger.error(f"Error querying payment {row.id}: {str(answer)}")
+                            stats['errors'] += 1
+                    elif str(answer.get('ResultCode')) == '0':
+                        completed.append({'payment_id': row.id})
+                    elif answer.get('ResultCode') is not None:
+                        failed.append({
+                            'payment_id': row.id,
+                            'reason': str(answer.get('ResultDesc') or 'Payment failed')[:200]
+                        })
+                    else:
+                        stats['errors'] += 1
+                
+                apply_outcomes(completed, failed)
+                stats['checked'] += len(page.items)
+                stats['completed'] += len(completed)
+                stats['failed'] += len(failed)
+                stats['position'] = page.items[-1].created_at.isoformat()
+                shared.set(RECONCILE_KEY, stats)
+                shared.incr('mpesa.reconcile.checked', len(page.items))
+                shared.incr('mpesa.reconcile.completed', len(completed))
+                shared.incr('mpesa.reconcile.failed', len(failed))
+                
+                if circuit_open:
+                    logger.error("M-Pesa circuit is open, stopping reconciliation")
+                    break
+                if not page.has_next:
+                    break
+                cursor = page.next_cursor
+        
+        stats['finished_at'] = time.time()
+        stats['per_second'] = stats['checked'] / max(stats['finished_at'] - started, 0.001)
+        shared.set(RECONCILE_KEY, stats)
+        shared.incr('mpesa.reconcile.seconds', stats['finished_at'] - started)
+        return stats
+    finally:
+        lock.release()
+
+def apply_outcomes(completed, failed):
+    """Settle payments by id with one UPDATE per outcome; pending ones only"""
+    table = Payment.__table__
+    if completed:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('payment_id'), table.c.status == 'pending')
+            .values(status='completed', amount_paid=table.c.amount, completed_at=datetime.utcnow()),
+            completed
+        )
+    if failed:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('payment_id'), table.c.status == 'pending')
+            .values(status='failed', failure_reason=bindparam('reason')),
+            failed
+        )
+    db.session.commit()
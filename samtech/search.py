@@ -0,0 +1,281 @@
+"""Full-text search over the firmware catalog.
+
+Each firmware has one search document built from its name, version,
+description, features and brand name. On SQLite the documents live in
+an FTS5 table ranked with bm25(); on PostgreSQL in a weighted tsvector
+column with a GIN index, ranked with ts_rank_cd(). Other databases fall
+back to LIKE matching. Every query term is matched as a prefix, so
+"gal a1" finds "Galaxy A10". The admin views update a firmware's
+document after each commit that changes it.
+"""
+from sqlalchemy import or_, text
+from sqlalchemy.exc import OperationalError
+from . import db
+from .models import Brand, Firmware
+from .shared import shared
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+# Longer queries are cut short rather than rejected
+MAX_TERMS = 8
+
+def query_terms(query):
+    """Split a user query into lower-case word terms"""
+    return TERM_RE.findall((query or '').lower())[:MAX_TERMS]
+
+def document_rows(firmware_ids=None, brand_id=None):
+    """Return (id, name, version, description, features, brand) rows to index"""
+    rows = db.session.query(
+        Firmware.id, Firmware.name, Firmware.version, Firmware.description,
+        Firmware.features, Brand.name
+    ).join(Brand, Firmware.brand_id == Brand.id)
+    if firmware_ids is not None:
+        rows = rows.filter(Firmware.id.in_(firmware_ids))
+    if brand_id is not None:
+        rows = rows.filter(Firmware.brand_id == brand_id)
+    return [
+        {
+            'id': row[0],
+            'name': row[1] or '',
+            'version': row[2] or '',
+            'description': row[3] or '',
+            'features': row[4] or '',
+            'brand': row[5] or ''
+        }
+        for row in rows.all()
+    ]
+
+class SqliteIndex:
+    """An FTS5 table keyed by firmware id"""
+    name = 'fts5'
+    # bm25() weights for name, version, description, features, brand
+    weights = '10.0, 4.0, 1.0, 2.0, 8.0'
+    
+    def create(self):
+        """Create the index table; returns True if it did not exist"""
+        exists = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'firmware_search'"
+        )).first()
+        if exists:
+            return False
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE firmware_search USING fts5("
+            "name, version, description, features, brand, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+        return True
+    
+    def upsert(self, rows):
+        for row in rows:
+            db.session.execute(text('DELETE FROM firmware_search WHERE rowid = :id'), row)
+            db.session.execute(text(
+                'INSERT INTO firmware_search (rowid, name, version, description, features, brand) '
+                'VALUES (:id, :name, :version, :description, :features, :brand)'
+            ), row)
+    
+    def delete(self, firmware_ids):
+        for firmware_id in firmware_ids:
+            db.session.execute(text('DELETE FROM firmware_search WHERE rowid = :id'), {'id': firmware_id})
+    
+    def clear(self):
+        db.session.execute(text('DELETE FROM firmware_search'))
+    
+    def search(self, terms, limit, offset):
+        # Terms are plain words, so quoting them is enough to escape them
+        match = ' AND '.join(f'"{term}"*' for term in terms)
+        ids = db.session.execute(text(
+            f'SELECT rowid FROM firmware_search WHERE firmware_search MATCH :match '
+            f'ORDER BY bm25(firmware_search, {self.weights}), rowid DESC LIMIT :limit OFFSET :offset'
+        ), {'match': match, 'limit': limit, 'offset': offset}).scalars().all()
+        total = db.session.execute(text(
+            'SELECT COUNT(*) FROM firmware_search WHERE firmware_search MATCH :match'
+        ), {'match': match}).scalar()
+        return ids, total
+
+class PostgresIndex:
+    """A weighted tsvector per firmware with a GIN index"""
+    name = 'tsvector'
+    # Names and brands weigh most (A), then versions (B), features (C)
+    # and descriptions (D). The 'simple' configuration does not stem, so
+    # prefixes of model codes and words match what was typed.
+    document = (
+        "setweight(to_tsvector('simple', :name), 'A') || "
+        "setweight(to_tsvector('simple', :brand), 'A') || "
+        "setweight(to_tsvector('simple', :version), 'B') || "
+        "setweight(to_tsvector('simple', :features), 'C') || "
+        "setweight(to_tsvector('simple', :description), 'D')"
+    )
+    
+    def create(self):
+        exists = db.session.execute(text("SELECT to_regclass('firmware_search')")).scalar()
+        if exists:
+            return False
+        db.session.execute(text(
+            'CREATE TABLE IF NOT EXISTS firmware_search ('
+            'firmware_id INTEGER PRIMARY KEY REFERENCES firmwares (id) ON DELETE CASCADE, '
+            'document TSVECTOR NOT NULL)'
+        ))
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_firmware_search_document '
+            'ON firmware_search USING GIN (document)'
+        ))
+        return True
+    
+    def upsert(self, rows):
+        for row in rows:
+            db.session.execute(text(
+                f'INSERT INTO firmware_search (firmware_id, document) VALUES (:id, {self.document}) '
+                f'ON CONFLICT (firmware_id) DO UPDATE SET document = excluded.document'
+            ), row)
+    
+    def delete(self, firmware_ids):
+        for firmware_id in firmware_ids:
+            db.session.execute(text('DELETE FROM firmware_search WHERE firmware_id = :id'), {'id': firmware_id})
+    
+    def clear(self):
+        db.session.execute(text('DELETE FROM firmware_search'))
+    
+    def search(self, terms, limit, offset):
+        query = ' & '.join(f'{term}:*' for term in terms)
+        ids = db.session.execute(text(
+            "SELECT firmware_id FROM firmware_search, to_tsquery('simple', :query) query "
+            "WHERE document @@ query "
+            "ORDER BY ts_rank_cd(document, query) DESC, firmware_id DESC LIMIT :limit OFFSET :offset"
+        ), {'query': query, 'limit': limit, 'offset': offset}).scalars().all()
+        total = db.session.execute(text(
+            "SELECT COUNT(*) FROM firmware_search WHERE document @@ to_tsquery('simple', :query)"
+        ), {'query': query}).scalar()
+        return ids, total
+
+class LikeIndex:
+    """No index: match every term against the columns, newest first"""
+    name = 'like'
+    
+    def create(self):
+        return False
+    
+    def upsert(self, rows):
+        pass
+    
+    def delete(self, firmware_ids):
+        pass
+    
+    def clear(self):
+        pass
+    
+    def search(self, terms, limit, offset):
+        query = db.session.query(Firmware.id).join(Brand, Firmware.brand_id == Brand.id)
+        for term in terms:
+            pattern = f'%{term}%'
+            query = query.filter(or_(
+                Firmware.name.ilike(pattern), Firmware.version.ilike(pattern),
+                Firmware.description.ilike(pattern), Firmware.features.ilike(pattern),
+                Brand.name.ilike(pattern)
+            ))
+        total = query.count()
+        ids = [row[0] for row in query.order_by(Firmware.created_at.desc(), Firmware.id.desc())
+               .limit(limit).offset(offset).all()]
+        return ids, total
+
+class SearchPage:
+    """One page of search results"""
+    
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+    
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.total / self.per_page))
+    
+    @property
+    def has_prev(self):
+        return self.page > 1
+    
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+class SearchIndex:
+    """The full-text index for the database in use"""
+    
+    def __init__(self):
+        self.backend = None
+    
+    def init_app(self, app):
+        """Pick the backend and build the index if it is new; call in an app context"""
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            self.backend = SqliteIndex()
+        elif dialect == 'postgresql':
+            self.backend = PostgresIndex()
+        else:
+            self.backend = LikeIndex()
+        
+        # Workers start together; only one of them builds the index
+        with shared.lock('search-index'):
+            try:
+                created = self.backend.create()
+                db.session.commit()
+            except OperationalError as e:
+                # SQLite builds without FTS5
+                db.session.rollback()
+                app.logger.error(f"Full-text search unavailable, using LIKE: {str(e)}")
+                self.backend = LikeIndex()
+                created = False
+            if created:
+                count = self.rebuild()
+                app.logger.info(f"Built search index ({self.backend.name}) for {count} firmwares")
+    
+    def rebuild(self):
+        """Index every firmware from scratch"""
+        rows = document_rows()
+        self.backend.clear()
+        self.backend.upsert(rows)
+        db.session.commit()
+        return len(rows)
+    
+    def search(self, query, page=1, per_page=20):
+        """Return a SearchPage of firmware matching every term of `query`"""
+        terms = query_terms(query)
+        if not terms:
+            return SearchPage([], 0, page, per_page)
+        ids, total = self.backend.search(terms, per_page, (page - 1) * per_page)
+        # Keep the index's ranking order
+        firmwares = {firmware.id: firmware for firmware in Firmware.query.filter(Firmware.id.in_(ids)).all()}
+        return SearchPage([firmwares[id] for id in ids if id in firmwares], total, page, per_page)
+
+search_index = SearchIndex()
+
+def index_firmware(firmware):
+    """Update a firmware's search document; call after commit"""
+    try:
+        search_index.backend.upsert(document_rows(firmware_ids=[firmware.id]))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error indexing firmware {firmware.id}: {str(e)}")
+
+def index_brand(brand):
+    """Update the documents of a brand's firmware, e.g. after a rename"""
+    try:
+        search_index.backend.upsert(document_rows(brand_id=brand.id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error indexing brand {brand.id}: {str(e)}")
+
+def unindex_firmware(firmware_id):
+    """Drop a deleted firmware from the index; call after commit"""
+    try:
+        search_index.backend.delete([firmware_id])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error removing firmware {firmware_id} from the search index: {str(e)}")
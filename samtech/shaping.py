@@ -0,0 +1,104 @@
+"""Bandwidth shaping for firmware downloads.
+
+Bodies streamed by the workers are sent in fixed-size chunks, each paid
+for from two token buckets: one per stream, kept in the worker, and one
+for all downloads, kept in the shared store so the cap holds across
+gunicorn workers. A stream over either cap sleeps before its next chunk,
+so a paused or throttled client never holds more than one chunk.
+"""
+from flask import current_app
+from .shared import shared
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_BUCKET = 'downloads'
+
+class TokenBucket:
+    """A token bucket owned by a single stream"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def take(self, amount):
+        """Take `amount` tokens and return how long to wait before using them"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        return max(0.0, -self.tokens / self.rate)
+
+class ShapedBody:
+    """Re-chunk a response body and pace it to the configured rates"""
+    
+    def __init__(self, body, chunk_size, stream_rate, global_rate):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.stream_bucket = TokenBucket(stream_rate, chunk_size) if stream_rate else None
+        self.global_rate = global_rate
+        self.sent = 0
+        self.waited = 0.0
+    
+    def chunks(self):
+        buffer = bytearray()
+        for data in self.body:
+            buffer += data
+            while len(buffer) >= self.chunk_size:
+                yield bytes(buffer[:self.chunk_size])
+                del buffer[:self.chunk_size]
+        if buffer:
+            yield bytes(buffer)
+    
+    def wait_for(self, amount):
+        wait = self.stream_bucket.take(amount) if self.stream_bucket else 0.0
+        if self.global_rate:
+            try:
+                # Allow up to a second of burst across all streams
+                wait = max(wait, shared.take(GLOBAL_BUCKET, amount, self.global_rate,
+                                             max(self.global_rate, self.chunk_size)))
+            except Exception as e:
+                # Never fail a download because the shared store is busy
+                logger.error(f"Error taking from the global download bucket: {str(e)}")
+        if wait > 0:
+            time.sleep(wait)
+            self.waited += wait
+    
+    def __iter__(self):
+        for chunk in self.chunks():
+            self.wait_for(len(chunk))
+            yield chunk
+            self.sent += len(chunk)
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            try:
+                shared.incr('bandwidth.bytes_sent', self.sent)
+                if self.waited:
+                    shared.incr('bandwidth.throttled_seconds', self.waited)
+            except Exception as e:
+                logger.error(f"Error recording download bandwidth: {str(e)}")
+
+def shape_response(response):
+    """Pace a file response streamed by this worker to the configured caps"""
+    config = current_app.config
+    stream_rate = config['DOWNLOAD_RATE_PER_STREAM']
+    global_rate = config['DOWNLOAD_RATE_GLOBAL']
+    # Only bodies the worker streams itself; 304s and errors have none
+    if not (stream_rate or global_rate) or not response.direct_passthrough:
+        return response
+    if response.status_code not in (200, 206):
+        return response
+    
+    response.response = ShapedBody(
+        response.response,
+        config['DOWNLOAD_STREAM_CHUNK_SIZE'],
+        stream_rate,
+        global_rate
+    )
+    return response
@@ -0,0 +1,221 @@
+"""State shared by all gunicorn workers on this host.
+
+Workers are separate processes, so anything they must agree on lives in
+SHARED_STATE_DIR: a small SQLite database (WAL mode) for values with a
+time to live, counters and waiting queues, and lock files taken with
+flock(), which the kernel releases if a worker dies.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows development server, a single process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+class FileLock:
+    """An exclusive lock on a file, shared across processes"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+    
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                os.close(fd)
+                return False
+        self.fd = fd
+        return True
+    
+    def release(self):
+        if self.fd is not None:
+            # Closing the descriptor drops the flock
+            os.close(self.fd)
+            self.fd = None
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+
+class SharedStore:
+    """Key/value, counter and queue storage shared by worker processes"""
+    
+    def __init__(self):
+        self.directory = None
+        self.local = threading.local()
+    
+    def init_app(self, app):
+        self.directory = app.config['SHARED_STATE_DIR'] or os.path.join(app.instance_path, 'shared')
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, 'state.db')
+        # Connections opened for an earlier app point at its store
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+    
+    def connection(self):
+        """Return this thread's connection, reopening it after a fork"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+    
+    def lock(self, name):
+        """Return a lock file shared by every worker"""
+        return FileLock(os.path.join(self.directory, 'locks', f"{name}.lock"))
+    
+    def get(self, key, default=None):
+        row = self.connection().execute(
+            'SELECT value, expires FROM kv WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+    
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self.connection().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+            (key, json.dumps(value), expires)
+        )
+    
+    def delete(self, key):
+        self.connection().execute('DELETE FROM kv WHERE key = ?', (key,))
+    
+    def incr(self, name, amount=1):
+        """Add to a counter and return its new value"""
+        conn = self.connection()
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount)
+        )
+        return conn.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()[0]
+    
+    def counter_values(self, names):
+        """Return the value of each named counter, 0 for counters never incremented"""
+        names = list(names)
+        if not names:
+            return {}
+        rows = self.connection().execute(
+            f'SELECT name, value FROM counters WHERE name IN ({", ".join("?" * len(names))})', names
+        ).fetchall()
+        values = dict.fromkeys(names, 0)
+        values.update(rows)
+        return values
+    
+    def purge_expired(self):
+        """Delete values whose time to live has passed"""
+        self.connection().execute('DELETE FROM kv WHERE expires < ?', (time.time(),))
+    
+    def counters(self, prefix=''):
+        rows = self.connection().execute(
+            'SELECT name, value FROM counters WHERE name LIKE ? ORDER BY name', (prefix + '%',)
+        ).fetchall()
+        return dict(rows)
+    
+    def take(self, name, amount, rate, burst):
+        """Take from a token bucket and return how long to wait before using it
+        
+        The bucket may go into debt, so concurrent takers are spaced out
+        fairly instead of retrying.
+        """
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            tokens -= amount
+            conn.execute(
+                'INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                (name, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return max(0.0, -tokens / rate)
+    
+    def enqueue(self, name, key):
+        """Add a waiter to a queue, or mark an existing one as still waiting"""
+        now = time.time()
+        self.connection().execute(
+            'INSERT INTO queue (name, key, first_seen, last_seen) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(name, key) DO UPDATE SET last_seen = excluded.last_seen',
+            (name, key, now, now)
+        )
+    
+    def dequeue(self, name, key):
+        self.connection().execute('DELETE FROM queue WHERE name = ? AND key = ?', (name, key))
+    
+    def queue_position(self, name, key, stale_after):
+        """Return how many live waiters are ahead of `key` in a queue"""
+        conn = self.connection()
+        cutoff = time.time() - stale_after
+        # Waiters that stopped retrying give up their place
+        conn.execute('DELETE FROM queue WHERE name = ? AND last_seen < ?', (name, cutoff))
+        row = conn.execute(
+            'SELECT first_seen FROM queue WHERE name = ? AND key = ?', (name, key)
+        ).fetchone()
+        if row is None:
+            return self.queue_depth(name, stale_after)
+        return conn.execute(
+            'SELECT COUNT(*) FROM queue WHERE name = ? AND first_seen < ? AND last_seen >= ?',
+            (name, row[0], cutoff)
+        ).fetchone()[0]
+    
+    def queue_depth(self, name, stale_after):
+        """Return the number of live waiters in a queue, or in all of them"""
+        if name is None:
+            return self.connection().execute(
+                'SELECT COUNT(*) FROM queue WHERE last_seen >= ?',
+                (time.time() - stale_after,)
+            ).fetchone()[0]
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM queue WHERE name = ? AND last_seen >= ?',
+            (name, time.time() - stale_after)
+        ).fetchone()[0]
+
+shared = SharedStore()
@@ -0,0 +1,416 @@
+"""Storage for firmware files, blobs and patches.
+
+Keys are paths relative to the storage root, e.g. ``blobs/ab/cd/<digest>``.
+The local driver keeps them under UPLOAD_FOLDER; the S3 driver keeps them
+in a bucket of any S3-compatible service (AWS, MinIO, or s3_standin.py
+for development), signing requests with AWS Signature V4 over a pooled
+``requests`` session. Both drivers return seekable file objects, so
+Range requests work the same everywhere, and the S3 driver can hand out
+presigned URLs that let clients download without going through the app.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlsplit
+from urllib3.util.retry import Retry
+from xml.etree import ElementTree
+import hashlib
+import hmac
+import io
+import logging
+import os
+import requests
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+class StorageError(Exception):
+    pass
+
+class ObjectStat(namedtuple('ObjectStat', ['size', 'mtime_ns'])):
+    """Size and modification time of a stored object"""
+    
+    @property
+    def mtime(self):
+        return self.mtime_ns / 1e9
+
+class LocalStorage:
+    """Files under a local directory"""
+    is_local = True
+    presigns = False
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def path(self, key):
+        return os.path.join(self.root, key)
+    
+    def stat(self, key):
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return ObjectStat(stat.st_size, stat.st_mtime_ns)
+    
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+    
+    def open(self, key):
+        return open(self.path(key), 'rb')
+    
+    def put_file(self, key, tmp_path, keep=False):
+        """Move a finished local file into storage; with `keep`, link it instead"""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not keep:
+            os.replace(tmp_path, path)
+            return
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Another filesystem, or one without hard links
+            with open(tmp_path, 'rb') as f:
+                self.put_stream(key, f)
+    
+    def put_stream(self, key, stream, size=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                    out.write(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def move(self, key, new_key):
+        path = self.path(new_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.path(key), path)
+    
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def presigned_url(self, key, expires, download_name=None):
+        return None
+    
+    @contextmanager
+    def local_copy(self, key):
+        """Yield a local path holding the object"""
+        yield self.path(key)
+
+# AWS Signature Version 4
+
+def uri_encode(value, safe='-_.~'):
+    return quote(value, safe=safe)
+
+def canonical_query(params):
+    return '&'.join(f"{uri_encode(k)}={uri_encode(v)}" for k, v in sorted(params.items()))
+
+def signing_key(secret_key, date, region):
+    key = f"AWS4{secret_key}".encode('utf-8')
+    for part in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    return key
+
+def signature(secret_key, region, amz_date, method, path, params, headers, signed_headers, payload_hash):
+    """Compute a SigV4 signature; `headers` has lower-case names"""
+    canonical_headers = ''.join(f"{name}:{str(headers[name]).strip()}\n" for name in signed_headers)
+    canonical_request = '\n'.join([
+        method,
+        uri_encode(path, safe='/-_.~'),
+        canonical_query(params),
+        canonical_headers,
+        ';'.join(signed_headers),
+        payload_hash
+    ])
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+    ])
+    return hmac.new(signing_key(secret_key, amz_date[:8], region),
+                    string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+class BodyReader:
+    """Expose the next `length` bytes of a stream as a request body"""
+    
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+        self.length = length
+    
+    def __len__(self):
+        return self.length
+    
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+    
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), b'')
+
+class S3ObjectReader(io.RawIOBase):
+    """A seekable reader over an object, fetched with ranged GETs"""
+    
+    def __init__(self, driver, key, size):
+        super().__init__()
+        self.driver = driver
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.response = None
+        self.stream_position = None
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+    
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        # Sequential reads share one response; a seek starts a new range
+        if self.response is None or self.stream_position != self.position:
+            self.close_response()
+            self.response = self.driver.request(
+                'GET', self.key, headers={'range': f"bytes={self.position}-"}, stream=True)
+            if self.response.status_code not in (200, 206):
+                raise StorageError(f"GET {self.key} failed with {self.response.status_code}")
+            self.stream_position = self.position
+        
+        data = self.response.raw.read(len(buffer))
+        if not data:
+            raise StorageError(f"Object {self.key} ended early")
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.stream_position = self.position
+        return len(data)
+    
+    def close_response(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+    
+    def close(self):
+        self.close_response()
+        super().close()
+
+class S3Storage:
+    """Objects in a bucket of an S3-compatible service"""
+    is_local = False
+    presigns = True
+    
+    def __init__(self, endpoint, bucket, region, access_key, secret_key, pool_size, part_size, staging_dir):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urlsplit(self.endpoint).netloc
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.pool_size = pool_size
+        self.part_size = part_size
+        self.staging_dir = staging_dir
+        self.local = threading.local()
+    
+    def session(self):
+        """Return this thread's pooled session, recreated after a fork"""
+        session = getattr(self.local, 'session', None)
+        if session is None or self.local.pid != os.getpid():
+            session = requests.Session()
+            # Only requests without a streamed body can be replayed
+            retry = Retry(total=3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD', 'DELETE']), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            self.local.pid = os.getpid()
+        return session
+    
+    def object_path(self, key):
+        return f"/{self.bucket}/{key.replace(os.sep, '/')}"
+    
+    def request(self, method, key, params=None, headers=None, data=None, stream=False):
+        params = params or {}
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        amz_date = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        headers.update({
+            'host': self.host,
+            'x-amz-date': amz_date,
+            'x-amz-content-sha256': 'UNSIGNED-PAYLOAD'
+        })
+        path = self.object_path(key)
+        signed_headers = sorted(headers)
+        sig = signature(self.secret_key, self.region, amz_date, method, path, params,
+                        headers, signed_headers, 'UNSIGNED-PAYLOAD')
+        headers['authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request, "
+            f"SignedHeaders={';'.join(signed_headers)}, Signature={sig}"
+        )
+        url = self.endpoint + uri_encode(path, safe='/-_.~')
+        if params:
+            url += '?' + canonical_query(params)
+        return self.session().request(method, url, headers=headers, data=data, stream=stream,
+                                      timeout=(5, 300))
+    
+    def check(self, response, action):
+        if response.status_code >= 300:
+            raise StorageError(f"{action} failed with {response.status_code}: {response.text[:200]}")
+        return response
+    
+    def stat(self, key):
+        response = self.request('HEAD', key)
+        if response.status_code == 404:
+            return None
+        self.check(response, f"HEAD {key}")
+        modified = parsedate_to_datetime(response.headers['Last-Modified'])
+        return ObjectStat(int(response.headers['Content-Length']), int(modified.timestamp()) * 10 ** 9)
+    
+    def exists(self, key):
+        return self.stat(key) is not None
+    
+    def open(self, key):
+        stat = self.stat(key)
+        if stat is None:
+            raise FileNotFoundError(key)
+        return S3ObjectReader(self, key, stat.size)
+    
+    def put_file(self, key, tmp_path, keep=False):
+        """Upload a finished local file, then remove it unless `keep`"""
+        with open(tmp_path, 'rb') as f:
+            self.put_stream(key, f, os.path.getsize(tmp_path))
+        if not keep:
+            os.remove(tmp_path)
+    
+    def put_stream(self, key, stream, size):
+        """Upload `size` bytes from a stream, in parts when it is large"""
+        if size <= self.part_size:
+            self.check(self.request('PUT', key, data=BodyReader(stream, size)), f"PUT {key}")
+            return
+        
+        response = self.check(self.request('POST', key, params={'uploads': ''}), f"Start upload of {key}")
+        upload_id = ElementTree.fromstring(response.content).findtext('{*}UploadId')
+        try:
+            parts = []
+            remaining = size
+            while remaining > 0:
+                length = min(self.part_size, remaining)
+                number = len(parts) + 1
+                response = self.check(self.request(
+                    'PUT', key,
+                    params={'partNumber': str(number), 'uploadId': upload_id},
+                    data=BodyReader(stream, length)
+                ), f"Upload part {number} of {key}")
+                parts.append(f"<Part><PartNumber>{number}</PartNumber><ETag>{response.headers['ETag']}</ETag></Part>")
+                remaining -= length
+            
+            body = f"<CompleteMultipartUpload>{''.join(parts)}</CompleteMultipartUpload>".encode('utf-8')
+            self.check(self.request('POST', key, params={'uploadId': upload_id}, data=body),
+                       f"Complete upload of {key}")
+        except Exception:
+            self.request('DELETE', key, params={'uploadId': upload_id})
+            raise
+    
+    def move(self, key, new_key):
+        """Copy an object server-side, then delete the original"""
+        source = uri_encode(self.object_path(key), safe='/-_.~')
+        self.check(self.request('PUT', new_key, headers={'x-amz-copy-source': source}),
+                   f"Copy {key} to {new_key}")
+        self.delete(key)
+    
+    def delete(self, key):
+        response = self.request('DELETE', key)
+        if response.status_code != 404:
+            self.check(response, f"DELETE {key}")
+    
+    def presigned_url(self, key, expires, download_name=None):
+        """Return a URL that fetches the object without credentials until it expires"""
+        amz_date = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        params = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f"{self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request",
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host'
+        }
+        if download_name:
+            params['response-content-disposition'] = f'attachment; filename="{download_name}"'
+        path = self.object_path(key)
+        sig = signature(self.secret_key, self.region, amz_date, 'GET', path, params,
+                        {'host': self.host}, ['host'], 'UNSIGNED-PAYLOAD')
+        return (f"{self.endpoint}{uri_encode(path, safe='/-_.~')}?{canonical_query(params)}"
+                f"&X-Amz-Signature={sig}")
+    
+    @contextmanager
+    def local_copy(self, key):
+        """Download the object to a temporary file and yield its path"""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.staging_dir, suffix='.download')
+        try:
+            with os.fdopen(fd, 'wb') as out, self.open(key) as source:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    out.write(chunk)
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+class Storage:
+    """The storage driver chosen by STORAGE_BACKEND"""
+    
+    def __init__(self):
+        self.driver = None
+    
+    def init_app(self, app):
+        config = app.config
+        backend = config['STORAGE_BACKEND']
+        if backend == 'local':
+            self.driver = LocalStorage(config['UPLOAD_FOLDER'])
+        elif backend == 's3':
+            self.driver = S3Storage(
+                config['S3_ENDPOINT_URL'],
+                config['S3_BUCKET'],
+                config['S3_REGION'],
+                config['S3_ACCESS_KEY_ID'],
+                config['S3_SECRET_ACCESS_KEY'],
+                config['S3_POOL_SIZE'],
+                config['S3_PART_SIZE'],
+                os.path.join(config['UPLOAD_FOLDER'], 'tmp')
+            )
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+storage = Storage()
@@ -0,0 +1,105 @@
+"""Stateless signed download tokens.
+
+A token carries the firmware id, user id, issue time, expiry and an
+optional byte budget, HMAC-signed with DOWNLOAD_SIGNING_KEYS (the last
+key signs, every key verifies, so keys can be rotated). Checking a token
+needs no database round trip; the only shared state is a small list of
+revoked purchases, cached per worker.
+"""
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from . import db
+from .models import RevokedDownload
+from datetime import datetime
+import calendar
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SALT = 'firmware-download'
+
+def timestamp(dt):
+    """Convert a naive UTC datetime to a unix timestamp"""
+    return calendar.timegm(dt.utctimetuple())
+
+def serializer():
+    keys = current_app.config['DOWNLOAD_SIGNING_KEYS'] or [current_app.config['SECRET_KEY']]
+    return URLSafeSerializer(keys, salt=SALT)
+
+def issue_token(firmware_id, user_id, expires_at, byte_budget=None, audit_id=None):
+    """Sign a download token for a purchased firmware"""
+    claims = {
+        'f': firmware_id,
+        'u': user_id,
+        'i': int(time.time()),
+        'e': timestamp(expires_at)
+    }
+    if byte_budget:
+        claims['b'] = byte_budget
+    if audit_id:
+        claims['j'] = audit_id
+    return serializer().dumps(claims)
+
+def verify_token(token, firmware_id):
+    """Return the claims of a valid token for a firmware, or None"""
+    try:
+        claims = serializer().loads(token)
+    except BadSignature:
+        return None
+    
+    if not isinstance(claims, dict) or claims.get('f') != firmware_id:
+        return None
+    if claims.get('e', 0) < time.time():
+        return None
+    if revocations.is_revoked(claims.get('u'), firmware_id, claims.get('i', 0)):
+        return None
+    return claims
+
+class RevocationList:
+    """Per-worker cache of revoked purchases, reloaded periodically"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.revoked = {}
+        self.loaded_at = 0
+    
+    def invalidate(self):
+        self.loaded_at = 0
+    
+    def load(self):
+        revoked = {}
+        for entry in RevokedDownload.query.all():
+            key = (entry.user_id, entry.firmware_id)
+            revoked[key] = max(revoked.get(key, 0), timestamp(entry.revoked_at))
+        return revoked
+    
+    def is_revoked(self, user_id, firmware_id, issued_at):
+        """Check whether a token issued at `issued_at` was revoked since"""
+        refresh = current_app.config['DOWNLOAD_REVOCATION_REFRESH_SECONDS']
+        if time.time() - self.loaded_at > refresh:
+            with self.lock:
+                if time.time() - self.loaded_at > refresh:
+                    try:
+                        self.revoked = self.load()
+                        self.loaded_at = time.time()
+                    except Exception as e:
+                        # Keep serving with the last known list
+                        logger.error(f"Error loading download revocations: {str(e)}")
+        revoked_at = self.revoked.get((user_id, firmware_id))
+        return revoked_at is not None and issued_at <= revoked_at
+
+revocations = RevocationList()
+
+def revoke_downloads(user_id, firmware_id, reason=None):
+    """Invalidate every token issued so far for a purchase, e.g. on refund"""
+    entry = RevokedDownload(
+        user_id=user_id,
+        firmware_id=firmware_id,
+        reason=reason,
+        revoked_at=datetime.utcnow()
+    )
+    db.session.add(entry)
+    revocations.invalidate()
+    return entry
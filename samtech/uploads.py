@@ -0,0 +1,420 @@
+from flask import Blueprint, request, jsonify, current_app, url_for
+from flask_login import login_required, current_user
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
+from datetime import datetime, timedelta
+from . import db
+from .models import Firmware, UploadSession, UploadChunk
+from .blobs import CHUNK_SIZE, blob_key, hash_file, place_blob, blob_record, acquire_blob, discard_blob
+from .deltas import schedule_deltas
+from .search import index_firmware
+from .devices import set_device_codes
+from .versions import set_version_fields, latest_group, refresh_latest
+from .pagecache import invalidate_firmware
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+# Resumable (tus-style) firmware uploads. A session preallocates one
+# part file; chunks are written into it at their offset, in any order and
+# in parallel. Finalizing hashes it in a background thread and links it
+# into the blob store without a copy; the client polls the session.
+uploads = Blueprint('uploads', __name__)
+
+def part_path(session_id):
+    """Return the path of the file a session's chunks are written to"""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp', f"{session_id}.part")
+
+def received_offset(session, indexes):
+    """Return how many bytes from the start of the file have been received"""
+    index = 0
+    while index in indexes:
+        index += 1
+    return min(index * session.chunk_size, session.size)
+
+def session_status(session):
+    """Describe an upload session for API responses"""
+    indexes = {chunk.index for chunk in session.chunks}
+    return {
+        'id': session.id,
+        'filename': session.filename,
+        'size': session.size,
+        'chunk_size': session.chunk_size,
+        'chunk_count': session.chunk_count,
+        'offset': received_offset(session, indexes),
+        'missing': [i for i in range(session.chunk_count) if i not in indexes],
+        'status': session.status,
+        'sha256': session.blob_digest,
+        'firmware_id': session.firmware_id,
+        'error': session.error,
+        'expires_at': session.expires_at.isoformat()
+    }
+
+def get_open_session(id):
+    """Return an upload session that still accepts data, or None"""
+    session = db.session.get(UploadSession, id)
+    if not session or session.status != 'open' or session.expires_at < datetime.utcnow():
+        return None
+    return session
+
+def expire_sessions():
+    """Remove upload sessions that were abandoned"""
+    expired = UploadSession.query.filter(
+        UploadSession.status.in_(['open', 'finalizing']),
+        UploadSession.expires_at < datetime.utcnow()
+    ).all()
+    for session in expired:
+        path = part_path(session.id)
+        if os.path.exists(path):
+            os.remove(path)
+        db.session.delete(session)
+    if expired:
+        db.session.commit()
+
+def write_chunk(session, index):
+    """Write the request body as chunk `index` of a session"""
+    expected_length = session.chunk_length(index)
+    if request.content_length != expected_length:
+        return jsonify({
+            'status': 'error',
+            'message': f'Chunk {index} must be {expected_length} bytes.'
+        }), 400
+    
+    # Write the chunk in place at its offset, hashing it on the way
+    stream = get_input_stream(request.environ, max_content_length=session.chunk_size)
+    sha256 = hashlib.sha256()
+    written = 0
+    try:
+        with open(part_path(session.id), 'r+b') as out:
+            out.seek(index * session.chunk_size)
+            while True:
+                data = stream.read(CHUNK_SIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                out.write(data)
+                written += len(data)
+    except ClientDisconnected:
+        written = -1
+    except FileNotFoundError:
+        # Expired, or finalized by a parallel request
+        return jsonify({'status': 'error', 'message': 'Upload not found or expired'}), 404
+    
+    digest = sha256.hexdigest()
+    expected = request.headers.get('X-Chunk-SHA256', '').strip().lower()
+    if written != expected_length or (expected and expected != digest):
+        # Nothing is recorded, so the chunk is simply sent again
+        return jsonify({'status': 'error', 'message': f'Chunk {index} was not received intact.'}), 400
+    
+    chunk = db.session.get(UploadChunk, (session.id, index))
+    if chunk is None:
+        db.session.add(UploadChunk(session_id=session.id, index=index, size=written, sha256=digest))
+    else:
+        chunk.sha256 = digest
+        chunk.received_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same chunk was recorded by a parallel retry
+        db.session.rollback()
+    
+    return jsonify({'status': 'success', 'data': {'index': index, 'sha256': digest}})
+
+def reopen_session(id, error=None):
+    """Let a session that failed to finalize be finalized again"""
+    db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.id == id, UploadSession.status == 'finalizing')
+        .values(status='open', error=error)
+    )
+    db.session.commit()
+
+def reopen_stale_sessions():
+    """Reopen sessions whose finalizing worker died"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_FINALIZE_TIMEOUT_SECONDS'])
+    db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.status == 'finalizing', UploadSession.finalize_started_at < cutoff)
+        .values(status='open', error='Finalizing was interrupted; finalize the upload again.')
+    )
+    db.session.commit()
+
+def firmware_fields(data):
+    """Validate the firmware details sent with a finalize request"""
+    name = str(data.get('name', '')).strip()
+    version = str(data.get('version', '')).strip()
+    description = str(data.get('description', '')).strip()
+    features = str(data.get('features', '')).strip()
+    
+    if not all([name, version, description, data.get('brand_id')]):
+        return None, 'Name, version, description and brand are required.'
+    try:
+        price = float(data.get('price', 0))
+        if price < 0:
+            raise ValueError("Price cannot be negative")
+        brand_id = int(data.get('brand_id'))
+    except (TypeError, ValueError):
+        return None, 'Invalid price or brand.'
+    
+    return {
+        'name': name,
+        'version': version,
+        'description': description,
+        'features': features,
+        'price': price,
+        'brand_id': brand_id
+    }, None
+
+@uploads.route('/', methods=['POST'])
+@login_required
+def create_session():
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(str(data.get('filename', '')))
+    sha256 = str(data.get('sha256') or '').strip().lower() or None
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    
+    if not filename or size <= 0:
+        return jsonify({'status': 'error', 'message': 'filename and size are required.'}), 400
+    
+    max_size = current_app.config['FIRMWARE_MAX_SIZE']
+    if size > max_size:
+        return jsonify({
+            'status': 'error',
+            'message': f'Firmware files are limited to {max_size // (1024 * 1024)} MB.'
+        }), 413
+    
+    expire_sessions()
+    
+    session = UploadSession(
+        id=str(uuid.uuid4()),
+        filename=filename,
+        size=size,
+        chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+        sha256=sha256,
+        creator_id=current_user.id,
+        expires_at=datetime.utcnow() + timedelta(hours=current_app.config['UPLOAD_SESSION_HOURS'])
+    )
+    
+    # Preallocate the part file; unwritten regions stay sparse
+    path = part_path(session.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    
+    db.session.add(session)
+    db.session.commit()
+    
+    response = jsonify({'status': 'success', 'data': session_status(session)})
+    response.headers['Location'] = url_for('uploads.get_session', id=session.id)
+    return response, 201
+
+@uploads.route('/<id>', methods=['GET'])
+@login_required
+def get_session(id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    reopen_stale_sessions()
+    session = db.session.get(UploadSession, id)
+    if not session:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+    
+    # HEAD requests get the tus offset headers without the body
+    status = session_status(session)
+    response = jsonify({'status': 'success', 'data': status})
+    response.headers['Upload-Offset'] = str(status['offset'])
+    response.headers['Upload-Length'] = str(session.size)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@uploads.route('/<id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def put_chunk(id, index):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    session = get_open_session(id)
+    if not session:
+        return jsonify({'status': 'error', 'message': 'Upload not found or expired'}), 404
+    if index < 0 or index >= session.chunk_count:
+        return jsonify({'status': 'error', 'message': 'Invalid chunk index'}), 400
+    
+    return write_chunk(session, index)
+
+@uploads.route('/<id>', methods=['PATCH'])
+@login_required
+def patch_session(id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    session = get_open_session(id)
+    if not session:
+        return jsonify({'status': 'error', 'message': 'Upload not found or expired'}), 404
+    
+    # tus-style append: the offset addresses a whole chunk
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None or offset < 0 or offset >= session.size or offset % session.chunk_size:
+        return jsonify({
+            'status': 'error',
+            'message': f'Upload-Offset must be a multiple of {session.chunk_size}.'
+        }), 409
+    
+    response = write_chunk(session, offset // session.chunk_size)
+    if isinstance(response, tuple):
+        return response
+    indexes = {chunk.index for chunk in session.chunks}
+    response.headers['Upload-Offset'] = str(received_offset(session, indexes))
+    return response
+
+@uploads.route('/<id>/finalize', methods=['POST'])
+@login_required
+def finalize_session(id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    reopen_stale_sessions()
+    session = get_open_session(id)
+    if not session:
+        return jsonify({'status': 'error', 'message': 'Upload not found or expired'}), 404
+    
+    status = session_status(session)
+    if status['missing']:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload is incomplete.',
+            'data': status
+        }), 409
+    
+    # Without firmware details only the blob is kept, so a form can
+    # reference it via blob_digest
+    data = request.get_json(silent=True) or request.form
+    details = None
+    if data.get('name'):
+        fields, error = firmware_fields(data)
+        if error:
+            return jsonify({'status': 'error', 'message': error}), 400
+        details = json.dumps({
+            'fields': fields,
+            'device_codes': {name: data.get(name) for name in ('model_code', 'region', 'build_id')}
+        })
+    
+    # Only one request finalizes a session
+    claimed = db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.id == id, UploadSession.status == 'open')
+        .values(status='finalizing', finalize_started_at=datetime.utcnow(), error=None, details=details)
+    )
+    db.session.commit()
+    if not claimed.rowcount:
+        return jsonify({'status': 'error', 'message': 'Upload is already being finalized.'}), 409
+    
+    # Hashing a large file takes longer than a request should
+    thread = threading.Thread(target=finalize_upload, args=(current_app._get_current_object(), id),
+                              name='upload-finalize', daemon=True)
+    thread.start()
+    
+    db.session.refresh(session)
+    response = jsonify({'status': 'success', 'data': session_status(session)})
+    response.headers['Location'] = url_for('uploads.get_session', id=id)
+    return response, 202
+
+def finalize_upload(app, id):
+    """Finalize a claimed session in the background"""
+    with app.app_context():
+        try:
+            complete_session(id)
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error finalizing upload {id}: {str(e)}")
+            reopen_session(id, 'An error occurred while finalizing the upload.')
+        finally:
+            db.session.remove()
+
+def complete_session(id):
+    """Hash a session's part file and store it as a blob, and as firmware if details were sent"""
+    session = db.session.get(UploadSession, id)
+    if not session or session.status != 'finalizing':
+        return
+    
+    path = part_path(session.id)
+    try:
+        hasher = hash_file(path)
+    except FileNotFoundError:
+        reopen_session(id, 'Upload not found or expired')
+        return
+    digest = hasher.digest
+    if hasher.size != session.size or (session.sha256 and session.sha256 != digest):
+        reopen_session(id, 'Checksum mismatch.')
+        return
+    
+    details = json.loads(session.details) if session.details else None
+    firmware = None
+    try:
+        # Hard-linked into the store; the part file is only removed once the
+        # rows are committed, so a failed finalize can be retried
+        place_blob(path, digest, keep=True)
+        blob = blob_record(hasher)
+        session.status = 'complete'
+        session.blob_digest = digest
+        
+        if details:
+            acquire_blob(blob)
+            firmware = Firmware(
+                filename=blob_key(blob.digest),
+                original_filename=session.filename,
+                blob_digest=blob.digest,
+                size=blob.size,
+                creator_id=session.creator_id,
+                **details['fields']
+            )
+            set_device_codes(firmware, details['device_codes'])
+            set_version_fields(firmware)
+            db.session.add(firmware)
+            db.session.flush()
+            session.firmware_id = firmware.id
+        
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # Drops the stored copy unless a committed blob row owns it
+        discard_blob(digest)
+        raise
+    
+    try:
+        os.remove(path)
+    except OSError as e:
+        current_app.logger.error(f"Error removing upload part file: {str(e)}")
+    
+    if firmware:
+        schedule_deltas(firmware)
+        index_firmware(firmware)
+        refresh_latest(latest_group(firmware))
+        invalidate_firmware(firmware.id, firmware.brand_id)
+
+@uploads.route('/<id>', methods=['DELETE'])
+@login_required
+def delete_session(id):
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    session = db.session.get(UploadSession, id)
+    if not session:
+        return jsonify({'status': 'error', 'message': 'Upload not found'}), 404
+    
+    path = part_path(session.id)
+    if session.status == 'open' and os.path.exists(path):
+        os.remove(path)
+    db.session.delete(session)
+    db.session.commit()
+    return jsonify({'status': 'success'})
@@ -0,0 +1,142 @@
+"""Version ordering and the latest build of each model.
+
+Version strings are free-form, so each firmware also stores a version
+key that sorts like the versions themselves:
+
+- Samsung builds (A525FXXU4CVJB) compare by their last five characters:
+  bootloader, major version, year, month and build letters, which are
+  already in ASCII order.
+- Anything else is split into numbers, compared by value, and words,
+  with alpha/beta/rc/pre/dev sorting before the release they precede:
+  1.0-beta < 1.0 < 1.0a < 1.0.1 < 1.2 < 1.10.
+
+Firmware of one brand, model (series) and region form a group, and the
+latest_firmware table holds the newest build of each group. The admin
+views refresh the groups they touch, so brand pages and the API read the
+newest builds from a single index.
+"""
+from datetime import datetime
+from . import db
+from .devices import SAMSUNG_BUILD, normalize_code
+from .models import Firmware, LatestFirmware
+from .pagination import paginate
+from .shared import shared
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+PRE_RELEASE = {'alpha', 'beta', 'rc', 'pre', 'preview', 'dev', 'snapshot'}
+KEY_LENGTH = 64
+
+def version_key(version, build_id=None):
+    """Return a string that sorts versions of one model in release order"""
+    if build_id:
+        match = SAMSUNG_BUILD.match(build_id)
+        if match:
+            return 'S' + build_id[-5:]
+    
+    parts = []
+    # v2.1 is version 2.1
+    version = re.sub(r'^[vV](?=\d)', '', (version or '').strip())
+    words = re.findall(r'\d+|[A-Za-z]+', version)
+    for index, part in enumerate(words):
+        if part.isdigit():
+            digits = part.lstrip('0') or '0'
+            # The length first, so 10 sorts after 9
+            parts.append(f'3{len(digits):02d}{digits}')
+        elif part.lower() in PRE_RELEASE and index > 0:
+            parts.append('0' + part.lower())
+        else:
+            parts.append('2' + part.lower())
+    # Ending sorts after pre-releases and before further parts
+    parts.append('1')
+    return 'V' + '.'.join(parts)[:KEY_LENGTH - 1]
+
+def series_of(firmware):
+    """Return the model a firmware is a version of"""
+    return (firmware.model_key or normalize_code(firmware.name) or '')[:100]
+
+def set_version_fields(firmware):
+    """Fill a firmware's version key and series; call after set_device_codes"""
+    firmware.version_key = version_key(firmware.version, firmware.build_id)
+    firmware.series = series_of(firmware)
+
+def latest_group(firmware):
+    """Return the (brand, series, region) group of a firmware"""
+    return (firmware.brand_id, firmware.series or series_of(firmware), firmware.region or '')
+
+def newest_in_group(brand_id, series, region):
+    query = Firmware.query.filter(Firmware.brand_id == brand_id, Firmware.series == series)
+    query = query.filter(Firmware.region == region if region else Firmware.region.is_(None))
+    return query.order_by(
+        Firmware.version_key.desc().nulls_last(),
+        Firmware.created_at.desc(),
+        Firmware.id.desc()
+    ).first()
+
+def refresh_group(brand_id, series, region):
+    """Point a group's latest_firmware row at its newest build, or drop it"""
+    newest = newest_in_group(brand_id, series, region)
+    row = LatestFirmware.query.filter_by(brand_id=brand_id, series=series, region=region).first()
+    if newest is None:
+        if row is not None:
+            db.session.delete(row)
+        return
+    if row is None:
+        row = LatestFirmware(brand_id=brand_id, series=series, region=region)
+        db.session.add(row)
+    row.firmware_id = newest.id
+    row.version_key = newest.version_key
+    row.updated_at = datetime.utcnow()
+
+def refresh_latest(*groups):
+    """Refresh the latest build of the given groups; call after commit"""
+    try:
+        for group in set(groups):
+            if group[1]:
+                refresh_group(*group)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error refreshing latest firmware: {str(e)}")
+
+def latest_builds(brand_id=None, series=None, region=None, after=None, before=None, per_page=50):
+    """Return a KeysetPage of the newest firmware of each model, by model and region
+    
+    The page is read from the covering index of latest_firmware; only the
+    firmware rows being shown are loaded.
+    """
+    query = db.session.query(LatestFirmware.brand_id, LatestFirmware.series,
+                             LatestFirmware.region, LatestFirmware.firmware_id)
+    if brand_id is not None:
+        query = query.filter(LatestFirmware.brand_id == brand_id)
+    if series:
+        query = query.filter(LatestFirmware.series == series)
+    if region is not None:
+        query = query.filter(LatestFirmware.region == region)
+    page = paginate(query, [LatestFirmware.brand_id, LatestFirmware.series, LatestFirmware.region],
+                    after=after, before=before, per_page=per_page, descending=False)
+    ids = [row.firmware_id for row in page.items]
+    firmwares = {firmware.id: firmware for firmware in Firmware.query.filter(Firmware.id.in_(ids)).all()}
+    page.items = [firmwares[id] for id in ids if id in firmwares]
+    return page
+
+def backfill_versions(batch_size=500):
+    """Fill version keys for the next batch of firmware; returns rows scanned
+    
+    Progress is kept in the shared store, so an interrupted backfill
+    carries on where it stopped.
+    """
+    checkpoint = 'version-keys-backfill'
+    last_id = shared.get(checkpoint, 0)
+    firmwares = Firmware.query.filter(Firmware.id > last_id).order_by(Firmware.id).limit(batch_size).all()
+    groups = set()
+    for firmware in firmwares:
+        set_version_fields(firmware)
+        groups.add(latest_group(firmware))
+    db.session.commit()
+    refresh_latest(*groups)
+    if firmwares:
+        shared.set(checkpoint, firmwares[-1].id)
+    return len(firmwares)
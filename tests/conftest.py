@@ -0,0 +1,48 @@
+import os
+import pytest
+from datetime import datetime, timedelta
+from samtech import create_app, db
+from samtech.models import Brand, DownloadToken, Firmware, User
+
+@pytest.fixture
+def app(tmp_path):
+    upload_folder = tmp_path / 'uploads'
+    upload_folder.mkdir()
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'samtech.db'}",
+        'UPLOAD_FOLDER': str(upload_folder),
+        'SHARED_STATE_DIR': str(tmp_path / 'shared'),
+        'STORAGE_BACKEND': 'local',
+        'PAGE_CACHE_ENABLED': False
+    })
+    with app.app_context():
+        yield app
+        db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def user(app):
+    return User.query.filter_by(username='samtech').first()
+
+@pytest.fixture
+def firmware(app, user):
+    """A legacy (non-blob) firmware file of 10240 known bytes"""
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'fw.bin'), 'wb') as f:
+        f.write(bytes(range(256)) * 40)
+    firmware = Firmware(name='Galaxy A52', version='1.0', filename='fw.bin', size=10240,
+                        brand_id=Brand.query.first().id, creator_id=user.id)
+    db.session.add(firmware)
+    db.session.commit()
+    return firmware
+
+@pytest.fixture
+def download_token(firmware, user):
+    token = DownloadToken(token='test-token', firmware_id=firmware.id, user_id=user.id,
+                          expires_at=datetime.utcnow() + timedelta(hours=1))
+    db.session.add(token)
+    db.session.commit()
+    return token
@@ -0,0 +1,60 @@
+import pytest
+from samtech.admission import admit, admission_stats
+
+@pytest.fixture
+def url(firmware, download_token):
+    return f'/firmware/{firmware.id}/download/{download_token.token}'
+
+def test_saturated_downloads_get_retry_after(app, client, url, user):
+    app.config['DOWNLOAD_MAX_STREAMS'] = 1
+    ticket, _ = admit(user.id + 1, 99)
+    assert ticket is not None
+    
+    response = client.get(url, headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app.config['DOWNLOAD_RETRY_AFTER_SECONDS'])
+    assert response.headers['Cache-Control'] == 'no-store'
+    
+    ticket.release()
+    assert client.get(url, headers={'Range': 'bytes=0-9'}).status_code == 206
+
+def test_browsers_get_a_queue_page(app, client, url, user):
+    app.config['DOWNLOAD_MAX_STREAMS'] = 1
+    ticket, _ = admit(user.id + 1, 99)
+    
+    response = client.get(url, headers={'Accept': 'text/html'})
+    assert response.status_code == 503
+    assert b'Galaxy A52' in response.data
+    ticket.release()
+
+def test_per_user_limit(app, user):
+    app.config['DOWNLOAD_MAX_STREAMS_PER_USER'] = 1
+    ticket, _ = admit(user.id, 1)
+    assert admit(user.id, 2) == (None, f'user-{user.id}')
+    # Other users are not held back
+    other, _ = admit(user.id + 1, 2)
+    assert other is not None
+    ticket.release()
+    other.release()
+
+def test_waiting_clients_go_first(app):
+    app.config['DOWNLOAD_MAX_STREAMS'] = 1
+    ticket, _ = admit(1, 1)
+    assert admit(2, 1) == (None, 'global')
+    ticket.release()
+    
+    # A slot is free, but client 2 was waiting for it
+    assert admit(3, 1) == (None, 'global')
+    assert admission_stats()['queue_depth'] == 2
+    first, _ = admit(2, 1)
+    assert first is not None
+    first.release()
+
+def test_finished_streams_free_their_slot(app, client, url):
+    app.config['DOWNLOAD_MAX_STREAMS'] = 1
+    for _ in range(2):
+        # The server closes the body once it has been sent
+        with client.get(url) as response:
+            assert response.status_code == 200
+            assert admission_stats()['active_streams'] == 1
+    assert admission_stats()['active_streams'] == 0
@@ -0,0 +1,65 @@
+import hashlib
+import io
+import pytest
+from datetime import datetime, timedelta
+from samtech import db
+from samtech.blobs import blob_key, collect_unreferenced_blobs, store_blob
+from samtech.models import Brand, Firmware, FirmwareBlob
+from samtech.storage import storage
+
+CONTENT = b'firmware image ' * 1000
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+@pytest.fixture
+def admin(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+def add_firmware(client, version):
+    response = client.post('/admin/firmware/add', data={
+        'name': 'Galaxy S21',
+        'version': version,
+        'description': 'Stock firmware',
+        'brand_id': str(Brand.query.first().id),
+        'price': '100',
+        'firmware_file': (io.BytesIO(CONTENT), 'S21.tar.md5')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+    return Firmware.query.filter_by(version=version).one()
+
+def test_identical_uploads_share_a_blob(admin):
+    first = add_firmware(admin, 'G991BXXU1')
+    second = add_firmware(admin, 'G991BXXU2')
+    assert first.blob_digest == second.blob_digest == DIGEST
+    assert first.filename == blob_key(DIGEST)
+    assert db.session.get(FirmwareBlob, DIGEST).ref_count == 2
+    with storage.open(blob_key(DIGEST)) as f:
+        assert f.read() == CONTENT
+
+def test_blob_is_kept_until_its_last_firmware_is_deleted(admin):
+    first = add_firmware(admin, 'G991BXXU1')
+    second = add_firmware(admin, 'G991BXXU2')
+    
+    admin.post(f'/admin/firmware/{first.id}/delete')
+    db.session.expire_all()
+    assert db.session.get(FirmwareBlob, DIGEST).ref_count == 1
+    assert storage.exists(blob_key(DIGEST))
+    
+    admin.post(f'/admin/firmware/{second.id}/delete')
+    db.session.expire_all()
+    assert db.session.get(FirmwareBlob, DIGEST) is None
+    assert not storage.exists(blob_key(DIGEST))
+
+def test_unreferenced_blobs_are_collected_after_a_grace_period(app):
+    old = store_blob(io.BytesIO(b'abandoned upload'))
+    old.created_at = datetime.utcnow() - timedelta(days=2)
+    recent = store_blob(io.BytesIO(b'upload in progress'))
+    db.session.commit()
+    old_digest, recent_digest = old.digest, recent.digest
+    
+    assert collect_unreferenced_blobs(timedelta(days=1)) == 1
+    assert db.session.get(FirmwareBlob, old_digest) is None
+    assert not storage.exists(blob_key(old_digest))
+    assert storage.exists(blob_key(recent_digest))
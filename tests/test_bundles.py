@@ -0,0 +1,45 @@
+import io
+import pytest
+import uuid
+import zipfile
+from datetime import datetime
+from samtech import db
+from samtech.manifests import record_manifest
+from samtech.models import Payment
+
+@pytest.fixture
+def paid(firmware, user, client):
+    payment = Payment(reference=f'FW{uuid.uuid4().hex[:10].upper()}', amount=100, phone_number='254712345678',
+                      firmware_id=firmware.id, user_id=user.id)
+    payment.status = 'completed'
+    payment.completed_at = datetime.utcnow()
+    db.session.add(payment)
+    db.session.commit()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return firmware
+
+def test_bundle_waits_for_crc(client, paid):
+    # Legacy files are hashed offline, never in the request
+    response = client.get(f'/firmware/bundle?ids={paid.id}')
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+
+def test_bundle_opens(client, paid):
+    record_manifest(paid)
+    response = client.get(f'/firmware/bundle?ids={paid.id}')
+    assert response.status_code == 200
+    assert int(response.headers['Content-Length']) == len(response.data)
+    
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    [name] = archive.namelist()
+    assert archive.read(name) == bytes(range(256)) * 40
+
+def test_bundle_range(client, paid):
+    record_manifest(paid)
+    whole = client.get(f'/firmware/bundle?ids={paid.id}').data
+    response = client.get(f'/firmware/bundle?ids={paid.id}', headers={'Range': 'bytes=100-5099'})
+    assert response.status_code == 206
+    assert response.data == whole[100:5100]
@@ -0,0 +1,24 @@
+from samtech import db
+from samtech.conditional import touch_brand
+
+def test_firmware_page_revalidates(client, firmware):
+    response = client.get(f'/firmware/{firmware.id}')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    
+    response = client.get(f'/firmware/{firmware.id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+def test_firmware_page_changes_with_its_brand(client, firmware):
+    etag = client.get(f'/firmware/{firmware.id}').headers['ETag']
+    touch_brand(firmware.brand_id)
+    db.session.commit()
+    assert client.get(f'/firmware/{firmware.id}', headers={'If-None-Match': etag}).status_code == 200
+
+def test_brand_page_revalidates(client, firmware):
+    etag = client.get(f'/brand/{firmware.brand_id}').headers['ETag']
+    assert client.get(f'/brand/{firmware.brand_id}', headers={'If-None-Match': etag}).status_code == 304
+
+def test_missing_firmware(client):
+    assert client.get('/firmware/999999').status_code == 404
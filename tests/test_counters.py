@@ -0,0 +1,58 @@
+import pytest
+from collections import Counter
+from samtech import db
+from samtech.counters import download_counter
+from samtech.models import DownloadToken, Firmware
+
+@pytest.fixture
+def counter(app, monkeypatch):
+    # Flushed by the tests, not by the background thread
+    monkeypatch.setattr(download_counter, 'start', lambda: None)
+    monkeypatch.setattr(download_counter, 'batch', 1000)
+    # Downloads made by other tests' requests are still buffered
+    monkeypatch.setattr(download_counter, 'tokens', Counter())
+    monkeypatch.setattr(download_counter, 'firmwares', Counter())
+    monkeypatch.setattr(download_counter, 'pending', 0)
+    return download_counter
+
+def test_downloads_are_buffered_then_flushed(counter, firmware, download_token):
+    for _ in range(3):
+        counter.record(download_token.id, firmware.id)
+    counter.record(None, firmware.id)
+    db.session.expire_all()
+    assert not db.session.get(Firmware, firmware.id).downloads
+    
+    counter.flush()
+    db.session.expire_all()
+    assert db.session.get(Firmware, firmware.id).downloads == 4
+    assert db.session.get(DownloadToken, download_token.id).download_count == 3
+
+def test_counts_are_not_edits(counter, firmware):
+    updated_at = firmware.updated_at
+    counter.record(None, firmware.id)
+    counter.flush()
+    db.session.expire_all()
+    assert db.session.get(Firmware, firmware.id).updated_at == updated_at
+
+def test_failed_flushes_keep_their_counts(counter, firmware, monkeypatch):
+    counter.record(None, firmware.id)
+    commit = db.session.commit
+    
+    def failing_commit():
+        monkeypatch.setattr(db.session, 'commit', commit)
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(db.session, 'commit', failing_commit)
+    counter.flush()
+    assert counter.firmwares[firmware.id] == 1
+    
+    counter.flush()
+    db.session.expire_all()
+    assert db.session.get(Firmware, firmware.id).downloads == 1
+
+def test_full_batches_wake_the_flusher(counter, firmware, monkeypatch):
+    monkeypatch.setattr(counter, 'batch', 2)
+    counter.wakeup.clear()
+    counter.record(None, firmware.id)
+    assert not counter.wakeup.is_set()
+    counter.record(None, firmware.id)
+    assert counter.wakeup.is_set()
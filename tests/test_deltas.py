@@ -0,0 +1,94 @@
+import hashlib
+import os
+import pytest
+import random
+from apply_delta import apply_delta
+from samtech import db
+from samtech.blobs import blob_key
+from samtech.deltas import build_pending_deltas, delta_key, write_block_delta
+from samtech.models import FirmwareBlob, FirmwareDelta
+from samtech.storage import storage
+
+BLOCK_SIZE = 4096
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+@pytest.fixture
+def versions():
+    rng = random.Random(1)
+    source = rng.randbytes(256 * 1024)
+    # Bytes inserted near the start shift every block after them
+    target = b'new header' + source[:100000] + rng.randbytes(5000) + source[100000:]
+    return source, target
+
+def make_patch(tmp_path, source, target):
+    source_path = tmp_path / 'old.bin'
+    target_path = tmp_path / 'new.bin'
+    patch_path = tmp_path / 'patch.sdlt'
+    source_path.write_bytes(source)
+    target_path.write_bytes(target)
+    with open(patch_path, 'wb') as out:
+        write_block_delta(source_path, target_path, out, BLOCK_SIZE, sha256(source), sha256(target))
+    return source_path, patch_path
+
+def test_block_delta_round_trips(tmp_path, versions):
+    source, target = versions
+    source_path, patch_path = make_patch(tmp_path, source, target)
+    # Shifted blocks are still found, so only the new bytes are sent
+    assert patch_path.stat().st_size < 3 * BLOCK_SIZE
+    
+    output_path = tmp_path / 'out.bin'
+    assert apply_delta(source_path, patch_path, output_path) == sha256(target)
+    assert output_path.read_bytes() == target
+
+@pytest.mark.parametrize('target', [b'', b'short', bytes(3 * BLOCK_SIZE + 7)])
+def test_block_delta_without_matches(tmp_path, target):
+    source = random.Random(2).randbytes(2 * BLOCK_SIZE)
+    source_path, patch_path = make_patch(tmp_path, source, target)
+    output_path = tmp_path / 'out.bin'
+    apply_delta(source_path, patch_path, output_path)
+    assert output_path.read_bytes() == target
+
+def test_apply_delta_checks_the_source(tmp_path, versions):
+    source, target = versions
+    source_path, patch_path = make_patch(tmp_path, source, target)
+    source_path.write_bytes(source[:-1] + b'x')
+    with pytest.raises(ValueError):
+        apply_delta(source_path, patch_path, tmp_path / 'out.bin')
+
+def add_pair(app, source, target):
+    for data in (source, target):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], 'staged')
+        with open(path, 'wb') as f:
+            f.write(data)
+        storage.put_file(blob_key(sha256(data)), path)
+        db.session.add(FirmwareBlob(digest=sha256(data), size=len(data), ref_count=1))
+    delta = FirmwareDelta(source_digest=sha256(source), target_digest=sha256(target))
+    db.session.add(delta)
+    db.session.commit()
+    return delta.id
+
+def test_build_pending_deltas(app, tmp_path, versions):
+    app.config['DELTA_TOOL'] = 'blocks'
+    source, target = versions
+    delta_id = add_pair(app, source, target)
+    assert build_pending_deltas(1) == 1
+    
+    delta = db.session.get(FirmwareDelta, delta_id)
+    assert delta.status == 'ready'
+    output_path = tmp_path / 'out.bin'
+    with storage.local_copy(delta_key(delta)) as patch_path:
+        (tmp_path / 'old.bin').write_bytes(source)
+        apply_delta(tmp_path / 'old.bin', patch_path, output_path)
+    assert output_path.read_bytes() == target
+
+def test_large_pairs_skip_block_patches(app, versions):
+    app.config['DELTA_TOOL'] = 'blocks'
+    app.config['DELTA_BLOCKS_MAX_SIZE'] = 100 * 1024
+    delta_id = add_pair(app, *versions)
+    assert build_pending_deltas(1) == 1
+    
+    delta = db.session.get(FirmwareDelta, delta_id)
+    assert delta.status == 'skipped'
+    assert 'xdelta3' in delta.error
@@ -0,0 +1,67 @@
+import pytest
+from samtech import db
+from samtech.devices import backfill_device_codes, extract_device_codes, set_device_codes
+from samtech.models import Brand, Firmware
+
+@pytest.mark.parametrize('name, version, filename, expected', [
+    ('Galaxy A52', 'A525FXXU4CVJB', 'A525FXXU4CVJB_A525FOXM4CVJB_KEN.zip', ('SM-A525F', 'KEN', 'A525FXXU4CVJB')),
+    ('Galaxy A52 SM-A525F', '13', 'firmware.zip', ('SM-A525F', None, None)),
+    ('Moto G8 XT-2041', '1.0', 'moto.zip', ('XT-2041', None, None)),
+    ('Pixel 4', 'QP1A.190711.020', 'flame.zip', (None, None, 'QP1A.190711.020')),
+    ('Smart TV', '1.0', 'tv.bin', (None, None, None)),
+])
+def test_extract_device_codes(name, version, filename, expected):
+    codes = extract_device_codes(name, version, filename)
+    assert (codes['model_code'], codes['region'], codes['build_id']) == expected
+
+@pytest.fixture
+def catalog(app, user):
+    samsung = Brand.query.filter_by(name='Samsung').one()
+    firmwares = []
+    for name, version, filename in [
+        ('Galaxy A52', 'A525FXXU4CVJB', 'A525FXXU4CVJB_A525FOXM4CVJB_KEN.zip'),
+        ('Galaxy A52', 'A525FXXU4CVJB', 'A525FXXU4CVJB_A525FOJM4CVJB_XSG.zip'),
+        ('Galaxy A53', 'A536BXXU4BVJG', 'A536BXXU4BVJG_A536BOXM4BVJG_KEN.zip'),
+    ]:
+        firmware = Firmware(name=name, version=version, description='Stock firmware', filename=filename,
+                            original_filename=filename, brand_id=samsung.id, creator_id=user.id)
+        set_device_codes(firmware)
+        firmwares.append(firmware)
+    db.session.add_all(firmwares)
+    db.session.commit()
+    return firmwares
+
+def lookup(client, **params):
+    response = client.get('/firmware/lookup', query_string=params)
+    assert response.status_code == 200
+    return [(row['model_code'], row['region']) for row in response.json['data']['results']]
+
+def test_exact_lookup(client, catalog):
+    # Dashes and case do not matter
+    assert lookup(client, model='sm-a525f', region='ken') == [('SM-A525F', 'KEN')]
+    assert lookup(client, model='SMA525F') == [('SM-A525F', 'XSG'), ('SM-A525F', 'KEN')]
+    assert lookup(client, model='SM-A52') == []
+    assert lookup(client, build='A536BXXU4BVJG') == [('SM-A536B', 'KEN')]
+
+def test_prefix_lookup(client, catalog):
+    assert len(lookup(client, model='SM-A5', match='prefix')) == 3
+    assert lookup(client, model='SM-A52', region='XSG', match='prefix') == [('SM-A525F', 'XSG')]
+    assert lookup(client, build='A536', match='prefix') == [('SM-A536B', 'KEN')]
+
+def test_lookup_needs_a_code(client, catalog):
+    assert client.get('/firmware/lookup').status_code == 400
+    assert client.get('/firmware/lookup?model=S&match=prefix').status_code == 400
+
+def test_form_codes_win_over_extracted_ones(app, user):
+    firmware = Firmware(name='Galaxy A52', version='A525FXXU4CVJB', filename='fw.bin')
+    set_device_codes(firmware, {'model_code': 'sm-a525m', 'region': 'tpa'})
+    assert (firmware.model_code, firmware.model_key, firmware.region, firmware.build_id) == \
+        ('SM-A525M', 'SMA525M', 'TPA', 'A525FXXU4CVJB')
+
+def test_backfill_fills_rows_without_codes(catalog):
+    firmware = catalog[0]
+    firmware.model_code = firmware.model_key = firmware.region = firmware.build_id = None
+    db.session.commit()
+    assert backfill_device_codes(100) == 3
+    assert (firmware.model_key, firmware.region) == ('SMA525F', 'KEN')
+    assert backfill_device_codes(100) == 0
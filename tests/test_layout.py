@@ -0,0 +1,54 @@
+import os
+import pytest
+from samtech import db
+from samtech.layout import migrate_batch, reset_migration, sharded_path
+from samtech.models import Firmware
+from samtech.storage import storage
+
+def test_sharded_paths_depend_on_the_name_only():
+    path = sharded_path('files', 'fw.bin')
+    assert path == sharded_path('files', 'fw.bin')
+    assert path != sharded_path('files', 'fw2.bin')
+    folder, first, second, name = path.split(os.sep)
+    assert (folder, name) == ('files', 'fw.bin')
+    assert len(first) == len(second) == 2
+
+def test_firmware_files_move_and_still_download(client, firmware, download_token):
+    assert migrate_batch('firmware-files', 100) == (1, 1, 0)
+    assert firmware.filename == sharded_path('files', 'fw.bin')
+    assert storage.exists(firmware.filename)
+    assert not storage.exists('fw.bin')
+    
+    with client.get(f'/firmware/{firmware.id}/download/{download_token.token}') as response:
+        assert response.status_code == 200
+        assert response.data == bytes(range(256)) * 40
+
+def test_runs_resume_from_their_checkpoint(firmware):
+    assert migrate_batch('firmware-files', 100) == (1, 1, 0)
+    assert migrate_batch('firmware-files', 100) == (0, 0, 0)
+    
+    # Sharded paths are left alone when the migration starts over
+    reset_migration('firmware-files')
+    assert migrate_batch('firmware-files', 100) == (1, 0, 0)
+
+def test_missing_files_are_left_as_is(firmware):
+    os.remove(storage.path('fw.bin'))
+    assert migrate_batch('firmware-files', 100) == (1, 0, 1)
+    db.session.expire_all()
+    assert db.session.get(Firmware, firmware.id).filename == 'fw.bin'
+
+@pytest.fixture
+def static_folder(app, tmp_path):
+    static = tmp_path / 'static'
+    (static / 'images' / 'firmware').mkdir(parents=True)
+    app.static_folder = str(static)
+    return static
+
+def test_images_move_under_the_static_folder(static_folder, firmware):
+    (static_folder / 'images' / 'firmware' / 'a52.png').write_bytes(b'png')
+    firmware.image = os.path.join('images', 'firmware', 'a52.png')
+    db.session.commit()
+    
+    assert migrate_batch('firmware-images', 100) == (1, 1, 0)
+    assert firmware.image == sharded_path(os.path.join('images', 'firmware'), 'a52.png')
+    assert (static_folder / firmware.image).read_bytes() == b'png'
@@ -0,0 +1,60 @@
+import hashlib
+import io
+import os
+import pytest
+from samtech import db
+from samtech.blobs import blob_key, store_blob
+from samtech.manifests import ContentHasher, backfill_manifests, manifest_root
+from samtech.shared import shared
+
+DATA = bytes(range(256)) * 40
+
+@pytest.fixture
+def url(app, firmware, download_token):
+    app.config['MANIFEST_CHUNK_SIZE'] = 4096
+    return f'/firmware/{firmware.id}/manifest/{download_token.token}'
+
+def test_hasher_matches_hashlib(app):
+    hasher = ContentHasher(chunk_size=4096)
+    # Reads that do not line up with chunk boundaries
+    for start in range(0, len(DATA), 1000):
+        hasher.update(DATA[start:start + 1000])
+    assert hasher.digest == hashlib.sha256(DATA).hexdigest()
+    assert hasher.chunk_digests == b''.join(
+        hashlib.sha256(DATA[start:start + 4096]).digest() for start in range(0, len(DATA), 4096))
+
+def test_legacy_files_wait_for_the_backfill(client, url, firmware):
+    response = client.get(url)
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    
+    assert backfill_manifests(100) == 1
+    response = client.get(url)
+    assert response.status_code == 200
+    data = response.json['data']
+    assert data['sha256'] == hashlib.sha256(DATA).hexdigest()
+    assert data['chunk_count'] == 3
+    assert data['chunks'][2] == hashlib.sha256(DATA[8192:]).hexdigest()
+    assert data['root'] == manifest_root(b''.join(bytes.fromhex(chunk) for chunk in data['chunks']))
+    
+    # Progress is kept, so a second run has nothing left to scan
+    assert backfill_manifests(100) == 0
+    assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_replaced_legacy_file_loses_its_manifest(app, client, url, firmware):
+    backfill_manifests(100)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'fw.bin')
+    with open(path, 'wb') as f:
+        f.write(b'replaced' * 100)
+    assert client.get(url).status_code == 503
+
+def test_blob_manifests_are_recorded_on_upload(app, client, url, firmware):
+    blob = store_blob(io.BytesIO(DATA))
+    firmware.blob_digest = blob.digest
+    firmware.filename = blob_key(blob.digest)
+    db.session.commit()
+    assert shared.get(f'manifest:fw{firmware.id}') is None
+    
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json['data']['root'] == blob.manifest_root
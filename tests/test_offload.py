@@ -0,0 +1,35 @@
+import pytest
+from samtech.counters import download_counter
+
+@pytest.fixture
+def url(firmware, download_token):
+    return f'/firmware/{firmware.id}/download/{download_token.token}'
+
+@pytest.fixture
+def recorded(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(download_counter, 'record', lambda token_id, firmware_id: recorded.append(firmware_id))
+    return recorded
+
+def test_accel_redirect(app, client, url, firmware, recorded):
+    app.config['DOWNLOAD_SERVE_MODE'] = 'accel'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/protected-firmware/fw.bin'
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert response.data == b''
+    assert recorded == [firmware.id]
+
+def test_accel_redirect_counts_resumed_segments_once(app, client, url, firmware, recorded):
+    app.config['DOWNLOAD_SERVE_MODE'] = 'accel'
+    # nginx answers the Range header, so only the first segment counts
+    client.get(url, headers={'Range': 'bytes=0-4999'})
+    client.get(url, headers={'Range': 'bytes=5000-'})
+    assert recorded == [firmware.id]
+
+def test_sendfile(app, client, url):
+    app.config['DOWNLOAD_SERVE_MODE'] = 'sendfile'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['X-Sendfile'].endswith('fw.bin')
+    assert response.data == b''
@@ -0,0 +1,67 @@
+import pytest
+from samtech.pagecache import cache_key, invalidate_brand, invalidate_firmware
+from samtech.shared import shared
+
+@pytest.fixture
+def cache(app):
+    app.config['PAGE_CACHE_ENABLED'] = True
+    return app
+
+@pytest.fixture
+def brand_url(firmware):
+    return f'/brand/{firmware.brand_id}'
+
+def cache_state(client, url):
+    # Each request gets its own app context, and so its own g, as it would in a server
+    with client.application.app_context():
+        response = client.get(url)
+    assert response.status_code == 200
+    return response.headers.get('X-Page-Cache')
+
+def test_pages_are_served_from_the_cache(cache, client, brand_url):
+    assert cache_state(client, brand_url) == 'miss'
+    assert cache_state(client, brand_url) == 'hit'
+    # The query string is part of the key
+    assert cache_state(client, brand_url + '?view=all') == 'miss'
+
+def test_edits_invalidate_the_pages_showing_them(cache, client, brand_url, firmware):
+    cache_state(client, '/')
+    cache_state(client, brand_url)
+    
+    invalidate_firmware(firmware.id, firmware.brand_id)
+    assert cache_state(client, brand_url) == 'miss'
+    # The home page lists brands only
+    assert cache_state(client, '/') == 'hit'
+    
+    invalidate_brand(firmware.brand_id)
+    assert cache_state(client, '/') == 'miss'
+
+def test_expired_pages_are_served_stale_while_one_worker_renders(cache, client, brand_url):
+    cache_state(client, brand_url)
+    with cache.test_request_context(brand_url):
+        key = cache_key()
+    entry = shared.get(key)
+    entry['fresh_until'] = 0
+    shared.set(key, entry, ttl=60)
+    
+    lock = shared.lock(f'page-{key[-2:]}')
+    assert lock.acquire(blocking=False)
+    assert cache_state(client, brand_url) == 'stale'
+    lock.release()
+    assert cache_state(client, brand_url) == 'miss'
+    assert cache_state(client, brand_url) == 'hit'
+
+def test_signed_in_users_bypass_the_cache(cache, client, brand_url, user):
+    cache_state(client, brand_url)
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    assert cache_state(client, brand_url) is None
+
+def test_disabled_cache(app, client, brand_url):
+    assert cache_state(client, brand_url) is None
+    assert cache_state(client, brand_url) is None
+
+def test_missing_pages_are_not_cached(cache, client):
+    assert client.get('/brand/999').status_code == 404
+    assert client.get('/brand/999').headers.get('X-Page-Cache') is None
@@ -0,0 +1,82 @@
+import pytest
+from datetime import datetime, timedelta
+from samtech import db
+from samtech.models import Brand, Firmware
+from samtech.pagination import decode_cursor, encode_cursor, paginate
+
+COLUMNS = [Firmware.created_at, Firmware.id]
+
+@pytest.fixture
+def firmwares(app, user):
+    """25 firmwares; pairs share a created_at so the id breaks ties"""
+    brand = Brand.query.first()
+    start = datetime(2024, 1, 1)
+    for n in range(25):
+        db.session.add(Firmware(name=f'Model {n}', version='1', filename=f'fw{n}.bin', brand_id=brand.id,
+                                creator_id=user.id, created_at=start + timedelta(minutes=n // 2)))
+    db.session.commit()
+    return Firmware.query.order_by(Firmware.created_at.desc(), Firmware.id.desc()).all()
+
+def walk(query, **kwargs):
+    pages, cursor = [], None
+    while True:
+        page = paginate(query, COLUMNS, after=cursor, per_page=10, **kwargs)
+        pages.append(page)
+        if not page.has_next:
+            return pages
+        cursor = page.next_cursor
+
+def test_cursor_round_trip(app):
+    values = [datetime(2024, 5, 6, 7, 8, 9, 123456), 42]
+    assert decode_cursor(encode_cursor(values), COLUMNS) == values
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', encode_cursor([1]), encode_cursor({'a': 1}),
+                                    encode_cursor([1, 2]), encode_cursor(['yesterday', 2])])
+def test_invalid_cursor(app, cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, COLUMNS)
+
+def test_pages_cover_every_row_once(firmwares):
+    pages = walk(Firmware.query)
+    assert [len(page.items) for page in pages] == [10, 10, 5]
+    assert [row.id for page in pages for row in page.items] == [row.id for row in firmwares]
+    assert not pages[0].has_prev
+    assert pages[1].has_prev
+
+def test_ascending(firmwares):
+    pages = walk(Firmware.query, descending=False)
+    assert [row.id for page in pages for row in page.items] == [row.id for row in reversed(firmwares)]
+
+def test_previous_page(firmwares):
+    pages = walk(Firmware.query)
+    previous = paginate(Firmware.query, COLUMNS, before=pages[2].prev_cursor, per_page=10)
+    assert [row.id for row in previous.items] == [row.id for row in pages[1].items]
+    assert previous.has_next and previous.has_prev
+    
+    first = paginate(Firmware.query, COLUMNS, before=pages[1].prev_cursor, per_page=10)
+    assert [row.id for row in first.items] == [row.id for row in pages[0].items]
+    assert not first.has_prev
+
+def test_rows_added_while_paging_do_not_shift_pages(firmwares, user):
+    first = paginate(Firmware.query, COLUMNS, per_page=10)
+    db.session.add(Firmware(name='New', version='1', filename='new.bin', brand_id=firmwares[0].brand_id,
+                            creator_id=user.id, created_at=datetime(2030, 1, 1)))
+    db.session.commit()
+    second = paginate(Firmware.query, COLUMNS, after=first.next_cursor, per_page=10)
+    assert [row.id for row in second.items] == [row.id for row in firmwares[10:20]]
+
+def test_empty_page(app):
+    page = paginate(Firmware.query, COLUMNS, per_page=10)
+    assert page.items == [] and not page.has_next and not page.has_prev
+
+def test_catalog_rejects_bad_cursors(client, firmwares):
+    for cursor in ['WzEsMl0=', 'WzEsMl0', 'garbage']:
+        response = client.get(f'/firmware/catalog?after={cursor}')
+        assert response.status_code == 400
+        assert response.json['status'] == 'error'
+
+def test_catalog_pages(client, firmwares):
+    response = client.get('/firmware/catalog?per_page=20')
+    assert response.status_code == 200
+    assert len(response.json['data']['results']) == 20
+    assert response.json['data']['next']
@@ -0,0 +1,184 @@
+import json
+import pytest
+import threading
+import uuid
+from datetime import datetime, timedelta
+from werkzeug.serving import make_server
+from daraja_standin import DarajaStandIn
+from samtech import db
+from samtech.daraja import access_tokens
+from samtech.models import MpesaCallback, Payment
+from samtech.payments import apply_callbacks, callback_applier, reconcile_payments
+from samtech.shared import shared
+
+PHONE = '254712345678'
+
+@pytest.fixture(autouse=True)
+def no_background_apply(monkeypatch):
+    # Callbacks are applied by the tests, not by the applier thread
+    monkeypatch.setattr(callback_applier, 'notify', lambda: None)
+
+@pytest.fixture
+def standin(app):
+    daraja = DarajaStandIn('dev', 'devsecret', callback_delay=-1)
+    server = make_server('127.0.0.1', 0, daraja, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    app.config.update({
+        'MPESA_BASE_URL': f'http://127.0.0.1:{server.server_port}',
+        'MPESA_CONSUMER_KEY': 'dev',
+        'MPESA_CONSUMER_SECRET': 'devsecret',
+        'MPESA_RETRY_DELAY': 0,
+        'MPESA_RETRY_MAX_DELAY': 0
+    })
+    access_tokens.local = None
+    yield daraja
+    server.shutdown()
+    access_tokens.local = None
+
+def add_payment(firmware, user, checkout_id=None, age=timedelta(hours=1), amount=100):
+    payment = Payment(reference=f'FW{uuid.uuid4().hex[:10].upper()}', amount=amount, phone_number=PHONE,
+                      firmware_id=firmware.id, user_id=user.id)
+    payment.checkout_request_id = checkout_id
+    payment.created_at = datetime.utcnow() - age
+    db.session.add(payment)
+    db.session.commit()
+    # Reconciliation ends the session, so tests look payments up again
+    return payment.id
+
+def stk_result(checkout_id, result_code=0, receipt='QK12345678', amount=100):
+    result = {
+        'MerchantRequestID': '12345-6789-1',
+        'CheckoutRequestID': checkout_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user'
+    }
+    if result_code == 0:
+        result['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20240101120000},
+            {'Name': 'PhoneNumber', 'Value': int(PHONE)}
+        ]}
+    return {'Body': {'stkCallback': result}}
+
+def post_callback(client, body):
+    return client.post('/mpesa/callback', data=json.dumps(body), content_type='application/json')
+
+def test_callback_is_applied_once(client, firmware, user):
+    payment = db.session.get(Payment, add_payment(firmware, user, 'ws_CO_1'))
+    
+    # Daraja redelivers callbacks; only the first copy is stored
+    assert post_callback(client, stk_result('ws_CO_1')).status_code == 200
+    assert post_callback(client, stk_result('ws_CO_1')).status_code == 200
+    assert MpesaCallback.query.count() == 1
+    
+    assert len(apply_callbacks(100, 600)) == 1
+    db.session.refresh(payment)
+    assert payment.status == 'completed'
+    assert payment.mpesa_receipt == 'QK12345678'
+    completed_at = payment.completed_at
+    
+    # Nothing is left to apply, and applying again changes nothing
+    assert apply_callbacks(100, 600) == []
+    MpesaCallback.query.update({'applied_at': None})
+    db.session.commit()
+    apply_callbacks(100, 600)
+    db.session.refresh(payment)
+    assert payment.status == 'completed'
+    assert payment.completed_at == completed_at
+    assert MpesaCallback.query.one().outcome == 'duplicate'
+
+def test_receipt_is_recorded_once(client, firmware, user):
+    first = db.session.get(Payment, add_payment(firmware, user, 'ws_CO_1'))
+    second = db.session.get(Payment, add_payment(firmware, user, 'ws_CO_2'))
+    post_callback(client, stk_result('ws_CO_1', receipt='QKSAME0001'))
+    post_callback(client, stk_result('ws_CO_2', receipt='QKSAME0001'))
+    apply_callbacks(100, 600)
+    
+    db.session.refresh(first)
+    db.session.refresh(second)
+    assert (first.status, second.status) == ('completed', 'pending')
+
+def test_failed_callback(client, firmware, user):
+    payment = db.session.get(Payment, add_payment(firmware, user, 'ws_CO_1'))
+    post_callback(client, stk_result('ws_CO_1', result_code=1032))
+    apply_callbacks(100, 600)
+    db.session.refresh(payment)
+    assert payment.status == 'failed'
+    assert payment.failure_reason == 'Request cancelled by user'
+
+def test_unknown_callback_waits_for_its_payment(client, firmware, user):
+    post_callback(client, stk_result('ws_CO_early'))
+    apply_callbacks(100, 600)
+    assert MpesaCallback.query.one().applied_at is None
+    
+    # The push's CheckoutRequestID is recorded after its callback arrived
+    payment = db.session.get(Payment, add_payment(firmware, user, 'ws_CO_early'))
+    apply_callbacks(100, 600)
+    db.session.refresh(payment)
+    assert payment.status == 'completed'
+
+def test_unknown_callback_gives_up(client):
+    post_callback(client, stk_result('ws_CO_nobody'))
+    MpesaCallback.query.update({'received_at': datetime.utcnow() - timedelta(hours=1)})
+    db.session.commit()
+    apply_callbacks(100, 600)
+    assert MpesaCallback.query.one().outcome == 'unmatched'
+
+def settle_push(standin, checkout_id, result_code=0):
+    """Register a push with the stand-in and settle it without a callback"""
+    standin.result_code = result_code
+    push = {
+        'merchant_request_id': '12345-6789-1',
+        'checkout_request_id': checkout_id,
+        'amount': 100,
+        'phone': PHONE,
+        # Nothing listens here; the tests only query
+        'callback_url': 'http://127.0.0.1:9/callback',
+        'result': None
+    }
+    standin.pushes[checkout_id] = push
+    if result_code is not None:
+        standin.complete(push)
+
+def test_reconcile_payments(app, standin, firmware, user):
+    paid = add_payment(firmware, user, 'ws_CO_paid')
+    cancelled = add_payment(firmware, user, 'ws_CO_cancelled')
+    processing = add_payment(firmware, user, 'ws_CO_processing')
+    recent = add_payment(firmware, user, 'ws_CO_recent', age=timedelta(seconds=5))
+    unsent = add_payment(firmware, user, None)
+    settle_push(standin, 'ws_CO_paid')
+    settle_push(standin, 'ws_CO_cancelled', result_code=1032)
+    settle_push(standin, 'ws_CO_processing', result_code=None)
+    settle_push(standin, 'ws_CO_recent')
+    
+    stats = reconcile_payments(older_than=60, batch_size=2, concurrency=2)
+    assert stats['checked'] == 3
+    assert (stats['completed'], stats['failed'], stats['pending'], stats['unsent']) == (1, 1, 1, 1)
+    assert stats['errors'] == 0
+    assert shared.get('mpesa-reconcile')['finished_at'] is not None
+    
+    payments = {id: db.session.get(Payment, id) for id in (paid, cancelled, processing, recent, unsent)}
+    assert payments[paid].status == 'completed'
+    assert payments[paid].amount_paid == 100
+    assert payments[cancelled].status == 'failed'
+    assert payments[cancelled].failure_reason == 'Request cancelled by user'
+    assert payments[processing].status == 'pending'
+    assert payments[recent].status == 'pending'
+    assert payments[unsent].status == 'failed'
+    assert payments[unsent].failure_reason == 'Payment request was not sent'
+
+def test_reconcile_leaves_settled_payments_alone(app, standin, client, firmware, user):
+    payment_id = add_payment(firmware, user, 'ws_CO_1')
+    settle_push(standin, 'ws_CO_1', result_code=1032)
+    
+    # The callback settled it first; the query's answer must not undo that
+    post_callback(client, stk_result('ws_CO_1'))
+    apply_callbacks(100, 600)
+    reconcile_payments(older_than=60)
+    assert db.session.get(Payment, payment_id).status == 'completed'
+
+def test_one_reconciliation_at_a_time(app, standin):
+    with shared.lock('mpesa-reconcile'):
+        assert reconcile_payments(older_than=60) is None
@@ -0,0 +1,61 @@
+import pytest
+from samtech.counters import download_counter
+
+DATA = bytes(range(256)) * 40
+
+@pytest.fixture
+def url(firmware, download_token):
+    return f'/firmware/{firmware.id}/download/{download_token.token}'
+
+def test_full_download(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.data == DATA
+
+def test_single_range(client, url):
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 100-199/10240'
+    assert response.data == DATA[100:200]
+
+def test_open_and_suffix_ranges(client, url):
+    response = client.get(url, headers={'Range': 'bytes=10000-'})
+    assert response.status_code == 206
+    assert response.data == DATA[10000:]
+    
+    response = client.get(url, headers={'Range': 'bytes=-40'})
+    assert response.status_code == 206
+    assert response.data == DATA[-40:]
+
+def test_unsatisfiable_range(client, url):
+    response = client.get(url, headers={'Range': 'bytes=20000-20010'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */10240'
+
+def test_if_range_matching_etag(client, url):
+    etag = client.get(url).headers['ETag']
+    response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == DATA[:10]
+
+def test_if_range_stale_etag_sends_whole_file(client, url):
+    response = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"fw1-old"'})
+    assert response.status_code == 200
+    assert response.data == DATA
+
+def test_multirange_policy(app, client, url):
+    ranges = {'Range': 'bytes=0-9,100-109'}
+    response = client.get(url, headers=ranges)
+    assert response.status_code == 200
+    assert response.data == DATA
+    
+    app.config['DOWNLOAD_MULTIRANGE_POLICY'] = 'reject'
+    assert client.get(url, headers=ranges).status_code == 416
+
+def test_resumed_segments_count_once(client, url, firmware, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(download_counter, 'record', lambda token_id, firmware_id: recorded.append(firmware_id))
+    client.get(url, headers={'Range': 'bytes=0-4999'})
+    client.get(url, headers={'Range': 'bytes=5000-'})
+    assert recorded == [firmware.id]
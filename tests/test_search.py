@@ -0,0 +1,64 @@
+import pytest
+from samtech import db
+from samtech.models import Brand, Firmware
+from samtech.search import LikeIndex, index_brand, index_firmware, search_index, unindex_firmware
+
+@pytest.fixture
+def catalog(app, user):
+    samsung = Brand.query.filter_by(name='Samsung').one()
+    lg = Brand.query.filter_by(name='LG').one()
+    firmwares = [
+        Firmware(name='Galaxy A52', version='A525FXXU4', description='Android 13 update',
+                 filename='a52.bin', brand_id=samsung.id, creator_id=user.id),
+        Firmware(name='Galaxy S21', version='G991BXXU5', description='Camera fixes ported from the A52',
+                 filename='s21.bin', brand_id=samsung.id, creator_id=user.id),
+        Firmware(name='OLED55C1', version='03.20.60', description='Smart TV firmware',
+                 filename='oled.bin', brand_id=lg.id, creator_id=user.id)
+    ]
+    db.session.add_all(firmwares)
+    db.session.commit()
+    for firmware in firmwares:
+        index_firmware(firmware)
+    return firmwares
+
+def names(query):
+    return [firmware.name for firmware in search_index.search(query).items]
+
+def test_terms_match_as_prefixes(catalog):
+    assert names('gal s2') == ['Galaxy S21']
+    assert names('G991') == ['Galaxy S21']
+    assert names('lg tv') == ['OLED55C1']
+    # Every term must match
+    assert names('samsung android') == ['Galaxy A52']
+    assert names('samsung tv') == []
+    assert names('') == []
+
+def test_name_matches_rank_first(catalog):
+    # The S21 only mentions the A52 in its description
+    assert names('a52') == ['Galaxy A52', 'Galaxy S21']
+    assert names('camera') == ['Galaxy S21']
+
+def test_documents_follow_edits(catalog):
+    a52, s21, oled = catalog
+    oled.brand.name = 'LG Electronics'
+    db.session.commit()
+    index_brand(oled.brand)
+    assert names('electronics') == ['OLED55C1']
+    
+    db.session.delete(s21)
+    db.session.commit()
+    unindex_firmware(s21.id)
+    assert names('galaxy') == ['Galaxy A52']
+
+def test_json_results(client, catalog):
+    response = client.get('/firmware/search?q=galaxy&format=json&per_page=1')
+    data = response.json['data']
+    assert data['total'] == 2
+    assert data['pages'] == 2
+    assert len(data['results']) == 1
+    assert data['results'][0]['brand'] == 'Samsung'
+
+def test_like_fallback(catalog, monkeypatch):
+    monkeypatch.setattr(search_index, 'backend', LikeIndex())
+    assert names('oled smart') == ['OLED55C1']
+    assert names('galaxy') == ['Galaxy S21', 'Galaxy A52']
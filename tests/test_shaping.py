@@ -0,0 +1,62 @@
+import pytest
+from samtech import shaping, shared as shared_module
+from samtech.shared import shared
+
+DATA = bytes(range(256)) * 40
+
+class FakeClock:
+    """Stands in for the time module; sleeping moves the clock on"""
+    
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+    
+    def time(self):
+        return self.now
+    
+    def monotonic(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shaping, 'time', clock)
+    monkeypatch.setattr(shared_module, 'time', clock)
+    app.config['DOWNLOAD_STREAM_CHUNK_SIZE'] = 1024
+    return clock
+
+@pytest.fixture
+def url(firmware, download_token):
+    return f'/firmware/{firmware.id}/download/{download_token.token}'
+
+def test_stream_rate(app, client, url, clock):
+    app.config['DOWNLOAD_RATE_PER_STREAM'] = 4096
+    with client.get(url) as response:
+        assert response.data == DATA
+    
+    # The first chunk is the burst; the other nine are paced at the rate
+    assert sum(clock.slept) == pytest.approx((len(DATA) - 1024) / 4096)
+    assert shared.counter_values(['bandwidth.bytes_sent'])['bandwidth.bytes_sent'] == len(DATA)
+
+def test_global_rate_is_shared_by_streams(app, client, url, clock):
+    app.config['DOWNLOAD_RATE_GLOBAL'] = 4096
+    assert client.get(url).data == DATA
+    first = sum(clock.slept)
+    assert client.get(url).data == DATA
+    # The second download starts with the bucket already drained
+    assert sum(clock.slept) - first == pytest.approx(len(DATA) / 4096)
+
+def test_ranges_are_shaped(app, client, url, clock):
+    app.config['DOWNLOAD_RATE_PER_STREAM'] = 4096
+    response = client.get(url, headers={'Range': 'bytes=100-3171'})
+    assert response.status_code == 206
+    assert response.data == DATA[100:3172]
+    assert sum(clock.slept) == pytest.approx(2048 / 4096)
+
+def test_unshaped_by_default(client, url, clock):
+    assert client.get(url).data == DATA
+    assert clock.slept == []
@@ -0,0 +1,62 @@
+import hashlib
+import pytest
+from samtech import db
+from samtech.blobs import blob_key
+from samtech.models import Brand, Firmware, FirmwareBlob
+from samtech.storage import storage
+
+CONTENT = b'streamed firmware ' * 4000
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+@pytest.fixture
+def admin(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+def put(client, data=CONTENT, filename='S21.tar.md5', headers=None):
+    return client.put('/admin/firmware/upload', query_string={'filename': filename},
+                      data=data, headers=headers or {})
+
+def test_upload_is_stored_as_a_blob(admin):
+    response = put(admin, headers={'X-Content-SHA256': DIGEST.upper()})
+    assert response.status_code == 200
+    assert response.json['data'] == {'sha256': DIGEST, 'size': len(CONTENT), 'filename': 'S21.tar.md5'}
+    with storage.open(blob_key(DIGEST)) as f:
+        assert f.read() == CONTENT
+    
+    assert admin.get(f'/admin/firmware/blobs/{DIGEST}').json['exists'] is True
+
+def test_forms_can_reference_an_uploaded_blob(admin):
+    put(admin)
+    response = admin.post('/admin/firmware/add', data={
+        'name': 'Galaxy S21',
+        'version': 'G991BXXU1',
+        'description': 'Stock firmware',
+        'brand_id': str(Brand.query.first().id),
+        'price': '100',
+        'blob_digest': DIGEST,
+        'firmware_filename': 'S21.tar.md5'
+    })
+    assert response.status_code == 302
+    firmware = Firmware.query.filter_by(version='G991BXXU1').one()
+    assert firmware.blob_digest == DIGEST
+    assert db.session.get(FirmwareBlob, DIGEST).ref_count == 1
+
+def test_checksum_mismatch_discards_the_upload(admin):
+    response = put(admin, headers={'X-Content-SHA256': '0' * 64})
+    assert response.status_code == 400
+    assert db.session.get(FirmwareBlob, DIGEST) is None
+    assert not storage.exists(blob_key(DIGEST))
+
+def test_oversized_uploads_are_refused_before_reading(app, admin):
+    app.config['FIRMWARE_MAX_SIZE'] = len(CONTENT) - 1
+    assert put(admin).status_code == 413
+    assert db.session.get(FirmwareBlob, DIGEST) is None
+
+def test_file_name_is_required(admin):
+    assert put(admin, filename='').status_code == 400
+
+def test_uploads_need_a_signed_in_admin(client):
+    assert put(client).status_code == 302
@@ -0,0 +1,70 @@
+import pytest
+from datetime import datetime, timedelta
+from itsdangerous import URLSafeSerializer
+from samtech import db
+from samtech.models import RevokedDownload
+from samtech.tokens import SALT, issue_token, revocations, revoke_downloads, timestamp, verify_token
+
+@pytest.fixture(autouse=True)
+def fresh_revocations():
+    revocations.invalidate()
+    yield
+    revocations.invalidate()
+
+def expires():
+    return datetime.utcnow() + timedelta(hours=1)
+
+def test_round_trip(app):
+    token = issue_token(7, 3, expires(), byte_budget=1000, audit_id='abc')
+    claims = verify_token(token, 7)
+    assert claims['u'] == 3
+    assert claims['b'] == 1000
+    assert claims['j'] == 'abc'
+
+def test_token_is_bound_to_its_firmware(app):
+    assert verify_token(issue_token(7, 3, expires()), 8) is None
+
+def test_expired_token(app):
+    assert verify_token(issue_token(7, 3, datetime.utcnow() - timedelta(seconds=1)), 7) is None
+
+def test_tampered_token(app):
+    token = issue_token(7, 3, expires())
+    forged = URLSafeSerializer('not-the-key', salt=SALT).dumps({'f': 7, 'u': 3, 'i': 0, 'e': 2 ** 40})
+    payload, signature = token.rsplit('.', 1)
+    assert verify_token(f'{payload}x.{signature}', 7) is None
+    assert verify_token(forged, 7) is None
+    assert verify_token('garbage', 7) is None
+
+def test_key_rotation(app):
+    app.config['DOWNLOAD_SIGNING_KEYS'] = ['old-key']
+    token = issue_token(7, 3, expires())
+    
+    # The new key signs, the old one still verifies
+    app.config['DOWNLOAD_SIGNING_KEYS'] = ['old-key', 'new-key']
+    assert verify_token(token, 7) is not None
+    assert verify_token(issue_token(7, 3, expires()), 7) is not None
+    
+    app.config['DOWNLOAD_SIGNING_KEYS'] = ['new-key']
+    assert verify_token(token, 7) is None
+
+def test_revocation_covers_tokens_issued_before_it(app, firmware, user):
+    token = issue_token(firmware.id, user.id, expires())
+    assert verify_token(token, firmware.id) is not None
+    
+    revoke_downloads(user.id, firmware.id, reason='Refunded')
+    db.session.commit()
+    assert verify_token(token, firmware.id) is None
+
+def test_tokens_issued_after_a_revocation_work(app, firmware, user):
+    db.session.add(RevokedDownload(user_id=user.id, firmware_id=firmware.id,
+                                   revoked_at=datetime.utcnow() - timedelta(minutes=1)))
+    db.session.commit()
+    assert verify_token(issue_token(firmware.id, user.id, expires()), firmware.id) is not None
+
+def test_revocation_is_per_user_and_firmware(app, firmware, user):
+    revoke_downloads(user.id + 1, firmware.id)
+    db.session.commit()
+    assert verify_token(issue_token(firmware.id, user.id, expires()), firmware.id) is not None
+
+def test_timestamp_is_utc():
+    assert timestamp(datetime(1970, 1, 2)) == 86400
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import pytest
+import random
+import time
+from datetime import datetime, timedelta
+from samtech import db
+from samtech.blobs import blob_key
+from samtech.models import Brand, Firmware, UploadSession
+from samtech.storage import storage
+
+CHUNK_SIZE = 1000
+CONTENT = random.Random(3).randbytes(4 * CHUNK_SIZE + 123)
+
+@pytest.fixture
+def admin(app, client, user):
+    app.config['UPLOAD_CHUNK_SIZE'] = CHUNK_SIZE
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+def create_session(client, content=CONTENT, sha256=None):
+    response = client.post('/admin/uploads/', json={'filename': 'fw.tar.md5', 'size': len(content), 'sha256': sha256})
+    assert response.status_code == 201
+    return response.json['data']
+
+def put_chunks(client, session, content=CONTENT, order=None):
+    for index in order or range(session['chunk_count']):
+        chunk = content[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        response = client.put(f"/admin/uploads/{session['id']}/chunks/{index}", data=chunk,
+                              headers={'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+        assert response.status_code == 200
+
+def finalize(client, session, **details):
+    response = client.post(f"/admin/uploads/{session['id']}/finalize", json=details)
+    assert response.status_code == 202
+    # Finalizing runs in the background; poll the session like the admin page does
+    for _ in range(200):
+        status = client.get(response.headers['Location']).json['data']
+        if status['status'] != 'finalizing':
+            return status
+        time.sleep(0.02)
+    raise AssertionError('Upload was not finalized')
+
+def test_out_of_order_chunks(admin):
+    session = create_session(admin)
+    put_chunks(admin, session, order=[3, 0, 4, 2, 1])
+    status = finalize(admin, session)
+    
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    assert status['status'] == 'complete'
+    assert status['sha256'] == digest
+    with storage.open(blob_key(digest)) as f:
+        assert f.read() == CONTENT
+
+def test_finalize_with_firmware_details(admin):
+    session = create_session(admin)
+    put_chunks(admin, session)
+    status = finalize(admin, session, name='Galaxy S21', version='G991BXXU5CVDD',
+                      description='Android 12', brand_id=Brand.query.first().id, price=500)
+    
+    firmware = db.session.get(Firmware, status['firmware_id'])
+    assert firmware.blob_digest == status['sha256']
+    assert firmware.original_filename == 'fw.tar.md5'
+    assert firmware.blob.ref_count == 1
+
+def test_incomplete_upload(admin):
+    session = create_session(admin)
+    put_chunks(admin, session, order=[0, 1, 3])
+    response = admin.post(f"/admin/uploads/{session['id']}/finalize")
+    assert response.status_code == 409
+    assert response.json['data']['missing'] == [2, 4]
+
+def test_checksum_mismatch_reopens(admin):
+    session = create_session(admin, sha256='0' * 64)
+    put_chunks(admin, session)
+    status = finalize(admin, session)
+    assert status['status'] == 'open'
+    assert status['error'] == 'Checksum mismatch.'
+
+def test_stale_finalizing_is_reopened(app, admin):
+    session = create_session(admin)
+    put_chunks(admin, session)
+    # As if the worker finalizing it had died
+    row = db.session.get(UploadSession, session['id'])
+    row.status = 'finalizing'
+    row.finalize_started_at = datetime.utcnow() - timedelta(seconds=app.config['UPLOAD_FINALIZE_TIMEOUT_SECONDS'] + 1)
+    db.session.commit()
+    
+    status = finalize(admin, session)
+    assert status['status'] == 'complete'
+    assert not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], 'tmp', f"{session['id']}.part"))
@@ -0,0 +1,55 @@
+import pytest
+from samtech import db
+from samtech.devices import set_device_codes
+from samtech.models import Brand, Firmware
+from samtech.versions import latest_group, refresh_latest, set_version_fields, version_key
+
+def test_versions_sort_in_release_order():
+    versions = ['0.9', '1.0-alpha', '1.0-beta', '1.0-rc1', '1.0', 'v1.0a', '1.0.1', '1.2', '1.10', '2']
+    assert sorted(versions, key=version_key) == versions
+
+def test_leading_zeros_and_prefixes_do_not_matter():
+    assert version_key('v2.01') == version_key('2.1')
+    assert version_key('V2.1') == version_key('2.1')
+
+def test_samsung_builds_sort_by_their_last_characters():
+    # Bootloader, major version, year, month, build
+    builds = ['A525FXXU1AUB7', 'A525FXXU1AUE5', 'A525FXXU2BUG1', 'A525FXXS3BUL2', 'A525FXXU4CVJB']
+    assert sorted(builds, key=lambda build: version_key('', build)) == builds
+
+@pytest.fixture
+def add(app, user):
+    samsung = Brand.query.filter_by(name='Samsung').one()
+    
+    def add(version, filename='firmware.zip', name='Galaxy A52 SM-A525F'):
+        firmware = Firmware(name=name, version=version, description='Stock firmware', filename=filename,
+                            original_filename=filename, brand_id=samsung.id, creator_id=user.id)
+        set_device_codes(firmware)
+        set_version_fields(firmware)
+        db.session.add(firmware)
+        db.session.commit()
+        refresh_latest(latest_group(firmware))
+        return firmware
+    return add
+
+def latest(client, **params):
+    response = client.get('/firmware/latest', query_string=params)
+    assert response.status_code == 200
+    return [row['version'] for row in response.json['data']['results']]
+
+def test_latest_build_per_model_and_region(client, add):
+    add('A525FXXU2BUG1', 'A525FXXU2BUG1_A525FOXM2BUG1_KEN.zip')
+    newest = add('A525FXXU4CVJB', 'A525FXXU4CVJB_A525FOXM4CVJB_KEN.zip')
+    # Uploaded last, but an older build
+    add('A525FXXU3BUL2', 'A525FXXU3BUL2_A525FOXM3BUL2_KEN.zip')
+    add('A525FXXU1AUB7', 'A525FXXU1AUB7_A525FOJM1AUB7_XSG.zip')
+    add('1.10', name='Galaxy Tab S7 SM-T870')
+    add('1.9', name='Galaxy Tab S7 SM-T870')
+    
+    assert sorted(latest(client)) == ['1.10', 'A525FXXU1AUB7', 'A525FXXU4CVJB']
+    assert latest(client, model='SM-A525F', region='KEN') == ['A525FXXU4CVJB']
+    
+    db.session.delete(newest)
+    db.session.commit()
+    refresh_latest(latest_group(newest))
+    assert latest(client, model='SM-A525F', region='KEN') == ['A525FXXU3BUL2']